@@ -0,0 +1,357 @@
+import argparse
+import contextlib
+import csv
+import gzip
+import io
+import json
+import math
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+from ETHQuantoFutures.Metrics import metrics
+from ETHQuantoFutures.TradingUtil import TradeSetup, eth_spot_layer, eth_quanto_futures_layer
+from ETHQuantoFutures.Valuation import DAYS_PER_YEAR, SECONDS_PER_DAY, black76, chain_of, leg_quotes
+
+QUANTO_SYMBOL = "ETHUSDM21"
+# Deribit columns under the names the snapshots use; Tardis style exports call some of them differently
+DERIBIT_ALIASES = {'instrument_name': ('instrument_name', 'symbol'), 'underlying_price': ('underlying_price',),
+                   'best_ask_price': ('best_ask_price', 'ask_price'), 'best_bid_price': ('best_bid_price', 'bid_price'),
+                   'mark_price': ('mark_price',), 'mark_iv': ('mark_iv',)}
+STEP_COLUMNS = ('timestamp', 'btc_price', 'eth_spot_price', 'eth_quanto_price', 'spot_pnl', 'futures_pnl',
+                'options_pnl', 'pnl', 'liquidation_price', 'liquidation_distance')
+
+
+def parse_timestamp(value):
+    # epoch seconds, milliseconds or microseconds, or ISO 8601 including BitMEX's 2021-03-01D00:00:00.123456789;
+    # times without a zone are UTC
+    try:
+        number = float(value)
+    except ValueError:
+        text = value.strip().replace('Z', '+00:00')
+        if len(text) > 10 and text[10] == 'D':
+            text = text[:10] + 'T' + text[11:]
+        if '.' in text:
+            head, fraction = text.split('.', 1)
+            digits = len(fraction) - len(fraction.lstrip('0123456789'))
+            text = f"{head}.{fraction[:min(digits, 6)]}{fraction[digits:]}"
+        moment = datetime.fromisoformat(text)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.timestamp()
+    if number > 1e14:
+        return number / 1e6
+    if number > 1e11:
+        return number / 1e3
+    return number
+
+
+def read_rows(path):
+    # CSV with a header, gzipped when the name ends in .gz, one row at a time
+    with (gzip.open(path, 'rt', newline='') if path.endswith('.gz') else open(path, newline='')) as f:
+        yield from csv.DictReader(f)
+
+
+def number(value):
+    return float(value) if value not in (None, '') else np.nan
+
+
+def bitmex_quotes(path, quanto_symbol=QUANTO_SYMBOL):
+    # BitMEX quote dumps (timestamp, symbol, bidPrice, ...): XBTUSD is the BTC price, the quanto future the other
+    series = {'XBTUSD': 'btc', quanto_symbol: 'eth_quanto'}
+    for row in read_rows(path):
+        name = series.get(row['symbol'])
+        if name and row['bidPrice']:
+            yield parse_timestamp(row['timestamp']), name, float(row['bidPrice'])
+
+
+def binance_quotes(path):
+    # Binance ETHUSDT trades or klines, 'price' or else the 'close' column
+    for row in read_rows(path):
+        price = row.get('price') or row.get('close')
+        if price:
+            yield parse_timestamp(row.get('timestamp') or row['open_time']), 'eth_spot', float(price)
+
+
+def deribit_quotes(path):
+    # Deribit option tickers, one row per instrument and time; yields (time, instrument name, the raw row)
+    columns = None
+    for row in read_rows(path):
+        if columns is None:
+            columns = {field: next((alias for alias in aliases if alias in row), None)
+                       for field, aliases in DERIBIT_ALIASES.items()}
+        yield parse_timestamp(row['timestamp']), row[columns['instrument_name']], (row, columns)
+
+
+def deribit_ticker(row, columns):
+    ticker = {field: number(row[column]) if column else np.nan for field, column in columns.items()
+              if field != 'instrument_name'}
+    ticker['instrument_name'] = row[columns['instrument_name']]
+    return ticker
+
+
+def option_strike(instrument_name):
+    # BTC-25JUN21-60000-C -> 60000.0
+    return float(instrument_name.split('-')[2])
+
+
+class QuoteStream:
+    # a time ordered quote iterator that is consumed up to a time at a time
+    def __init__(self, quotes):
+        self.quotes = iter(quotes)
+        self.pending = next(self.quotes, None)
+
+    @property
+    def exhausted(self):
+        return self.pending is None
+
+    @property
+    def next_time(self):
+        return self.pending[0] if self.pending else math.inf
+
+    def until(self, end):
+        # every quote up to and including end
+        quotes = []
+        while self.pending is not None and self.pending[0] <= end:
+            quotes.append(self.pending)
+            self.pending = next(self.quotes, None)
+        return quotes
+
+
+class AsOf:
+    # the last quoted value of one series at every time of a grid, fed one chunk of quotes at a time
+    def __init__(self, value=np.nan):
+        self.value = value
+
+    def align(self, times, values, grid):
+        if not len(times):
+            return np.full(len(grid), self.value)
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        indices = np.searchsorted(times, grid, side='right') - 1
+        aligned = np.where(indices >= 0, values[np.maximum(indices, 0)], self.value)
+        self.value = values[-1]
+        return aligned
+
+
+class Backtest:
+    # opens the position once from the quotes at start, the way the dashboard does from a live query, and marks it
+    # on a fixed time grid until the quotes run out (or end). Spot and the quanto future are marked at their quoted
+    # prices, options at Deribit's mark (mark_price * underlying_price) or, while a leg has no mark yet, with
+    # Black-76 at its opening IV. Quotes are read in chunks of chunk_size grid steps and marked with whole array
+    # operations per chunk; only the chunk and running totals are in memory, whatever the length of the history
+    def __init__(self, bitmex_path, binance_path, deribit_path, start=None, end=None, step=60, chunk_size=10000,
+                 method=None, usd_value_eth=None, quanto_symbol=QUANTO_SYMBOL):
+        self.streams = {'bitmex': QuoteStream(bitmex_quotes(bitmex_path, quanto_symbol)),
+                        'binance': QuoteStream(binance_quotes(binance_path)),
+                        'deribit': QuoteStream(deribit_quotes(deribit_path))}
+        self.start = start
+        self.end = end
+        self.step = step
+        self.chunk_size = chunk_size
+        self.method = method
+        self.trade_setup = TradeSetup()
+        if usd_value_eth is not None:
+            self.trade_setup.USD_VALUE_ETH = usd_value_eth
+        self.summary = None
+
+    def open(self):
+        # consumes the quotes up to start (by default the first time all three exchanges have quoted) and opens the
+        # position from the last quote of every series and instrument
+        if self.start is None:
+            self.start = max(stream.next_time for stream in self.streams.values())
+            if math.isinf(self.start):
+                raise ValueError("an exchange has no quotes to open the position with")
+        prices = {}
+        for _, name, price in self.streams['bitmex'].until(self.start) + self.streams['binance'].until(self.start):
+            prices[name] = price
+        missing = {'btc', 'eth_quanto', 'eth_spot'} - set(prices)
+        if missing:
+            raise ValueError(f"no {', '.join(sorted(missing))} quote up to the start of the backtest")
+        latest = {}
+        for _, instrument_name, row in self.streams['deribit'].until(self.start):
+            latest[instrument_name] = row
+
+        starting_parameters = self.trade_setup.starting_parameters
+        starting_parameters.quoted_at = self.start
+        starting_parameters.btc_start_price = round(prices['btc'], 2)
+        starting_parameters.eth_quanto_futures_start_price = round(prices['eth_quanto'], 2)
+        starting_parameters.eth_spot_start_price = round(prices['eth_spot'], 2)
+        tickers = [dict(deribit_ticker(*row), strike=option_strike(instrument_name))
+                   for instrument_name, row in latest.items() if starting_parameters.wanted_expiry(instrument_name)]
+        tickers = [ticker for ticker in tickers if ticker['best_ask_price'] > 0]
+        chains = starting_parameters.select_chains([ticker for ticker in tickers if ticker['instrument_name'][:3] == 'BTC'],
+                                                   [ticker for ticker in tickers if ticker['instrument_name'][:3] == 'ETH'])
+        if not all(chains):
+            raise ValueError("the Deribit quotes at the start of the backtest leave an option chain empty")
+        (starting_parameters.btc_call_options, starting_parameters.btc_put_options,
+         starting_parameters.eth_call_options, starting_parameters.eth_put_options) = chains
+
+        self.trade_setup.set_default_state()
+        if self.method:
+            # the optimizers report on stdout, which is the summary's
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.trade_setup.set_optimal_state(method=self.method, progress=lambda *args: None)
+
+        self.legs = self.trade_setup.portfolio.leg_table
+        self.vols, self.expiries = leg_quotes(starting_parameters, self.legs)
+        self.leg_names = [self.instrument_name(underlying, is_call, strike, expiry)
+                          for underlying, is_call, strike, expiry, _, _ in self.legs.rows()]
+        self.prices = {name: AsOf(price) for name, price in prices.items()}
+        self.marks = [AsOf(self.mark_of(latest[name]) if name in latest else np.nan) for name in self.leg_names]
+        self.summary = {'start': self.start, 'end': self.start, 'steps': 0, 'final_pnl': 0.0,
+                        'min_pnl': math.inf, 'min_pnl_at': None, 'max_pnl': -math.inf, 'max_pnl_at': None,
+                        'max_drawdown': 0.0, 'min_liquidation_distance': math.inf,
+                        'min_liquidation_distance_at': None, 'liquidated_at': None,
+                        'portfolio': dict(vars(self.trade_setup.portfolio), legs=self.trade_setup.portfolio.legs.to_records())}
+        self.peak_pnl = -math.inf
+
+    def instrument_name(self, underlying, is_call, strike, expiry):
+        # the Deribit instrument a leg was bought as, None for legs the chains do not quote
+        options = chain_of(self.trade_setup.starting_parameters, underlying, is_call)
+        index = options.find(strike, expiry)
+        return options.instrument_names[index] if index is not None else None
+
+    @staticmethod
+    def mark_of(row):
+        ticker = deribit_ticker(*row)
+        return ticker['mark_price'] * ticker['underlying_price']
+
+    def chunks(self):
+        # the steps of the backtest as dicts of STEP_COLUMNS arrays, chunk_size steps at a time
+        if self.summary is None:
+            self.open()
+        chunk_start = self.start
+        while self.end is None or chunk_start <= self.end:
+            grid = chunk_start + self.step * np.arange(self.chunk_size, dtype=float)
+            if self.end is not None:
+                grid = grid[grid <= self.end]
+                if not len(grid):
+                    return
+            chunk_end = grid[-1]
+            bitmex = self.streams['bitmex'].until(chunk_end)
+            binance = self.streams['binance'].until(chunk_end)
+            deribit = self.streams['deribit'].until(chunk_end)
+            if self.end is None and all(stream.exhausted for stream in self.streams.values()):
+                # the history ends within this chunk, the grid stops at its last quote
+                last_quote = max([quote[0] for quote in (bitmex[-1:] + binance[-1:] + deribit[-1:])] or [chunk_start])
+                grid = grid[grid <= max(last_quote, chunk_start)]
+            yield self.mark(grid, bitmex + binance, deribit)
+            if self.end is None and all(stream.exhausted for stream in self.streams.values()):
+                return
+            chunk_start = chunk_end + self.step
+
+    @metrics.timed("backtest.chunk")
+    def mark(self, grid, price_quotes, option_quotes):
+        series = {name: ([], []) for name in self.prices}
+        for timestamp, name, price in price_quotes:
+            series[name][0].append(timestamp)
+            series[name][1].append(price)
+        # the streams are each in time order, merged they are not
+        prices = {}
+        for name, (times, values) in series.items():
+            order = np.argsort(times, kind='stable')
+            prices[name] = self.prices[name].align(np.asarray(times)[order], np.asarray(values)[order], grid)
+
+        leg_rows = {name: index for index, name in enumerate(self.leg_names) if name}
+        leg_series = [([], []) for _ in self.leg_names]
+        for timestamp, instrument_name, row in option_quotes:
+            index = leg_rows.get(instrument_name)
+            if index is not None:
+                leg_series[index][0].append(timestamp)
+                leg_series[index][1].append(self.mark_of(row))
+        marks = np.column_stack([mark.align(times, values, grid) for mark, (times, values) in
+                                 zip(self.marks, leg_series)]) if len(self.legs) else np.zeros((len(grid), 0))
+
+        starting_parameters = self.trade_setup.starting_parameters
+        portfolio = self.trade_setup.portfolio
+        btc, eth_spot, eth_quanto = prices['btc'], prices['eth_spot'], prices['eth_quanto']
+        spot_pnl = eth_spot_layer(eth_spot, btc, portfolio.eth_spot_amount, starting_parameters.eth_spot_start_price)
+        # the future at its own quote: the premium is whatever the market makes of it
+        futures_pnl = eth_quanto_futures_layer(eth_quanto, btc, portfolio.eth_quanto_futures_contracts_shorted,
+                                               starting_parameters.eth_quanto_futures_start_price,
+                                               starting_parameters.quanto_multiplier, 0)
+        forwards = np.where(self.legs.underlying == 'eth', eth_spot[:, None], btc[:, None])
+        years = (self.expiries - grid[:, None]) / SECONDS_PER_DAY / DAYS_PER_YEAR
+        values = np.where(np.isnan(marks), black76(forwards, self.legs.strike, years, self.vols, self.legs.is_call),
+                          marks)
+        options_pnl = (self.legs.amount * values - self.legs.amount * self.legs.premium).sum(axis=-1)
+        pnl = spot_pnl + futures_pnl + options_pnl
+        liquidation_price = self.trade_setup.calculate_bitmex_eth_liq_prices(btc)
+        liquidation_distance = liquidation_price / eth_quanto - 1
+        metrics.count("backtest.steps", len(grid))
+        self.update_summary(grid, pnl, liquidation_distance)
+        return dict(zip(STEP_COLUMNS, (grid, btc, eth_spot, eth_quanto, spot_pnl, futures_pnl, options_pnl, pnl,
+                                       liquidation_price, liquidation_distance)))
+
+    def update_summary(self, grid, pnl, liquidation_distance):
+        if not len(grid):
+            return
+        summary = self.summary
+        summary['steps'] += len(grid)
+        summary['end'] = float(grid[-1])
+        summary['final_pnl'] = float(pnl[-1])
+        low, high, closest = pnl.argmin(), pnl.argmax(), liquidation_distance.argmin()
+        if pnl[low] < summary['min_pnl']:
+            summary['min_pnl'], summary['min_pnl_at'] = float(pnl[low]), float(grid[low])
+        if pnl[high] > summary['max_pnl']:
+            summary['max_pnl'], summary['max_pnl_at'] = float(pnl[high]), float(grid[high])
+        if liquidation_distance[closest] < summary['min_liquidation_distance']:
+            summary['min_liquidation_distance'] = float(liquidation_distance[closest])
+            summary['min_liquidation_distance_at'] = float(grid[closest])
+        # the running peak continues from the chunks before
+        peaks = np.maximum.accumulate(np.maximum(pnl, self.peak_pnl))
+        summary['max_drawdown'] = max(summary['max_drawdown'], float((peaks - pnl).max()))
+        self.peak_pnl = float(peaks[-1])
+        liquidated = np.flatnonzero(liquidation_distance <= 0)
+        if summary['liquidated_at'] is None and liquidated.size:
+            summary['liquidated_at'] = float(grid[liquidated[0]])
+
+    def run(self, output=None):
+        # marks the whole history, writing every step to the output CSV when given; returns the summary
+        f = open(output, 'w') if output else None
+        try:
+            if f:
+                f.write(",".join(STEP_COLUMNS) + "\n")
+            for chunk in self.chunks():
+                if f:
+                    np.savetxt(f, np.column_stack([chunk[column] for column in STEP_COLUMNS]), delimiter=',',
+                               fmt='%.10g')
+        finally:
+            if f:
+                f.close()
+        return self.summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtests the hedge on historical quotes")
+    parser.add_argument("--bitmex", required=True, help="BitMEX quotes CSV (timestamp, symbol, bidPrice), may be .gz")
+    parser.add_argument("--binance", required=True, help="Binance ETHUSDT CSV (timestamp, price or close), may be .gz")
+    parser.add_argument("--deribit", required=True,
+                        help="Deribit option tickers CSV (timestamp, instrument_name, underlying_price, "
+                             "best_ask_price, mark_price, mark_iv), may be .gz")
+    parser.add_argument("--start", help="opening time, epoch seconds or ISO 8601; the first common quote by default")
+    parser.add_argument("--end", help="last time to mark, epoch seconds or ISO 8601; the last quote by default")
+    parser.add_argument("--step", type=float, default=60, help="seconds between marks")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="marks computed at once")
+    parser.add_argument("--method", help="optimize the position with this set_optimal_state method before holding it")
+    parser.add_argument("--usd-value-eth", type=float, help="USD value of the ETH position")
+    parser.add_argument("--quanto-symbol", default=QUANTO_SYMBOL)
+    parser.add_argument("-o", "--output", help="CSV every marked step is written to")
+    args = parser.parse_args()
+    backtest = Backtest(args.bitmex, args.binance, args.deribit,
+                        start=parse_timestamp(args.start) if args.start else None,
+                        end=parse_timestamp(args.end) if args.end else None,
+                        step=args.step, chunk_size=args.chunk_size, method=args.method,
+                        usd_value_eth=args.usd_value_eth, quanto_symbol=args.quanto_symbol)
+    try:
+        summary = backtest.run(args.output)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    json.dump(summary, sys.stdout, indent=1, default=float)
+    print()
+
+
+if __name__ == '__main__':
+    main()
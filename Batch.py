@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import csv
+import glob
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ETHQuantoFutures.Snapshots import MarketSnapshot
+from ETHQuantoFutures.TradingUtil import TradeSetup, OptimizationTarget, InfeasibleTarget
+
+# spec keys that are swept, every one a list of values; missing keys keep the dashboard's defaults
+SWEEP_KEYS = ('snapshot', 'method', 'usd_value_eth', 'premium_exit', 'eth_prices_range', 'btc_prices_range',
+              'cant_lose_prices')
+LEG_COLUMNS = tuple(f"{leg}_{field}" for leg in ('btc_calls', 'btc_puts', 'eth_calls', 'eth_puts')
+                    for field in ('amount', 'strike', 'premium'))
+SCORE_COLUMNS = ('cant_lose', 'min_pnl', 'mean_pnl', 'percentile_pnl', 'premium_cost', 'liquidation_pnl')
+BATCH_COLUMNS = ('id', 'status', 'error', 'seconds', 'quoted_at') + SWEEP_KEYS + \
+    ('eth_spot_amount', 'eth_quanto_futures_contracts_shorted') + LEG_COLUMNS + SCORE_COLUMNS
+
+
+def price_range(value):
+    # a list of prices, or {"start": 1400, "step": 200, "count": 16} like the OptimizationTarget defaults
+    if isinstance(value, dict):
+        return [value['start'] + value['step'] * i for i in range(value['count'])]
+    return list(value)
+
+
+def snapshot_paths(paths):
+    # files as they are, directories expand to every snapshot saved in them, oldest first
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded += sorted(glob.glob(os.path.join(path, "*.json.gz")))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def scenarios(spec):
+    # the cartesian product of every swept value, each with an id that only depends on its parameters
+    if not spec.get('snapshots'):
+        raise ValueError("the sweep spec needs at least one snapshot")
+    methods = spec.get('method', ['branch_and_bound'])
+    values = {
+        'snapshot': snapshot_paths(spec['snapshots']),
+        'method': [methods] if isinstance(methods, str) else methods,
+        'usd_value_eth': spec.get('usd_value_eth', [TradeSetup.USD_VALUE_ETH]),
+        'premium_exit': spec.get('premium_exit', [0]),
+        'eth_prices_range': [price_range(value) for value in
+                             spec.get('eth_prices_range', [OptimizationTarget.eth_prices_range])],
+        'btc_prices_range': [price_range(value) for value in
+                             spec.get('btc_prices_range', [OptimizationTarget.btc_prices_range])],
+        'cant_lose_prices': spec.get('cant_lose_prices', [OptimizationTarget.cant_lose_prices]),
+    }
+    for combination in itertools.product(*(values[key] for key in SWEEP_KEYS)):
+        scenario = dict(zip(SWEEP_KEYS, combination))
+        scenario['id'] = hashlib.sha1(json.dumps(scenario, sort_keys=True).encode()).hexdigest()[:16]
+        yield scenario
+
+
+def run_scenario(scenario):
+    # one optimization from scratch, as a CSV row; failures become rows too so that a sweep never stops on one
+    start = time.perf_counter()
+    row = {key: scenario[key] for key in ('id',) + SWEEP_KEYS}
+    try:
+        trade_setup = TradeSetup()
+        trade_setup.USD_VALUE_ETH = scenario['usd_value_eth']
+        trade_setup.optimization_target = OptimizationTarget(scenario['btc_prices_range'],
+                                                             scenario['eth_prices_range'],
+                                                             scenario['cant_lose_prices'])
+        trade_setup.set_exit_premium(scenario['premium_exit'])
+        MarketSnapshot.load(scenario['snapshot']).apply(trade_setup.starting_parameters)
+        trade_setup.set_default_state()
+        # the optimizers report on stdout, which would interleave between the worker processes
+        with contextlib.redirect_stdout(io.StringIO()):
+            trade_setup.set_optimal_state(method=scenario['method'], progress=lambda *args: None)
+        portfolio = vars(trade_setup.portfolio)
+        row.update({column: portfolio[column] for column in
+                    ('eth_spot_amount', 'eth_quanto_futures_contracts_shorted') + LEG_COLUMNS})
+        row.update(trade_setup.calc_range_scores())
+        row.update(status='ok', quoted_at=trade_setup.starting_parameters.quoted_at)
+    except InfeasibleTarget as e:
+        row.update(status='infeasible', error=str(e))
+    except Exception as e:
+        row.update(status='failed', error=repr(e))
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+
+def to_csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def finished_ids(path, retry_failed=False):
+    # ids already in the output (failed ones only without retry_failed); a line cut off by an interruption is
+    # dropped so appending continues cleanly
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+    with open(path, newline='') as f:
+        return {row['id'] for row in csv.DictReader(f)
+                if row.get('status') in ('ok', 'infeasible') or (row.get('status') and not retry_failed)}
+
+
+def run_batch(spec, output, workers=None, retry_failed=False, log=sys.stderr):
+    # rows are appended and flushed as the optimizations finish, in completion order; running the same spec
+    # against the same output again only runs the scenarios it does not have yet
+    done = finished_ids(output, retry_failed)
+    pending = [scenario for scenario in scenarios(spec) if scenario['id'] not in done]
+    print(f"{len(pending)} scenarios to run, {len(done)} already in {output}", file=log)
+    if not pending:
+        return 0
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+    failed = 0
+    with open(output, 'a', newline='') as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=BATCH_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        futures = [executor.submit(run_scenario, scenario) for scenario in pending]
+        try:
+            for finished, future in enumerate(as_completed(futures), 1):
+                row = future.result()
+                writer.writerow({key: to_csv_value(value) for key, value in row.items()})
+                f.flush()
+                failed += row['status'] == 'failed'
+                summary = f"min PnL {row['min_pnl']:.2f}" if row['status'] == 'ok' else row['error']
+                print(f"{finished}/{len(pending)} {row['id']} {row['status']} in {row['seconds']:.1f}s: {summary}",
+                      file=log)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return failed
+
+
+def write_parquet(csv_path, parquet_path):
+    # the CSV stays the journal that makes runs resumable, Parquet is written from it (last row of every id)
+    try:
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet output needs pyarrow: python -m pip install pyarrow")
+    table = pyarrow.csv.read_csv(csv_path)
+    last = {scenario_id: index for index, scenario_id in enumerate(table.column('id').to_pylist())}
+    pyarrow.parquet.write_table(table.take(sorted(last.values())), parquet_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a sweep of optimizations without the dashboard")
+    parser.add_argument("spec", help="JSON sweep spec, see the README")
+    parser.add_argument("-o", "--output", required=True, help="CSV the results are appended to, also for resuming")
+    parser.add_argument("--parquet", help="also write the results to this Parquet file when done (needs pyarrow)")
+    parser.add_argument("--workers", type=int, help="parallel optimizations, one per CPU core by default")
+    parser.add_argument("--retry-failed", action="store_true", help="run failed scenarios of the output again")
+    args = parser.parse_args()
+    with open(args.spec) as f:
+        spec = json.load(f)
+    failed = run_batch(spec, args.output, args.workers, args.retry_failed)
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+    if failed:
+        print(f"{failed} scenarios failed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import copy
+import threading
+import time
+import uuid
+
+
+class OptimizationCancelled(Exception):
+    pass
+
+
+# what a job publishes to the session store, so that any worker process can report on it
+RECORD_FIELDS = ('id', 'status', 'done', 'total', 'best_result', 'best_so_far', 'error', 'started_at', 'finished_at',
+                 'portfolio')
+
+
+class JobProgress:
+    # the status, ETA and summary of a job, for the job itself and for the record another process published of it
+    @property
+    def finished(self):
+        return self.status in ('done', 'cancelled', 'failed')
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def eta(self):
+        if not self.done or self.finished:
+            return None
+        return self.elapsed / self.done * (self.total - self.done)
+
+    @property
+    def summary(self):
+        text = f"{self.status}: {self.done}/{self.total} combinations in {self.elapsed:.0f}s"
+        if self.eta is not None:
+            text += f", about {self.eta:.0f}s left"
+        if self.best_so_far:
+            text += f" · best so far {self.best_result:.2f} USD with " \
+                    f"BTC calls {self.best_so_far[0]:.4f} at {self.best_so_far[1]}, " \
+                    f"BTC puts {self.best_so_far[3]:.4f} at {self.best_so_far[4]}, " \
+                    f"ETH calls {self.best_so_far[6]:.4f} at {self.best_so_far[7]}, " \
+                    f"ETH puts {self.best_so_far[9]:.4f} at {self.best_so_far[10]}"
+        if self.error:
+            text += f" · {self.error}"
+        return text
+
+    def to_record(self):
+        return {field: getattr(self, field) for field in RECORD_FIELDS}
+
+
+class JobRecord(JobProgress):
+    # a published job as read back from the session store; portfolio is the to_state() form of the job's portfolio
+    def __init__(self, record):
+        for field in RECORD_FIELDS:
+            setattr(self, field, record.get(field))
+
+
+class OptimizationJob(JobProgress):
+    def __init__(self, trade_setup, store=None, publish_interval=0.5, **optimize_options):
+        # the job optimizes its own copy, the live TradeSetup is only touched when the result is applied. With a
+        # store the job publishes its progress there (at most every publish_interval seconds, always when it
+        # finishes) and picks up cancellations requested through it by other processes
+        self.id = uuid.uuid4().hex
+        self.trade_setup = copy.deepcopy(trade_setup)
+        self.optimize_options = optimize_options
+        self.store = store
+        self.publish_interval = publish_interval
+        self.published_at = 0
+        self.status = 'pending'
+        self.done = 0
+        self.total = 0
+        self.best_result = None
+        self.best_so_far = []
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @property
+    def portfolio(self):
+        return self.trade_setup.to_state()['portfolio']
+
+    def publish(self, force=False):
+        if self.store is None or (not force and time.time() - self.published_at < self.publish_interval):
+            return
+        self.published_at = time.time()
+        self.store.save_job(self.id, self.to_record())
+        if self.store.job_cancel_requested(self.id):
+            self.cancel_event.set()
+
+    def run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        try:
+            self.trade_setup.set_optimal_state(progress=self.progress, **self.optimize_options)
+            self.status = 'done'
+        except OptimizationCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.error = repr(e)
+            self.status = 'failed'
+        self.finished_at = time.time()
+        self.publish(force=True)
+
+    def progress(self, done, total, best_result, optimal):
+        self.done = done
+        self.total = total
+        if optimal:
+            self.best_result = best_result
+            self.best_so_far = list(optimal)
+        self.publish()
+        if self.cancel_event.is_set():
+            raise OptimizationCancelled()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+class JobManager:
+    # jobs run in threads of the process that submitted them; with a shared store (SessionStore with a directory)
+    # every worker process can poll and cancel them, and read their results
+    def __init__(self, keep_finished=20, store=None):
+        self.jobs = {}
+        self.keep_finished = keep_finished
+        self.store = store
+        self.lock = threading.Lock()
+
+    def submit(self, trade_setup, **optimize_options):
+        job = OptimizationJob(trade_setup, store=self.store, **optimize_options)
+        with self.lock:
+            finished = [job_id for job_id, old_job in self.jobs.items() if old_job.finished]
+            for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self.jobs[job_id]
+            self.jobs[job.id] = job
+        # published before anyone can poll it, a poll on another process must not find it missing
+        job.publish(force=True)
+        job.thread.start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            record = self.store.load_job(job_id)
+            return JobRecord(record) if record is not None else None
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if isinstance(job, OptimizationJob):
+            job.cancel()
+        elif job is not None:
+            self.store.cancel_job(job_id)
+        return job
+
+    def forget(self, job_id):
+        # a result that was applied is not needed anymore
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        if self.store is not None:
+            self.store.delete_job(job_id)
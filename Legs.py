@@ -0,0 +1,67 @@
+import numpy as np
+
+LEG_FIELDS = ('underlying', 'is_call', 'strike', 'expiry', 'amount', 'premium')
+
+
+class LegTable:
+    # any number of option legs as columns: underlying ('eth' or 'btc'), is_call, strike, expiry (Deribit code like
+    # '25JUN21', None when it does not matter), amount and the USD premium paid per unit.
+    # Tables are values, so they can be compared, hashed and used as cache keys
+    def __init__(self, underlying=(), is_call=(), strike=(), expiry=(), amount=(), premium=()):
+        self.underlying = np.array(underlying, dtype='<U3')
+        self.is_call = np.array(is_call, dtype=bool)
+        self.strike = np.array(strike, dtype=float)
+        self.expiry = list(expiry)
+        self.amount = np.array(amount, dtype=float)
+        self.premium = np.array(premium, dtype=float)
+        if not len(self.underlying) == len(self.is_call) == len(self.strike) == len(self.expiry) == \
+                len(self.amount) == len(self.premium):
+            raise ValueError("leg columns differ in length")
+        if not np.isin(self.underlying, ('eth', 'btc')).all():
+            raise ValueError(f"unknown underlying in {self.underlying.tolist()}")
+        self.key = tuple(self.rows())
+
+    @classmethod
+    def from_records(cls, records):
+        records = list(records)
+        return cls(*([record.get(field) for record in records] for field in LEG_FIELDS))
+
+    def rows(self):
+        return (tuple(values) for values in zip(self.underlying.tolist(), self.is_call.tolist(), self.strike.tolist(),
+                                                self.expiry, self.amount.tolist(), self.premium.tolist()))
+
+    def to_records(self):
+        return [dict(zip(LEG_FIELDS, values)) for values in self.rows()]
+
+    @property
+    def cost(self):
+        return float((self.amount * self.premium).sum())
+
+    @property
+    def strikes_by_underlying(self):
+        return {underlying: self.strike[self.underlying == underlying].tolist() for underlying in ('eth', 'btc')}
+
+    def leg_pnl(self, eth_exit_prices, btc_exit_prices):
+        # payoff minus premium of every leg, stacked on a new last axis after the broadcast price shape
+        eth_exit_prices = np.asarray(eth_exit_prices, dtype=float)[..., None]
+        btc_exit_prices = np.asarray(btc_exit_prices, dtype=float)[..., None]
+        exit_prices = np.where(self.underlying == 'eth', eth_exit_prices, btc_exit_prices)
+        payoff = np.where(self.is_call,
+                          np.where(exit_prices > self.strike, exit_prices - self.strike, 0),
+                          np.where(exit_prices < self.strike, self.strike - exit_prices, 0))
+        return self.amount * payoff - self.amount * self.premium
+
+    def pnl(self, eth_exit_prices, btc_exit_prices):
+        return self.leg_pnl(eth_exit_prices, btc_exit_prices).sum(axis=-1)
+
+    def __len__(self):
+        return len(self.strike)
+
+    def __eq__(self, other):
+        return isinstance(other, LegTable) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"LegTable({list(self.key)})"
@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ETHQuantoFutures.Metrics import metrics
+
+
+class RateLimiter:
+    # token bucket: `burst` requests at once, refilled at `rate` requests per second
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ExchangeClient:
+    def __init__(self, base_url, session, rate, burst, max_retries=4, backoff=0.25, timeout=10, name="exchange"):
+        # name labels the metrics: http.<name> times every call, retries and rate limit waits included
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.session = session
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def get(self, path, **params):
+        with metrics.timer(f"http.{self.name}"):
+            return self.get_with_retries(path, **params)
+
+    def get_with_retries(self, path, **params):
+        for attempt in range(self.max_retries + 1):
+            with metrics.timer(f"http.{self.name}.rate_limit"):
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                retry_after = response.headers.get('Retry-After')
+                error = requests.HTTPError(f"{response.status_code} from {response.url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retry_after = None
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            metrics.count(f"http.{self.name}.retries")
+            delay = self.backoff * 2 ** attempt
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay)
+
+
+class MarketDataClient:
+    BITMEX_URL = "https://www.bitmex.com"
+    BINANCE_URL = "https://api.binance.com"
+    DERIBIT_URL = "https://www.deribit.com"
+
+    def __init__(self, bitmex_url=None, binance_url=None, deribit_url=None, max_workers=16, **client_options):
+        # one pooled session for every exchange, so connections are reused between calls and queries
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.bitmex = ExchangeClient(bitmex_url or self.BITMEX_URL, self.session, rate=0.5, burst=10, name="bitmex",
+                                     **client_options)
+        self.binance = ExchangeClient(binance_url or self.BINANCE_URL, self.session, rate=10, burst=10, name="binance",
+                                      **client_options)
+        self.deribit = ExchangeClient(deribit_url or self.DERIBIT_URL, self.session, rate=20, burst=20, name="deribit",
+                                      **client_options)
+
+    def get_many(self, calls):
+        # calls are (client, path, params) tuples, results come back in the same order
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(calls)))) as executor:
+            futures = [executor.submit(client.get, path, **params) for client, path, params in calls]
+            return [future.result() for future in futures]
+
+    def bitmex_quote(self, symbol):
+        return self.bitmex, "/api/v1/quote", dict(symbol=symbol, count=1, reverse="true")
+
+    def binance_ticker_price(self, symbol):
+        return self.binance, "/api/v3/ticker/price", dict(symbol=symbol)
+
+    def deribit_instruments(self, currency):
+        return self.deribit, "/api/v2/public/get_instruments", dict(currency=currency, kind="option", expired="false")
+
+    def deribit_book_summary(self, currency):
+        return self.deribit, "/api/v2/public/get_book_summary_by_currency", dict(currency=currency, kind="option")
+
+    def deribit_ticker(self, instrument_name):
+        return self.deribit, "/api/v2/public/ticker", dict(instrument_name=instrument_name)
+
+
+def ticker_from_book_summary(summary):
+    # the bulk endpoint names the quote fields differently and reports a missing side as null instead of 0
+    return {
+        'instrument_name': summary['instrument_name'],
+        'underlying_price': summary['underlying_price'],
+        'best_ask_price': summary.get('ask_price') or 0,
+        'best_bid_price': summary.get('bid_price') or 0,
+        'mark_price': summary.get('mark_price'),
+        'mark_iv': summary.get('mark_iv'),
+    }
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = MarketDataClient()
+        return _default_client
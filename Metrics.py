@@ -0,0 +1,166 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# counters of work done, reported per second of the timer they are named after ('optimizer.lp.candidates' per
+# second of 'optimizer.lp')
+RATE_COUNTERS = ('candidates', 'evaluations')
+
+
+class Timer:
+    # count, total and max of every measurement plus the last `window` ones for the percentiles
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def to_dict(self):
+        recent = np.array(self.recent) if self.recent else np.zeros(1)
+        return {'count': self.count, 'total_s': self.total, 'max_ms': self.max * 1000,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0,
+                'p50_ms': float(np.percentile(recent, 50) * 1000),
+                'p90_ms': float(np.percentile(recent, 90) * 1000),
+                'p99_ms': float(np.percentile(recent, 99) * 1000)}
+
+
+class Metrics:
+    # process wide timers and counters, cheap enough for the hot paths: one lock round trip per measurement
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        # failed calls are timed too, and counted under name.errors
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(f"{name}.errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name=None):
+        # decorator form of timer, named after the function unless told otherwise
+        def decorator(function):
+            timer_name = name or function.__name__
+
+            # the same as timer, without the generator round trip of a context manager on every call
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    self.count(f"{timer_name}.errors")
+                    raise
+                finally:
+                    self.observe(timer_name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        # counters, timers and the RATE_COUNTERS per second of their timers
+        with self.lock:
+            timers = {name: timer.to_dict() for name, timer in self.timers.items()}
+            counters = dict(self.counters)
+        rates = {}
+        for name, value in counters.items():
+            prefix, _, kind = name.rpartition('.')
+            if kind in RATE_COUNTERS and prefix in timers and timers[prefix]['total_s'] > 0:
+                rates[f"{name}_per_s"] = value / timers[prefix]['total_s']
+        return {'uptime_s': time.time() - self.started_at, 'counters': counters, 'timers': timers, 'rates': rates}
+
+    def prometheus(self):
+        # the snapshot in the Prometheus text format, timers as summaries
+        snapshot = self.snapshot()
+        lines = [f"quanto_uptime_seconds {snapshot['uptime_s']}"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"quanto_{metric_name(name)}_total {value}")
+        for name, timer in sorted(snapshot['timers'].items()):
+            name = metric_name(name)
+            for quantile in ('50', '90', '99'):
+                lines.append(f'quanto_{name}_seconds{{quantile="0.{quantile}"}} {timer[f"p{quantile}_ms"] / 1000}')
+            lines.append(f"quanto_{name}_seconds_sum {timer['total_s']}")
+            lines.append(f"quanto_{name}_seconds_count {timer['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.started_at = time.time()
+
+
+def metric_name(name):
+    return "".join(character if character.isalnum() else '_' for character in name)
+
+
+class Profiler:
+    # cProfile for single requests, switched on with QUANTO_PROFILE_DIR. Only one profile runs at a time (the
+    # interpreter allows no more), a request that finds it busy runs unprofiled. Every profile is dumped to the
+    # directory for snakeviz or pstats, the text of the last ones is kept for the metrics endpoint
+    def __init__(self, directory=None, keep=20):
+        self.directory = directory if directory is not None else os.environ.get("QUANTO_PROFILE_DIR")
+        self.recent = deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @contextmanager
+    def profile(self, name):
+        # yields the path the profile will be written to, None when the request runs unprofiled
+        if not self.enabled or not self.lock.acquire(blocking=False):
+            yield None
+            return
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{metric_name(name)}-{uuid.uuid4().hex[:8]}.prof")
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield path
+            finally:
+                profile.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path)
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(30)
+            self.recent.append({'name': name, 'path': path, 'at': time.time(), 'stats': text.getvalue()})
+        finally:
+            self.lock.release()
+
+
+metrics = Metrics()
+profiler = Profiler()
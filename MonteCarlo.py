@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import sys
+
+import numpy as np
+
+from ETHQuantoFutures.Metrics import metrics
+from ETHQuantoFutures.Snapshots import load_replay_snapshot
+from ETHQuantoFutures.TradingUtil import TradeSetup
+
+
+def implied_vol(options, underlying_price, default):
+    # mark_iv of the strike closest to the money, Deribit quotes it in percent
+    mark_iv = options.columns['mark_iv']
+    quoted = np.flatnonzero(mark_iv > 0)
+    if not len(quoted):
+        return default
+    return float(mark_iv[quoted[np.argmin(np.abs(options.strikes[quoted] - underlying_price))]]) / 100
+
+
+class StreamingHistogram:
+    # fixed bins over the range of the first chunk (widened on both sides), per-bin counts and sums give
+    # quantiles and tail means without keeping the samples; values outside the range land in the edge bins
+    def __init__(self, first_values, bins):
+        low, high = float(first_values.min()), float(first_values.max())
+        pad = max(high - low, 1.0)
+        self.edges = np.linspace(low - pad, high + pad, bins + 1)
+        self.counts = np.zeros(bins)
+        self.sums = np.zeros(bins)
+
+    def add(self, values):
+        index = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(index, minlength=len(self.counts))
+        self.sums += np.bincount(index, weights=values, minlength=len(self.counts))
+
+    def lower_tail(self, probability):
+        # returns (quantile, mean of the values below it)
+        target = probability * self.counts.sum()
+        cumulative = np.cumsum(self.counts)
+        bin_index = min(int(np.searchsorted(cumulative, target)), len(self.counts) - 1)
+        below = cumulative[bin_index] - self.counts[bin_index]
+        fraction = (target - below) / self.counts[bin_index] if self.counts[bin_index] else 0
+        quantile = self.edges[bin_index] + fraction * (self.edges[bin_index + 1] - self.edges[bin_index])
+        tail_sum = self.sums[:bin_index].sum() + fraction * self.sums[bin_index]
+        return quantile, tail_sum / target if target else quantile
+
+
+class MonteCarloResult:
+    def __init__(self, num_samples, expected_pnl, std_pnl, min_pnl, max_pnl, var, cvar, liquidation_probability,
+                 confidence):
+        self.num_samples = num_samples
+        self.expected_pnl = expected_pnl
+        self.std_pnl = std_pnl
+        self.min_pnl = min_pnl
+        self.max_pnl = max_pnl
+        self.var = var
+        self.cvar = cvar
+        self.liquidation_probability = liquidation_probability
+        self.confidence = confidence
+
+    def __repr__(self):
+        return f"MonteCarloResult(samples={self.num_samples}, E[PnL]={self.expected_pnl:.2f}, " \
+               f"std={self.std_pnl:.2f}, VaR{self.confidence:.0%}={self.var:.2f}, " \
+               f"CVaR{self.confidence:.0%}={self.cvar:.2f}, P(liquidation)={self.liquidation_probability:.4f})"
+
+
+def daily_steps(horizon_days):
+    return max(1, math.ceil(horizon_days))
+
+
+class MonteCarlo:
+    def __init__(self, trade_setup, eth_vol=None, btc_vol=None, correlation=0.8, horizon_days=90, steps=1,
+                 confidence=0.95, chunk_size=1000000, bins=20000, seed=None):
+        # correlated zero-drift lognormal ETH/BTC prices. With steps=1 only the exit prices are drawn and the
+        # liquidation probability is that of being past the liquidation price at exit; daily_steps(horizon_days)
+        # checks it along the path instead (paths that cross and come back count), at steps times the cost. The
+        # futures premium moves linearly from the starting premium to the exit premium
+        self.trade_setup = trade_setup
+        starting_parameters = trade_setup.starting_parameters
+        self.eth_vol = eth_vol if eth_vol is not None else \
+            implied_vol(starting_parameters.eth_call_options + starting_parameters.eth_put_options,
+                        starting_parameters.eth_spot_start_price, 0.9)
+        self.btc_vol = btc_vol if btc_vol is not None else \
+            implied_vol(starting_parameters.btc_call_options + starting_parameters.btc_put_options,
+                        starting_parameters.btc_start_price, 0.75)
+        self.correlation = correlation
+        self.horizon = horizon_days / 365
+        self.steps = steps
+        self.confidence = confidence
+        self.chunk_size = chunk_size
+        self.bins = bins
+        self.rng = np.random.default_rng(seed)
+
+    def simulate_chunk(self, size):
+        starting_parameters = self.trade_setup.starting_parameters
+        dt = self.horizon / self.steps
+        start_premium = starting_parameters.eth_quanto_futures_start_price / starting_parameters.eth_spot_start_price - 1
+        exit_premium = self.trade_setup.exit_parameters.premium_exit
+        log_eth = np.full(size, np.log(starting_parameters.eth_spot_start_price))
+        log_btc = np.full(size, np.log(starting_parameters.btc_start_price))
+        liquidated = np.zeros(size, dtype=bool)
+        for step in range(1, self.steps + 1):
+            z_btc = self.rng.standard_normal(size)
+            z_eth = self.correlation * z_btc + np.sqrt(1 - self.correlation ** 2) * self.rng.standard_normal(size)
+            log_btc += -0.5 * self.btc_vol ** 2 * dt + self.btc_vol * np.sqrt(dt) * z_btc
+            log_eth += -0.5 * self.eth_vol ** 2 * dt + self.eth_vol * np.sqrt(dt) * z_eth
+            premium = start_premium + (exit_premium - start_premium) * step / self.steps
+            btc_prices = np.exp(log_btc)
+            liquidated |= np.exp(log_eth) * (1 + premium) >= self.trade_setup.calculate_bitmex_eth_liq_prices(btc_prices)
+        return np.exp(log_eth), np.exp(log_btc), liquidated
+
+    @metrics.timed("montecarlo.run")
+    def run(self, num_samples):
+        if num_samples <= 0:
+            raise ValueError(f"num_samples must be positive, got {num_samples}")
+        total = total_squares = 0.0
+        min_pnl, max_pnl = np.inf, -np.inf
+        liquidations = 0
+        histogram = None
+        for start in range(0, num_samples, self.chunk_size):
+            eth_prices, btc_prices, liquidated = self.simulate_chunk(min(self.chunk_size, num_samples - start))
+            pnl = self.trade_setup.calculate_pnl_grid(eth_prices, btc_prices)
+            if histogram is None:
+                histogram = StreamingHistogram(pnl, self.bins)
+            histogram.add(pnl)
+            total += pnl.sum()
+            total_squares += np.square(pnl).sum()
+            min_pnl = min(min_pnl, pnl.min())
+            max_pnl = max(max_pnl, pnl.max())
+            liquidations += int(liquidated.sum())
+
+        metrics.count("montecarlo.run.evaluations", num_samples)
+        mean = total / num_samples
+        quantile, tail_mean = histogram.lower_tail(1 - self.confidence)
+        return MonteCarloResult(num_samples=num_samples,
+                                expected_pnl=mean,
+                                std_pnl=float(np.sqrt(max(total_squares / num_samples - mean ** 2, 0))),
+                                min_pnl=float(min_pnl),
+                                max_pnl=float(max_pnl),
+                                var=float(-quantile),
+                                cvar=float(-tail_mean),
+                                liquidation_probability=liquidations / num_samples,
+                                confidence=self.confidence)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo PnL, VaR/CVaR and liquidation probability of the hedge")
+    parser.add_argument("snapshot", help="market snapshot saved through QUANTO_SNAPSHOT_DIR, a directory for its latest")
+    parser.add_argument("--samples", type=int, default=1000000)
+    parser.add_argument("--method", help="optimize the position with this set_optimal_state method first")
+    parser.add_argument("--premium-exit", type=float, default=0, help="futures premium at exit, 0.02 is 2%%")
+    parser.add_argument("--horizon-days", type=float, default=90)
+    parser.add_argument("--eth-vol", type=float, help="annual ETH vol, the at-the-money mark_iv by default")
+    parser.add_argument("--btc-vol", type=float, help="annual BTC vol, the at-the-money mark_iv by default")
+    parser.add_argument("--correlation", type=float, default=0.8)
+    parser.add_argument("--daily-paths", action="store_true",
+                        help="check liquidation on every day of the horizon instead of at exit only (slower)")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    trade_setup = TradeSetup()
+    trade_setup.set_exit_premium(args.premium_exit)
+    load_replay_snapshot(args.snapshot).apply(trade_setup.starting_parameters)
+    trade_setup.set_default_state()
+    if args.method:
+        with contextlib.redirect_stdout(io.StringIO()):
+            trade_setup.set_optimal_state(method=args.method, progress=lambda *args: None)
+    monte_carlo = MonteCarlo(trade_setup, eth_vol=args.eth_vol, btc_vol=args.btc_vol, correlation=args.correlation,
+                             horizon_days=args.horizon_days,
+                             steps=daily_steps(args.horizon_days) if args.daily_paths else 1,
+                             confidence=args.confidence, seed=args.seed)
+    try:
+        result = monte_carlo.run(args.samples)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    json.dump(vars(result), sys.stdout, indent=1, default=float)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import numpy as np
+
+NUMERIC_FIELDS = ('strike', 'underlying_price', 'best_ask_price', 'best_bid_price', 'mark_price', 'mark_iv')
+
+
+def as_column(values, length):
+    if values is None:
+        return np.full(length, np.nan)
+    return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+
+class OptionRow:
+    # a view of one row that reads and writes like the ticker dict it replaces
+    __slots__ = ('chain', 'index')
+
+    def __init__(self, chain, index):
+        self.chain = chain
+        self.index = index
+
+    def get(self, field, default=None):
+        if field == 'instrument_name':
+            return self.chain.instrument_names[self.index]
+        if field != 'premium' and field not in NUMERIC_FIELDS:
+            return default
+        value = float(self.chain.columns[field][self.index])
+        return default if np.isnan(value) else value
+
+    def __getitem__(self, field):
+        if field != 'instrument_name' and field != 'premium' and field not in NUMERIC_FIELDS:
+            raise KeyError(field)
+        return self.get(field)
+
+    def __setitem__(self, field, value):
+        self.chain.set(self.index, field, value)
+
+    def __repr__(self):
+        return repr({field: self.get(field) for field in ('instrument_name',) + NUMERIC_FIELDS})
+
+
+class OptionChain:
+    # one column per quoted field instead of one Deribit ticker dict per option; 'premium' is the USD ask
+    # (underlying_price * best_ask_price), kept up to date by set
+    def __init__(self, instrument_names, columns):
+        self.instrument_names = list(instrument_names)
+        self.columns = {field: as_column(columns.get(field), len(self.instrument_names)) for field in NUMERIC_FIELDS}
+        self.columns['premium'] = self.columns['underlying_price'] * self.columns['best_ask_price']
+        self.index_strikes()
+
+    @classmethod
+    def from_records(cls, records):
+        records = list(records)
+        return cls([record.get('instrument_name') for record in records],
+                   {field: [record.get(field) for record in records] for field in NUMERIC_FIELDS})
+
+    @property
+    def strikes(self):
+        return self.columns['strike']
+
+    @property
+    def premiums(self):
+        return self.columns['premium']
+
+    def column(self, field):
+        # plain python values, None where the exchange gave nothing
+        if field == 'instrument_name':
+            return list(self.instrument_names)
+        return [None if np.isnan(value) else value for value in self.columns[field].tolist()]
+
+    @property
+    def expiries(self):
+        # Deribit expiry codes taken from the instrument names (BTC-25JUN21-60000-C -> 25JUN21)
+        return [name.split('-')[1] if name and name.count('-') >= 3 else None for name in self.instrument_names]
+
+    def index_strikes(self):
+        self.row_by_strike = {}
+        for index, (strike, expiry) in enumerate(zip(self.columns['strike'].tolist(), self.expiries)):
+            self.row_by_strike.setdefault(strike, index)
+            self.row_by_strike.setdefault((strike, expiry), index)
+
+    def find(self, strike, expiry=None):
+        # row of the first option with this strike (and expiry, when given), or None
+        return self.row_by_strike.get(strike if expiry is None else (strike, expiry))
+
+    def set(self, index, field, value):
+        if field == 'instrument_name':
+            self.instrument_names[index] = value
+            self.index_strikes()
+            return
+        self.columns[field][index] = np.nan if value is None else value
+        if field == 'strike':
+            self.index_strikes()
+        if field in ('underlying_price', 'best_ask_price'):
+            self.columns['premium'][index] = self.columns['underlying_price'][index] * self.columns['best_ask_price'][index]
+
+    def update_quotes(self, other, instrument_names=None):
+        # copies the quotes (everything but the strike) of the instruments this chain shares with other, only of
+        # instrument_names when given; the rows and their order stay this chain's
+        other_rows = {name: index for index, name in enumerate(other.instrument_names)}
+        rows, other_indices = [], []
+        for index, name in enumerate(self.instrument_names):
+            if name in other_rows and (instrument_names is None or name in instrument_names):
+                rows.append(index)
+                other_indices.append(other_rows[name])
+        for field in NUMERIC_FIELDS[1:]:
+            self.columns[field][rows] = other.columns[field][other_indices]
+        self.columns['premium'][rows] = self.columns['underlying_price'][rows] * self.columns['best_ask_price'][rows]
+        return len(rows)
+
+    def missing_from(self, other):
+        # the rows of other whose instruments this chain does not have, as a chain
+        names = set(self.instrument_names)
+        return other.take([index for index, name in enumerate(other.instrument_names) if name not in names])
+
+    def take(self, indices):
+        indices = list(indices)
+        return OptionChain([self.instrument_names[index] for index in indices],
+                           {field: self.columns[field][indices] for field in NUMERIC_FIELDS})
+
+    def __len__(self):
+        return len(self.instrument_names)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return OptionRow(self, index)
+
+    def __iter__(self):
+        return (OptionRow(self, index) for index in range(len(self)))
+
+    def __eq__(self, other):
+        return isinstance(other, OptionChain) and self.instrument_names == other.instrument_names and \
+            all(np.array_equal(self.columns[field], other.columns[field], equal_nan=True) for field in NUMERIC_FIELDS)
+
+    def __add__(self, other):
+        return OptionChain(self.instrument_names + other.instrument_names,
+                           {field: np.concatenate([self.columns[field], other.columns[field]]) for field in NUMERIC_FIELDS})
+
+
+class ChainAttribute:
+    # lets StartingPrices take plain lists of ticker dicts and keep them as an OptionChain
+    def __set_name__(self, owner, name):
+        self.attribute = '_' + name
+
+    def __get__(self, instance, owner):
+        return self if instance is None else getattr(instance, self.attribute)
+
+    def __set__(self, instance, value):
+        setattr(instance, self.attribute, value if isinstance(value, OptionChain) else OptionChain.from_records(value))
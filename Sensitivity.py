@@ -0,0 +1,63 @@
+import numpy as np
+from scipy.special import ndtr
+
+from ETHQuantoFutures.Valuation import DAYS_PER_YEAR
+
+GREEKS = ('eth_delta', 'btc_delta', 'eth_gamma', 'btc_gamma', 'cross_gamma', 'vega', 'theta')
+
+
+def black76_greeks(forward, strike, years, vol, is_call):
+    # per unit: delta and gamma to the forward, vega per vol point (0.01) and theta per day, all undiscounted like
+    # black76. At and after expiry delta is the payoff slope and the rest is 0
+    forward, strike, years, vol = np.broadcast_arrays(*(np.asarray(value, dtype=float)
+                                                        for value in (forward, strike, years, vol)))
+    std_dev = vol * np.sqrt(np.maximum(years, 0))
+    live = (std_dev > 0) & (forward > 0) & (strike > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = (np.log(forward / strike) + 0.5 * std_dev ** 2) / std_dev
+        density = np.exp(-0.5 * d1 ** 2) / np.sqrt(2 * np.pi)
+        delta = np.where(is_call, ndtr(d1), ndtr(d1) - 1)
+        gamma = density / (forward * std_dev)
+        vega = forward * density * np.sqrt(np.maximum(years, 0)) / 100
+        theta = -forward * density * vol / (2 * np.sqrt(np.maximum(years, 0))) / DAYS_PER_YEAR
+    expired_delta = np.where(is_call, (forward > strike).astype(float), -(forward < strike).astype(float))
+    return np.where(live, delta, expired_delta), np.where(live, gamma, 0), np.where(live, vega, 0), \
+        np.where(live, theta, 0)
+
+
+def position_greeks(mark_to_market, day):
+    # greeks of the whole position over the grid of a MarkToMarket tensor, as a dict of GREEKS -> (ETH x BTC)
+    # arrays: deltas in USD per USD move, gammas per USD move squared, vega in USD per vol point summed over
+    # both underlyings, theta in USD per day (option decay plus the futures premium drift of the tensor).
+    # Spot and futures are linear in ETH, the quanto futures PnL is ETH x BTC, which gives it a BTC delta and
+    # the only cross gamma
+    eth_prices = mark_to_market.eth_prices[:, None]
+    btc_prices = mark_to_market.btc_prices[None, :]
+    spot_amount, _ = mark_to_market.fixed_layers[0]
+    contracts, futures_start_price, multiplier = mark_to_market.fixed_layers[1]
+    futures_factor = -contracts * (1 + mark_to_market.premium_at(day)) * multiplier
+    shape = np.broadcast(eth_prices, btc_prices).shape
+
+    greeks = {
+        'eth_delta': spot_amount + futures_factor * btc_prices + np.zeros(shape),
+        'btc_delta': futures_factor * eth_prices + contracts * futures_start_price * multiplier + np.zeros(shape),
+        'eth_gamma': np.zeros(shape),
+        'btc_gamma': np.zeros(shape),
+        'cross_gamma': np.full(shape, futures_factor),
+        'vega': np.zeros(shape),
+        'theta': -contracts * multiplier * mark_to_market.premium_slope(day) * eth_prices * btc_prices + np.zeros(shape),
+    }
+    legs = mark_to_market.legs
+    if len(legs):
+        is_eth = legs.underlying == 'eth'
+        forwards = np.where(is_eth, eth_prices[..., None], btc_prices[..., None])
+        delta, gamma, vega, theta = black76_greeks(forwards, legs.strike, (mark_to_market.expiry_days - day) / DAYS_PER_YEAR,
+                                                   mark_to_market.vols, legs.is_call)
+        amount = legs.amount
+        greeks['eth_delta'] += (amount * is_eth * delta).sum(axis=-1)
+        greeks['btc_delta'] += (amount * ~is_eth * delta).sum(axis=-1)
+        greeks['eth_gamma'] += (amount * is_eth * gamma).sum(axis=-1)
+        greeks['btc_gamma'] += (amount * ~is_eth * gamma).sum(axis=-1)
+        greeks['vega'] += (amount * vega).sum(axis=-1)
+        greeks['theta'] += (amount * theta).sum(axis=-1)
+    return greeks
@@ -0,0 +1,139 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ETHQuantoFutures.TradingUtil import TradeSetup
+
+SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class Session:
+    def __init__(self, trade_setup=None, n_clicks_optimize=0, optimization_job_id=None, stream_version=None,
+                 figure_fingerprint=None, live=False):
+        self.trade_setup = trade_setup or TradeSetup()
+        self.n_clicks_optimize = n_clicks_optimize
+        self.optimization_job_id = optimization_job_id
+        self.stream_version = stream_version
+        self.figure_fingerprint = figure_fingerprint
+        self.live = live
+
+    def to_bytes(self):
+        return zlib.compress(json.dumps({'trade_setup': self.trade_setup.to_state(),
+                                         'n_clicks_optimize': self.n_clicks_optimize,
+                                         'optimization_job_id': self.optimization_job_id,
+                                         'stream_version': self.stream_version,
+                                         'figure_fingerprint': self.figure_fingerprint,
+                                         'live': self.live},
+                                        separators=(',', ':')).encode())
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(zlib.decompress(data))
+        return cls(TradeSetup.from_state(state['trade_setup']), state['n_clicks_optimize'],
+                   state['optimization_job_id'], state['stream_version'], state.get('figure_fingerprint'),
+                   state.get('live', False))
+
+
+class SessionStore:
+    # sessions are kept serialized, in memory for a single process or in a shared directory (QUANTO_SESSION_DIR)
+    # when several worker processes serve the same users
+    def __init__(self, directory=None, max_sessions=1000):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.locks = {}
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id, extension='session'):
+        if not SESSION_ID_PATTERN.match(session_id or ''):
+            raise ValueError(f"invalid session id: {session_id!r}")
+        return os.path.join(self.directory, f"{session_id}.{extension}")
+
+    def _write(self, path, data):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def load(self, session_id):
+        if self.directory:
+            try:
+                with open(self._path(session_id), 'rb') as f:
+                    return Session.from_bytes(f.read())
+            except FileNotFoundError:
+                return Session()
+        with self.lock:
+            data = self.sessions.get(session_id)
+            if data is not None:
+                self.sessions.move_to_end(session_id)
+        return Session() if data is None else Session.from_bytes(data)
+
+    def save(self, session_id, session):
+        data = session.to_bytes()
+        if self.directory:
+            self._write(self._path(session_id), data)
+            return
+        with self.lock:
+            self.sessions[session_id] = data
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.locks.pop(self.sessions.popitem(last=False)[0], None)
+
+    @contextmanager
+    def _locked(self, session_id):
+        with self.lock:
+            lock = self.locks.setdefault(session_id, threading.Lock())
+        with lock:
+            if not self.directory:
+                yield
+                return
+            with open(self._path(session_id) + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def edit(self, session_id):
+        # read-modify-write under a per-session lock, so callbacks of one session never interleave their updates
+        with self._locked(session_id):
+            session = self.load(session_id)
+            yield session
+            self.save(session_id, session)
+
+    # optimization jobs, published by the process that runs them (Jobs.JobManager) for every other process; only
+    # for a store with a directory, in a single process the JobManager has the jobs itself
+    def save_job(self, job_id, record):
+        self._write(self._path(job_id, 'job'), json.dumps(record, separators=(',', ':'), default=float).encode())
+
+    def load_job(self, job_id):
+        try:
+            with open(self._path(job_id, 'job'), 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def cancel_job(self, job_id):
+        open(self._path(job_id, 'cancel'), 'w').close()
+
+    def job_cancel_requested(self, job_id):
+        return os.path.exists(self._path(job_id, 'cancel'))
+
+    def delete_job(self, job_id):
+        for extension in ('job', 'cancel'):
+            try:
+                os.remove(self._path(job_id, extension))
+            except FileNotFoundError:
+                pass
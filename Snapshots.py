@@ -0,0 +1,96 @@
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+
+from ETHQuantoFutures.OptionChain import OptionChain
+
+PRICE_FIELDS = ('btc_start_price', 'eth_spot_start_price', 'eth_quanto_futures_start_price')
+CHAIN_FIELDS = ('btc_call_options', 'btc_put_options', 'eth_call_options', 'eth_put_options')
+OPTION_FIELDS = ('instrument_name', 'strike', 'underlying_price', 'best_ask_price', 'best_bid_price', 'mark_price', 'mark_iv')
+
+
+class MarketSnapshot:
+    def __init__(self, timestamp, prices, chains):
+        self.timestamp = timestamp
+        self.prices = prices
+        # chains are stored column-wise and only with the fields we use, the full Deribit tickers are mostly greeks
+        self.chains = chains
+
+    @classmethod
+    def from_starting_prices(cls, starting_prices, timestamp=None):
+        prices = {field: getattr(starting_prices, field) for field in PRICE_FIELDS}
+        chains = {field: {column: getattr(starting_prices, field).column(column) for column in OPTION_FIELDS}
+                  for field in CHAIN_FIELDS}
+        if timestamp is None:
+            timestamp = starting_prices.quoted_at or time.time()
+        return cls(timestamp, prices, chains)
+
+    def apply(self, starting_prices):
+        starting_prices.quoted_at = self.timestamp
+        for field, value in self.prices.items():
+            setattr(starting_prices, field, value)
+        for field, columns in self.chains.items():
+            setattr(starting_prices, field, OptionChain(columns['instrument_name'], columns))
+
+    @property
+    def age(self):
+        return time.time() - self.timestamp
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp, 'prices': self.prices, 'chains': self.chains}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['timestamp'], data['prices'], data['chains'])
+
+    def save(self, path):
+        data = json.dumps(self.to_dict(), separators=(',', ':')).encode()
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rb') as f:
+            return cls.from_dict(json.loads(f.read()))
+
+
+class SnapshotCache:
+    def __init__(self, ttl=30, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def get(self, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            if self.latest is not None and self.latest.age <= max_age:
+                return self.latest
+        return None
+
+    def put(self, snapshot):
+        with self.lock:
+            self.latest = snapshot
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            snapshot.save(os.path.join(self.directory, f"snapshot-{snapshot.timestamp:.3f}.json.gz"))
+
+    def saved_snapshots(self):
+        if not self.directory:
+            return []
+        return sorted(glob.glob(os.path.join(self.directory, "snapshot-*.json.gz")))
+
+
+def load_replay_snapshot(path):
+    # a directory replays its most recent snapshot
+    if os.path.isdir(path):
+        saved = SnapshotCache(directory=path).saved_snapshots()
+        if not saved:
+            raise FileNotFoundError(f"no snapshot-*.json.gz to replay in {path}")
+        path = saved[-1]
+    return MarketSnapshot.load(path)
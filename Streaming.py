@@ -0,0 +1,160 @@
+import asyncio
+import json
+import random
+import threading
+
+import websockets
+
+
+class PriceStream:
+    BITMEX_WS_URL = "wss://www.bitmex.com/realtime"
+    BINANCE_WS_URL = "wss://stream.binance.com:9443/ws"
+    DERIBIT_WS_URL = "wss://www.deribit.com/ws/api/v2"
+
+    BITMEX_SYMBOLS = {'XBTUSD': 'btc_start_price', 'ETHUSDM21': 'eth_quanto_futures_start_price'}
+    CHAINS = ('btc_call_options', 'btc_put_options', 'eth_call_options', 'eth_put_options')
+
+    def __init__(self, starting_prices, bitmex_url=None, binance_url=None, deribit_url=None, reconnect_delay=1):
+        # updates StartingPrices in place from the exchange websockets and records which fields changed,
+        # so the dashboard can poll for changes and only recompute what they touch
+        self.starting_prices = starting_prices
+        self.bitmex_url = bitmex_url or self.BITMEX_WS_URL
+        self.binance_url = binance_url or self.BINANCE_WS_URL
+        self.deribit_url = deribit_url or self.DERIBIT_WS_URL
+        self.reconnect_delay = reconnect_delay
+        self.lock = threading.Lock()
+        self.version = 0
+        self.changed = set()
+        self.loop = None
+        self.thread = None
+        self.task = None
+        self.options_by_name = {}
+
+    def start(self):
+        self.options_by_name = {option['instrument_name']: (chain, option) for chain in self.CHAINS
+                                for option in getattr(self.starting_prices, chain) if option.get('instrument_name')}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._run(),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            self.thread.join(timeout=5)
+            self.task = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def take_changes(self):
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            return self.version, changed
+
+    def _update(self, field, value):
+        with self.lock:
+            if getattr(self.starting_prices, field) != value:
+                setattr(self.starting_prices, field, value)
+                self.changed.add(field)
+                self.version += 1
+
+    def _update_option(self, ticker):
+        chain, option = self.options_by_name.get(ticker.get('instrument_name'), (None, None))
+        if option is None:
+            return
+        with self.lock:
+            changed = False
+            for field in ('underlying_price', 'best_ask_price', 'best_bid_price', 'mark_price', 'mark_iv'):
+                if field in ticker and option.get(field) != ticker[field]:
+                    option[field] = ticker[field]
+                    changed = True
+            # a ticker repeating the last quote must not make the dashboard redraw
+            if changed:
+                self.changed.add(chain)
+                self.version += 1
+
+    async def _run(self):
+        self.task = asyncio.current_task()
+        try:
+            await asyncio.gather(self._keep_alive(self._bitmex), self._keep_alive(self._binance),
+                                 self._keep_alive(self._deribit))
+        except asyncio.CancelledError:
+            pass
+
+    async def _keep_alive(self, consumer):
+        while True:
+            try:
+                await consumer()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"stream {consumer.__name__} dropped: {e}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _bitmex(self):
+        async with websockets.connect(self.bitmex_url) as ws:
+            await ws.send(json.dumps({'op': 'subscribe', 'args': [f"quote:{symbol}" for symbol in self.BITMEX_SYMBOLS]}))
+            async for message in ws:
+                message = json.loads(message)
+                if message.get('table') == 'quote':
+                    for quote in message['data']:
+                        if quote.get('symbol') in self.BITMEX_SYMBOLS and quote.get('bidPrice'):
+                            self._update(self.BITMEX_SYMBOLS[quote['symbol']], round(quote['bidPrice'], 2))
+
+    async def _binance(self):
+        async with websockets.connect(self.binance_url) as ws:
+            await ws.send(json.dumps({'method': 'SUBSCRIBE', 'params': ['ethusdt@miniTicker'], 'id': 1}))
+            async for message in ws:
+                message = json.loads(message)
+                if message.get('s') == 'ETHUSDT':
+                    self._update('eth_spot_start_price', round(float(message['c']), 2))
+
+    async def _deribit(self):
+        if not self.options_by_name:
+            return await asyncio.Event().wait()
+        async with websockets.connect(self.deribit_url) as ws:
+            await ws.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'public/subscribe',
+                                      'params': {'channels': [f"ticker.{name}.100ms" for name in self.options_by_name]}}))
+            async for message in ws:
+                message = json.loads(message)
+                if message.get('method') == 'subscription':
+                    self._update_option(message['params']['data'])
+
+
+async def _stand_in_handler(ws, starting_prices, interval):
+    # speaks just enough of the three exchange protocols to drive a PriceStream with a random walk
+    request = json.loads(await ws.recv())
+    rnd = random.Random()
+    while True:
+        await asyncio.sleep(interval)
+        if request.get('op') == 'subscribe':
+            data = [{'symbol': 'XBTUSD', 'bidPrice': starting_prices.btc_start_price * rnd.uniform(0.999, 1.001)},
+                    {'symbol': 'ETHUSDM21', 'bidPrice': starting_prices.eth_quanto_futures_start_price * rnd.uniform(0.999, 1.001)}]
+            await ws.send(json.dumps({'table': 'quote', 'action': 'insert', 'data': data}))
+        elif request.get('method') == 'SUBSCRIBE':
+            await ws.send(json.dumps({'e': '24hrMiniTicker', 's': 'ETHUSDT',
+                                      'c': str(starting_prices.eth_spot_start_price * rnd.uniform(0.999, 1.001))}))
+        elif request.get('method') == 'public/subscribe':
+            for channel in request['params']['channels']:
+                instrument_name = channel.split('.')[1]
+                await ws.send(json.dumps({'jsonrpc': '2.0', 'method': 'subscription', 'params': {
+                    'channel': channel,
+                    'data': {'instrument_name': instrument_name, 'best_ask_price': round(rnd.uniform(0.001, 0.05), 4)}}}))
+
+
+def serve_stand_in(starting_prices, host="127.0.0.1", port=0, interval=0.5):
+    # runs a local websocket stand-in for BitMEX, Binance and Deribit in a background thread, returns its url
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    server_url = []
+
+    async def serve():
+        server = await websockets.serve(lambda ws: _stand_in_handler(ws, starting_prices, interval), host, port)
+        server_url.append(f"ws://{host}:{server.sockets[0].getsockname()[1]}")
+        ready.set()
+        await server.wait_closed()
+
+    threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+    ready.wait()
+    return server_url[0]
@@ -1,58 +1,132 @@
-import requests
+import functools
+import hashlib
+import heapq
+import operator
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.sparse
+from scipy.optimize import linprog
 import dash_html_components as html
 
+from ETHQuantoFutures.Legs import LegTable
+from ETHQuantoFutures.MarketData import default_client, ticker_from_book_summary
+from ETHQuantoFutures.Metrics import metrics
+from ETHQuantoFutures.OptionChain import ChainAttribute
+from ETHQuantoFutures.Snapshots import MarketSnapshot, SnapshotCache, load_replay_snapshot
+
+LEG_CHAINS = {'btc_calls': 'btc_call_options', 'btc_puts': 'btc_put_options',
+              'eth_calls': 'eth_call_options', 'eth_puts': 'eth_put_options'}
+
+
+class InfeasibleTarget(ValueError):
+    pass
+
 
 class StartingPrices:
     quanto_multiplier = 0.000001
+    # repeated queries within the TTL are served from memory, QUANTO_SNAPSHOT_DIR also keeps every snapshot on disk,
+    # and QUANTO_REPLAY_SNAPSHOT (a snapshot file or directory) replaces the exchanges entirely
+    snapshot_cache = SnapshotCache(ttl=float(os.environ.get("QUANTO_SNAPSHOT_TTL", 30)),
+                                   directory=os.environ.get("QUANTO_SNAPSHOT_DIR"))
+    replay_snapshot = os.environ.get("QUANTO_REPLAY_SNAPSHOT")
+    # Deribit expiry codes (or parts of them, like the month) whose options are kept, e.g. "JUN" or "25JUN21,24SEP21"
+    expiries = os.environ.get("QUANTO_EXPIRIES", "JUN").split(",")
+    btc_call_options = ChainAttribute()
+    btc_put_options = ChainAttribute()
+    eth_call_options = ChainAttribute()
+    eth_put_options = ChainAttribute()
 
     def __init__(self):
         self.btc_start_price = 50000
         self.eth_spot_start_price = 1600
         self.eth_quanto_futures_start_price = 2200
+        self.quoted_at = None
         self.btc_call_options = []
         self.btc_put_options = []
         self.eth_call_options = []
         self.eth_put_options = []
 
-    def query(self):
-        bitmex_xbtusd = requests.get("https://www.bitmex.com/api/v1/quote?symbol=XBTUSD&count=1&reverse=true").json()[0]
-        self.btc_start_price = round(bitmex_xbtusd['bidPrice'], 2)
+    @metrics.timed("query")
+    def query(self, market_data=None, bulk=True, max_age=None):
+        if self.replay_snapshot:
+            metrics.count("query.replays")
+            load_replay_snapshot(self.replay_snapshot).apply(self)
+            return
+        snapshot = self.snapshot_cache.get(max_age)
+        if snapshot is None:
+            self.query_exchanges(market_data, bulk)
+            snapshot = MarketSnapshot.from_starting_prices(self)
+            self.snapshot_cache.put(snapshot)
+        else:
+            metrics.count("query.cache_hits")
+        # fresh and cached queries leave the same trimmed option records behind
+        snapshot.apply(self)
 
-        bitmex_ethusdm21 = requests.get("https://www.bitmex.com/api/v1/quote?symbol=ETHUSDM21&count=1&reverse=true").json()[0]
-        self.eth_quanto_futures_start_price = round(bitmex_ethusdm21['bidPrice'], 2)
+    @metrics.timed("query.exchanges")
+    def query_exchanges(self, market_data=None, bulk=True):
+        # every independent request goes out concurrently over one pooled session; with bulk=True the option quotes
+        # come from one book summary per currency instead of one ticker call per instrument
+        market_data = market_data or default_client()
+        self.quoted_at = time.time()
+        calls = [market_data.bitmex_quote("XBTUSD"),
+                 market_data.bitmex_quote("ETHUSDM21"),
+                 market_data.binance_ticker_price("ETHUSDT"),
+                 market_data.deribit_instruments("BTC"),
+                 market_data.deribit_instruments("ETH")]
+        if bulk:
+            calls += [market_data.deribit_book_summary("BTC"),
+                      market_data.deribit_book_summary("ETH")]
+        responses = market_data.get_many(calls)
+        bitmex_xbtusd, bitmex_ethusdm21, binance_ethusd, btc_options, eth_options = responses[:5]
 
-        binance_ethusd = requests.get("https://api.binance.com/api/v3/ticker/price?symbol=ETHUSDT").json()
+        self.btc_start_price = round(bitmex_xbtusd[0]['bidPrice'], 2)
+        self.eth_quanto_futures_start_price = round(bitmex_ethusdm21[0]['bidPrice'], 2)
         self.eth_spot_start_price = round(float(binance_ethusd['price']), 2)
 
-        btc_options = requests.get("https://www.deribit.com/api/v2/public/get_instruments?currency=BTC&kind=option&expired=false").json()['result']
-        btc_options = [option for option in btc_options if "JUN" in option['instrument_name']]
-        self.btc_call_options = []
-        self.btc_put_options = []
-        for option in btc_options:
-            option_name = option['instrument_name']
-            if option_name[-1] == 'C' and self.btc_start_price + 15000 < option['strike'] < 130000:
-                option_ticker = requests.get(f"https://www.deribit.com/api/v2/public/ticker?instrument_name={option_name}").json()['result']
-                option_ticker['strike'] = option['strike']
-                self.btc_call_options.append(option_ticker)
-            elif option_name[-1] == 'P' and 18000 < option['strike'] < self.btc_start_price:
-                option_ticker = requests.get(f"https://www.deribit.com/api/v2/public/ticker?instrument_name={option_name}").json()['result']
-                option_ticker['strike'] = option['strike']
-                self.btc_put_options.append(option_ticker)
-
-        eth_options = requests.get("https://www.deribit.com/api/v2/public/get_instruments?currency=ETH&kind=option&expired=false").json()['result']
-        eth_options = [option for option in eth_options if "JUN" in option['instrument_name']]
-        self.eth_call_options = []
-        self.eth_put_options = []
-        for option in eth_options:
-            option_name = option['instrument_name']
-            if option_name[-1] == 'C' and self.eth_spot_start_price + 400 < option['strike'] < 4900:
-                option_ticker = requests.get(f"https://www.deribit.com/api/v2/public/ticker?instrument_name={option_name}").json()['result']
-                option_ticker['strike'] = option['strike']
-                self.eth_call_options.append(option_ticker)
-            elif option_name[-1] == 'P' and 570 < option['strike'] < self.eth_spot_start_price:
-                option_ticker = requests.get(f"https://www.deribit.com/api/v2/public/ticker?instrument_name={option_name}").json()['result']
-                option_ticker['strike'] = option['strike']
-                self.eth_put_options.append(option_ticker)
+        btc_options = [option for option in btc_options['result'] if self.wanted_expiry(option['instrument_name'])]
+        eth_options = [option for option in eth_options['result'] if self.wanted_expiry(option['instrument_name'])]
+        if bulk:
+            summaries = {summary['instrument_name']: summary for response in responses[5:] for summary in response['result']}
+            btc_options = [option for option in btc_options if option['instrument_name'] in summaries]
+            eth_options = [option for option in eth_options if option['instrument_name'] in summaries]
+        chains = self.select_chains(btc_options, eth_options)
+
+        options = [option for chain in chains for option in chain]
+        if bulk:
+            option_tickers = [ticker_from_book_summary(summaries[option['instrument_name']]) for option in options]
+        else:
+            option_tickers = [response['result'] for response in
+                              market_data.get_many([market_data.deribit_ticker(option['instrument_name']) for option in options])]
+        for option, option_ticker in zip(options, option_tickers):
+            option_ticker['strike'] = option['strike']
+
+        chain_ends = np.cumsum([len(chain) for chain in chains])
+        self.btc_call_options = option_tickers[:chain_ends[0]]
+        self.btc_put_options = option_tickers[chain_ends[0]:chain_ends[1]]
+        self.eth_call_options = option_tickers[chain_ends[1]:chain_ends[2]]
+        self.eth_put_options = option_tickers[chain_ends[2]:chain_ends[3]]
+
+    def select_chains(self, btc_options, eth_options):
+        # the options of every chain whose strikes are worth hedging with at the starting prices, as
+        # [btc calls, btc puts, eth calls, eth puts]; options are dicts with at least instrument_name and strike
+        return [
+            [option for option in btc_options
+             if option['instrument_name'][-1] == 'C' and self.btc_start_price + 15000 < option['strike'] < 130000],
+            [option for option in btc_options
+             if option['instrument_name'][-1] == 'P' and 18000 < option['strike'] < self.btc_start_price],
+            [option for option in eth_options
+             if option['instrument_name'][-1] == 'C' and self.eth_spot_start_price + 400 < option['strike'] < 4900],
+            [option for option in eth_options
+             if option['instrument_name'][-1] == 'P' and 570 < option['strike'] < self.eth_spot_start_price],
+        ]
+
+    def wanted_expiry(self, instrument_name):
+        return any(expiry in instrument_name.split('-')[1] for expiry in self.expiries)
 
     @property
     def starting_premium(self):
@@ -87,18 +161,25 @@ class Portfolio:
         self.eth_calls_amount = 0
         self.eth_calls_premium = 0
         self.eth_calls_strike = 1000000
+        self.eth_calls_expiry = None
 
         self.btc_calls_amount = 0
         self.btc_calls_premium = 0
         self.btc_calls_strike = 1000000
+        self.btc_calls_expiry = None
 
         self.eth_puts_amount = 0
         self.eth_puts_premium = 0
         self.eth_puts_strike = 0
+        self.eth_puts_expiry = None
 
         self.btc_puts_amount = 0
         self.btc_puts_premium = 0
         self.btc_puts_strike = 0
+        self.btc_puts_expiry = None
+
+        # option legs beyond the four above: spreads, second strikes, other expiries
+        self.legs = LegTable()
 
     @property
     def cost_of_calls(self):
@@ -124,6 +205,16 @@ class Portfolio:
     def cost_of_btc_puts(self):
         return self.btc_puts_amount * self.btc_puts_premium
 
+    @property
+    def leg_table(self):
+        # the four legs above and the extra legs as one table; legs of states saved without an expiry have None
+        fixed = LegTable(('btc', 'btc', 'eth', 'eth'), (True, False, True, False),
+                         (self.btc_calls_strike, self.btc_puts_strike, self.eth_calls_strike, self.eth_puts_strike),
+                         [getattr(self, f"{leg}_expiry", None) for leg in ('btc_calls', 'btc_puts', 'eth_calls', 'eth_puts')],
+                         (self.btc_calls_amount, self.btc_puts_amount, self.eth_calls_amount, self.eth_puts_amount),
+                         (self.btc_calls_premium, self.btc_puts_premium, self.eth_calls_premium, self.eth_puts_premium))
+        return LegTable.from_records(fixed.to_records() + self.legs.to_records())
+
     def set_eth_spot_amount(self, amount):
         self.eth_spot_amount = amount
 
@@ -137,22 +228,64 @@ class Portfolio:
 class OptimizationTarget:
     btc_prices_range = [35000 + 4000 * i for i in range(21)]
     eth_prices_range = [1400 + 200 * i for i in range(16)]
-    num_points_in_range = len(btc_prices_range) * len(eth_prices_range)
     cant_lose_prices = [
         {'eth': 600, 'btc': 26000},
         {'eth': 4800, 'btc': 165000},
         {'eth': 2500, 'btc': 11000},
     ]
 
+    def __init__(self, btc_prices_range=None, eth_prices_range=None, cant_lose_prices=None):
+        # the class attributes are the defaults the dashboard optimizes for
+        if btc_prices_range is not None:
+            self.btc_prices_range = list(btc_prices_range)
+        if eth_prices_range is not None:
+            self.eth_prices_range = list(eth_prices_range)
+        if cant_lose_prices is not None:
+            self.cant_lose_prices = [dict(eth=point['eth'], btc=point['btc']) for point in cant_lose_prices]
+
+    @property
+    def num_points_in_range(self):
+        return len(self.btc_prices_range) * len(self.eth_prices_range)
+
 
 class TradeSetup:
     USD_VALUE_ETH = 10000
+    OPTIMIZER_WORKERS = None    # None means one worker process per CPU core
 
     def __init__(self):
         self.starting_parameters = StartingPrices()
         self.exit_parameters = ExitPrices()
         self.portfolio = Portfolio()
         self.optimization_target = OptimizationTarget()
+        self.warm_start = WarmStart()
+
+    def to_state(self):
+        return {'portfolio': dict(vars(self.portfolio), legs=self.portfolio.legs.to_records()),
+                'premium_exit': self.exit_parameters.premium_exit,
+                'market': MarketSnapshot.from_starting_prices(self.starting_parameters).to_dict()}
+
+    @classmethod
+    def from_state(cls, state):
+        trade_setup = cls()
+        trade_setup.set_portfolio_state(state['portfolio'])
+        trade_setup.set_exit_premium(state['premium_exit'])
+        MarketSnapshot.from_dict(state['market']).apply(trade_setup.starting_parameters)
+        return trade_setup
+
+    def set_portfolio_state(self, portfolio_state):
+        # the 'portfolio' part of to_state()
+        self.portfolio = Portfolio()
+        vars(self.portfolio).update(portfolio_state)
+        self.portfolio.legs = LegTable.from_records(portfolio_state.get('legs', []))
+
+    @property
+    def fingerprint(self):
+        # identifies everything a PnL surface depends on, equal fingerprints mean identical plots
+        state = (sorted(vars(self.portfolio).items()), self.exit_parameters.premium_exit,
+                 self.starting_parameters.btc_start_price, self.starting_parameters.eth_spot_start_price,
+                 self.starting_parameters.eth_quanto_futures_start_price, self.starting_parameters.quanto_multiplier,
+                 self.optimization_target.btc_prices_range, self.optimization_target.eth_prices_range)
+        return hashlib.sha1(repr(state).encode()).hexdigest()
 
     def set_exit_prices(self, eth_exit_price, btc_exit_price):
         self.exit_parameters.eth_exit_price = eth_exit_price
@@ -161,33 +294,61 @@ class TradeSetup:
     def set_exit_premium(self, exit_premium):
         self.exit_parameters.premium_exit = exit_premium
 
-    def calc_range_min(self):
-        for critical_point in self.optimization_target.cant_lose_prices:
-            self.set_exit_prices(eth_exit_price=critical_point['eth'], btc_exit_price=critical_point['btc'])
-            if self.calculate_pnl() < 0:
-                return -1e9
-
-        min_pnl = 1e9
-        for btc_price in self.optimization_target.btc_prices_range:
-            for eth_price in self.optimization_target.eth_prices_range:
-                self.set_exit_prices(eth_exit_price=eth_price, btc_exit_price=btc_price)
-                pnl = self.calculate_pnl()
-                if pnl < min_pnl:
-                    min_pnl = pnl
-        return min_pnl
+    def calc_range_min(self, exact=False):
+        # exact=True takes the true minimum over the whole target rectangle instead of over its grid points
+        if not self.cant_lose_check():
+            return -1e9
+        if exact:
+            target = self.optimization_target
+            return self.calc_range_extremes((target.eth_prices_range[0], target.eth_prices_range[-1]),
+                                            (target.btc_prices_range[0], target.btc_prices_range[-1]))[0]
+        return float(self.calculate_pnl_grid(self.optimization_target.eth_prices_range,
+                                             np.array(self.optimization_target.btc_prices_range)[:, None]).min())
+
+    def calc_range_extremes(self, eth_range, btc_range):
+        # PnL = f(eth) + g(btc) + c * eth * btc + d * btc with f, g piecewise linear (kinks at the strikes), so it is
+        # bilinear on every cell between strike lines and its extremes over the rectangle lie on cell corners:
+        # evaluating the rectangle corners, edges and strike-line crossings is exact, not a sample.
+        # Returns (min_pnl, (eth, btc) of the min, max_pnl, (eth, btc) of the max)
+        eth_low, eth_high = eth_range
+        btc_low, btc_high = btc_range
+        leg_strikes = self.portfolio.legs.strikes_by_underlying
+        eth_prices = np.unique([eth_low, eth_high] + [strike for strike in [self.portfolio.eth_calls_strike,
+                                                                             self.portfolio.eth_puts_strike] +
+                                                      leg_strikes['eth'] if eth_low < strike < eth_high])
+        btc_prices = np.unique([btc_low, btc_high] + [strike for strike in [self.portfolio.btc_calls_strike,
+                                                                             self.portfolio.btc_puts_strike] +
+                                                      leg_strikes['btc'] if btc_low < strike < btc_high])
+        surface = self.pnl_surface(eth_prices, btc_prices)
+        min_pnl, min_index = surface.min()
+        max_pnl, max_index = surface.max()
+        return min_pnl, (float(eth_prices[min_index[0]]), float(btc_prices[min_index[1]])), \
+            max_pnl, (float(eth_prices[max_index[0]]), float(btc_prices[max_index[1]]))
 
     def calc_range_avg(self):
-        for critical_point in self.optimization_target.cant_lose_prices:
-            self.set_exit_prices(eth_exit_price=critical_point['eth'], btc_exit_price=critical_point['btc'])
-            if self.calculate_pnl() < 0:
-                return -1e9
-
-        pnl_sum = 0
-        for btc_price in self.optimization_target.btc_prices_range:
-            for eth_price in self.optimization_target.eth_prices_range:
-                self.set_exit_prices(eth_exit_price=eth_price, btc_exit_price=btc_price)
-                pnl_sum += self.calculate_pnl()
-        return pnl_sum / self.optimization_target.num_points_in_range
+        if not self.cant_lose_check():
+            return -1e9
+        return self.pnl_surface(self.optimization_target.eth_prices_range,
+                                self.optimization_target.btc_prices_range).mean()
+
+    def calc_range_scores(self, percentile=5):
+        # the FRONTIER_OBJECTIVES of the current portfolio from one evaluation of the cant_lose, grid and
+        # liquidation points; liquidation_pnl is the worst PnL at the liquidation price over the btc range
+        eth_points, btc_points, num_critical = self.optimization_points(include_liquidation=True)
+        pnl = self.calculate_pnl_grid(eth_points, btc_points)
+        grid = pnl[num_critical:num_critical + self.optimization_target.num_points_in_range]
+        liquidation = pnl[num_critical + self.optimization_target.num_points_in_range:]
+        return {'cant_lose': not (pnl[:num_critical] < 0).any(),
+                'min_pnl': float(grid.min()),
+                'mean_pnl': float(grid.mean()),
+                'percentile_pnl': float(np.percentile(grid, percentile)),
+                'premium_cost': self.portfolio.cost_of_calls + self.portfolio.cost_of_puts + self.portfolio.legs.cost,
+                'liquidation_pnl': float(liquidation.min()) if liquidation.size else np.inf}
+
+    def cant_lose_check(self):
+        eth_prices = [critical_point['eth'] for critical_point in self.optimization_target.cant_lose_prices]
+        btc_prices = [critical_point['btc'] for critical_point in self.optimization_target.cant_lose_prices]
+        return not (self.calculate_pnl_grid(eth_prices, btc_prices) < 0).any()
 
     def calculate_pnl(self):
         eth_spot_pnl_usd = self.portfolio.eth_spot_amount * \
@@ -213,9 +374,47 @@ class TradeSetup:
             options_profit += self.portfolio.btc_puts_amount * \
                             (self.portfolio.btc_puts_strike - self.exit_parameters.btc_exit_price)
 
+        if len(self.portfolio.legs):
+            options_profit += float(self.portfolio.legs.pnl(self.exit_parameters.eth_exit_price,
+                                                            self.exit_parameters.btc_exit_price))
+
         # we assume the btc holding on bitmex to be fully hedged at start, so that contributes 0
         return eth_spot_pnl_usd + eth_quanto_futres_pnl_usd + options_profit - self.portfolio.cost_of_calls - self.portfolio.cost_of_puts
 
+    def calculate_pnl_grid(self, eth_exit_prices, btc_exit_prices, premium_exit=None):
+        # same formula as calculate_pnl, but over whole arrays of exit prices at once (broadcast against each other).
+        # Not timed here: optimizer inner loops and Monte Carlo chunks call it too often for the metrics lock, the
+        # optimizers, build_plot and MonteCarlo.run are timed instead
+        eth_exit_prices = np.asarray(eth_exit_prices, dtype=float)
+        btc_exit_prices = np.asarray(btc_exit_prices, dtype=float)
+        if premium_exit is None:
+            premium_exit = self.exit_parameters.premium_exit
+        eth_futures_exit_prices = eth_exit_prices * (1 + np.asarray(premium_exit, dtype=float))
+
+        eth_spot_pnl_usd = self.portfolio.eth_spot_amount * \
+                           (eth_exit_prices - self.starting_parameters.eth_spot_start_price)
+
+        eth_quanto_futures_price_movement = eth_futures_exit_prices - self.starting_parameters.eth_quanto_futures_start_price
+        eth_quanto_futures_pnl_btc = self.portfolio.eth_quanto_futures_contracts_shorted * \
+                                     (eth_quanto_futures_price_movement * -1 * self.starting_parameters.quanto_multiplier)
+        eth_quanto_futres_pnl_usd = eth_quanto_futures_pnl_btc * btc_exit_prices
+
+        options_profit = np.where(eth_exit_prices > self.portfolio.eth_calls_strike,
+                                  self.portfolio.eth_calls_amount * (eth_exit_prices - self.portfolio.eth_calls_strike), 0)
+        options_profit = options_profit + \
+            np.where(btc_exit_prices > self.portfolio.btc_calls_strike,
+                     self.portfolio.btc_calls_amount * (btc_exit_prices - self.portfolio.btc_calls_strike), 0)
+        options_profit = options_profit + \
+            np.where(eth_exit_prices < self.portfolio.eth_puts_strike,
+                     self.portfolio.eth_puts_amount * (self.portfolio.eth_puts_strike - eth_exit_prices), 0)
+        options_profit = options_profit + \
+            np.where(btc_exit_prices < self.portfolio.btc_puts_strike,
+                     self.portfolio.btc_puts_amount * (self.portfolio.btc_puts_strike - btc_exit_prices), 0)
+        if len(self.portfolio.legs):
+            options_profit = options_profit + self.portfolio.legs.pnl(eth_exit_prices, btc_exit_prices)
+
+        return eth_spot_pnl_usd + eth_quanto_futres_pnl_usd + options_profit - self.portfolio.cost_of_calls - self.portfolio.cost_of_puts
+
     def calculate_bitmex_eth_liq_price(self, for_btc_price):
         # lost_BTC = contracts * price_move * multiplier
         # bitmex_BTC = contracts * (liq - entry) * multiplier
@@ -227,6 +426,110 @@ class TradeSetup:
         except ZeroDivisionError:
             return 1000000
 
+    def calculate_bitmex_eth_liq_prices(self, for_btc_prices):
+        # calculate_bitmex_eth_liq_price over an array, with the same 1000000 for the zero-division cases
+        for_btc_prices = np.asarray(for_btc_prices, dtype=float)
+        contracts = self.portfolio.eth_quanto_futures_contracts_shorted
+        if contracts == 0:
+            return np.full(for_btc_prices.shape, 1000000.0)
+        with np.errstate(divide='ignore'):
+            btc_available = self.portfolio.btc_amount_bitmex * self.starting_parameters.btc_start_price / for_btc_prices
+        return np.where(for_btc_prices == 0, 1000000,
+                        self.starting_parameters.eth_quanto_futures_start_price +
+                        (btc_available / self.starting_parameters.quanto_multiplier / contracts))
+
+    def pnl_layers(self):
+        # the additive parts of calculate_pnl, each as (function giving its SeparableSurface over a grid, the inputs
+        # it depends on)
+        return {
+            'eth_spot': (eth_spot_components, (self.portfolio.eth_spot_amount, self.starting_parameters.eth_spot_start_price)),
+            'eth_quanto_futures': (eth_quanto_futures_components, (self.portfolio.eth_quanto_futures_contracts_shorted,
+                                                                   self.starting_parameters.eth_quanto_futures_start_price,
+                                                                   self.starting_parameters.quanto_multiplier,
+                                                                   self.exit_parameters.premium_exit)),
+            'eth_calls': (option_components, ('eth', True, self.portfolio.eth_calls_amount,
+                                              self.portfolio.eth_calls_strike, self.portfolio.eth_calls_premium)),
+            'btc_calls': (option_components, ('btc', True, self.portfolio.btc_calls_amount,
+                                              self.portfolio.btc_calls_strike, self.portfolio.btc_calls_premium)),
+            'eth_puts': (option_components, ('eth', False, self.portfolio.eth_puts_amount,
+                                             self.portfolio.eth_puts_strike, self.portfolio.eth_puts_premium)),
+            'btc_puts': (option_components, ('btc', False, self.portfolio.btc_puts_amount,
+                                             self.portfolio.btc_puts_strike, self.portfolio.btc_puts_premium)),
+            'legs': (legs_components, (self.portfolio.legs,)),
+        }
+
+    def pnl_surface(self, eth_prices, btc_prices, premium_exit=None):
+        # calculate_pnl over the grid eth_prices x btc_prices as a SeparableSurface, without the dense table; the
+        # sum of pnl_layers in one pass, it is on the hot path of calc_range_min
+        eth_prices = np.asarray(eth_prices, dtype=float)
+        btc_prices = np.asarray(btc_prices, dtype=float)
+        if premium_exit is None:
+            premium_exit = self.exit_parameters.premium_exit
+        portfolio = self.portfolio
+        eth_terms = eth_spot_layer(eth_prices, None, portfolio.eth_spot_amount, self.starting_parameters.eth_spot_start_price) + \
+            option_layer(eth_prices, None, 'eth', True, portfolio.eth_calls_amount, portfolio.eth_calls_strike,
+                         portfolio.eth_calls_premium) + \
+            option_layer(eth_prices, None, 'eth', False, portfolio.eth_puts_amount, portfolio.eth_puts_strike,
+                         portfolio.eth_puts_premium)
+        btc_terms = option_layer(None, btc_prices, 'btc', True, portfolio.btc_calls_amount, portfolio.btc_calls_strike,
+                                 portfolio.btc_calls_premium) + \
+            option_layer(None, btc_prices, 'btc', False, portfolio.btc_puts_amount, portfolio.btc_puts_strike,
+                         portfolio.btc_puts_premium)
+        quanto = eth_quanto_futures_layer(eth_prices, 1, portfolio.eth_quanto_futures_contracts_shorted,
+                                          self.starting_parameters.eth_quanto_futures_start_price,
+                                          self.starting_parameters.quanto_multiplier, premium_exit)
+        surface = SeparableSurface(eth_prices, btc_prices, eth_terms, btc_terms, quanto)
+        if len(portfolio.legs):
+            surface = surface + legs_components(eth_prices, btc_prices, portfolio.legs)
+        return surface
+
+    def liq_curve_key(self):
+        return (self.portfolio.btc_amount_bitmex, self.starting_parameters.btc_start_price,
+                self.starting_parameters.eth_quanto_futures_start_price, self.portfolio.eth_quanto_futures_contracts_shorted)
+
+    def refresh_premiums(self):
+        # re-read the premiums of the selected strikes, after the option chains were updated in place
+        for leg in LEG_CHAINS:
+            self.select_strike(leg, getattr(self.portfolio, f"{leg}_strike"), getattr(self.portfolio, f"{leg}_expiry", None))
+
+    def select_strike(self, leg, strike, expiry=None):
+        # leg is one of LEG_CHAINS; takes strike, expiry and premium from the chain (the first expiry of the strike
+        # when none is given), unknown strikes are ignored
+        options = getattr(self.starting_parameters, LEG_CHAINS[leg])
+        index = options.find(strike, expiry)
+        if index is not None:
+            self.select_row(leg, index)
+
+    def select_option(self, leg, instrument_name):
+        # select_strike by Deribit instrument name, unknown names are ignored
+        options = getattr(self.starting_parameters, LEG_CHAINS[leg])
+        if instrument_name in options.instrument_names:
+            self.select_row(leg, options.instrument_names.index(instrument_name))
+
+    def select_row(self, leg, index):
+        options = getattr(self.starting_parameters, LEG_CHAINS[leg])
+        setattr(self.portfolio, f"{leg}_strike", options[index]['strike'])
+        setattr(self.portfolio, f"{leg}_premium", options[index]['premium'])
+        setattr(self.portfolio, f"{leg}_expiry", options.expiries[index])
+
+    def option_expiry(self, leg, strike, premium):
+        # expiry of the chain row an optimizer picked, recognized by its strike and premium
+        options = getattr(self.starting_parameters, LEG_CHAINS[leg])
+        rows = np.flatnonzero((options.strikes == strike) & (options.premiums == premium))
+        if not len(rows):
+            index = options.find(strike)
+            return options.expiries[index] if index is not None else None
+        return options.expiries[rows[0]]
+
+    def leg_instrument_names(self):
+        # the Deribit instrument of every row of portfolio.leg_table, None where the chains do not quote the strike
+        names = []
+        for underlying, is_call, strike, expiry, _, _ in self.portfolio.leg_table.rows():
+            options = getattr(self.starting_parameters, f"{underlying}_{'call' if is_call else 'put'}_options")
+            index = options.find(strike, expiry)
+            names.append(options.instrument_names[index] if index is not None else None)
+        return names
+
     @property
     def eth_spot_value(self):
         return round(self.portfolio.eth_spot_amount * self.starting_parameters.eth_spot_start_price, 2)
@@ -258,22 +561,57 @@ class TradeSetup:
         self.portfolio.set_eth_contracts_to_short(CONTRACTS_ETH)
         self.portfolio.set_eth_spot_amount(SPOT_ETH)
 
-        btc_call = self.starting_parameters.btc_call_options[0]
-        btc_put = self.starting_parameters.btc_put_options[0]
-        eth_call = self.starting_parameters.eth_call_options[0]
-        eth_put = self.starting_parameters.eth_put_options[0]
-        self.portfolio.btc_calls_strike = btc_call['strike']
-        self.portfolio.btc_calls_premium = btc_call['underlying_price'] * btc_call['best_ask_price']
-        self.portfolio.btc_puts_strike = btc_put['strike']
-        self.portfolio.btc_puts_premium = btc_put['underlying_price'] * btc_put['best_ask_price']
-        self.portfolio.eth_calls_strike = eth_call['strike']
-        self.portfolio.eth_calls_premium = eth_call['underlying_price'] * eth_call['best_ask_price']
-        self.portfolio.eth_puts_strike = eth_put['strike']
-        self.portfolio.eth_puts_premium = eth_put['underlying_price'] * eth_put['best_ask_price']
-
-    def set_optimal_state(self):
+        for leg in LEG_CHAINS:
+            self.select_row(leg, 0)
+
+    def set_optimal_state(self, method='vectorized', workers=None, progress=None, warm_start=None):
+        # progress(done, total, best_result, optimal) is called as the search advances; anything it raises
+        # aborts the search before the portfolio is touched. method='incremental' gives the branch_and_bound
+        # result, starting from what the last incremental run left in warm_start (self.warm_start by default)
         print("optimizing")
+        progress = progress or print_progress
+        evaluated = [0]
 
+        def counted_progress(done, total, best_result, optimal):
+            # the last count reported is what the metrics get, also for cancelled searches
+            evaluated[0] = done
+            progress(done, total, best_result, optimal)
+
+        with metrics.timer(f"optimizer.{method}"):
+            try:
+                optimal = self._optimize(method, workers, counted_progress, warm_start or self.warm_start)
+            finally:
+                metrics.count(f"optimizer.{method}.candidates", evaluated[0])
+        self.apply_optimal(optimal)
+
+    def _optimize(self, method, workers, progress, warm_start):
+        amounts = BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS = self.optimization_amounts()
+
+        if method == 'scalar':
+            optimal = self._optimize_scalar(*amounts, progress=progress)
+        elif method == 'vectorized':
+            optimal = self._optimize_vectorized(*amounts, progress=progress)
+        elif method == 'parallel':
+            optimal = self._optimize_vectorized(*amounts, workers=workers or self.OPTIMIZER_WORKERS or os.cpu_count(),
+                                                progress=progress)
+        elif method == 'branch_and_bound':
+            optimal = self._optimize_vectorized(*amounts, progress=progress, search=branch_and_bound_leg_combination)
+        elif method == 'incremental':
+            optimal = self._optimize_incremental(*amounts, warm_start=warm_start, progress=progress)
+        elif method == 'lp':
+            optimal = self._optimize_lp(max(BTC_CALL_AMOUNTS), max(BTC_PUT_AMOUNTS), max(ETH_CALL_AMOUNTS),
+                                        max(ETH_PUT_AMOUNTS), progress=progress)
+        elif method == 'frontier':
+            self.frontier = self._optimize_frontier(*amounts, progress=progress)
+            optimal = self.frontier.top[0]['optimal'] if self.frontier.top else []
+        else:
+            raise ValueError(f"unknown optimization method: {method}")
+        if not optimal:
+            raise InfeasibleTarget("no option combination keeps the cant_lose prices out of loss")
+        return optimal
+
+    def optimization_amounts(self):
+        # sizes the spot and futures legs for USD_VALUE_ETH and returns the option amounts the optimizer tries
         BTC_VALUE_ETH = self.USD_VALUE_ETH / self.starting_parameters.btc_start_price
         SPOT_ETH = round(self.USD_VALUE_ETH / self.starting_parameters.eth_spot_start_price, 2)
         CONTRACTS_ETH = round(BTC_VALUE_ETH /
@@ -287,62 +625,848 @@ class TradeSetup:
         ETH_CALL_AMOUNTS = [i / 4 * SPOT_ETH for i in range(0, 5)]
         BTC_PUT_AMOUNTS = [i / 4 * BTC_VALUE_ETH for i in range(0, 5)]
         ETH_PUT_AMOUNTS = [i / 4 * SPOT_ETH for i in range(0, 5)]
+        return BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS
 
+    def apply_optimal(self, optimal):
+        self.portfolio.btc_calls_amount, \
+        self.portfolio.btc_calls_strike, \
+        self.portfolio.btc_calls_premium, \
+        self.portfolio.btc_puts_amount, \
+        self.portfolio.btc_puts_strike, \
+        self.portfolio.btc_puts_premium, \
+        self.portfolio.eth_calls_amount, \
+        self.portfolio.eth_calls_strike, \
+        self.portfolio.eth_calls_premium, \
+        self.portfolio.eth_puts_amount, \
+        self.portfolio.eth_puts_strike, \
+        self.portfolio.eth_puts_premium = optimal
+        # the optimizers work on strikes and premiums, the expiry is that of the row they came from
+        for leg in LEG_CHAINS:
+            setattr(self.portfolio, f"{leg}_expiry", self.option_expiry(leg, getattr(self.portfolio, f"{leg}_strike"),
+                                                                        getattr(self.portfolio, f"{leg}_premium")))
+
+    def _optimize_scalar(self, BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS, progress=None):
         cnt = 0
+        btc_calls = self.starting_parameters.btc_call_options
+        btc_puts = self.starting_parameters.btc_put_options
+        eth_calls = self.starting_parameters.eth_call_options
+        eth_puts = self.starting_parameters.eth_put_options
         iters = len(BTC_CALL_AMOUNTS) * len(ETH_CALL_AMOUNTS) * len(BTC_PUT_AMOUNTS) * len(ETH_PUT_AMOUNTS) * \
-            len(self.starting_parameters.btc_call_options) * len(self.starting_parameters.btc_put_options) * \
-            len(self.starting_parameters.eth_call_options) * len(self.starting_parameters.eth_put_options)
+            len(btc_calls) * len(btc_puts) * len(eth_calls) * len(eth_puts)
         best_result = -1e9
         optimal = []
-        for btc_call in self.starting_parameters.btc_call_options:
-            self.portfolio.btc_calls_strike = btc_call['strike']
-            self.portfolio.btc_calls_premium = btc_call['underlying_price'] * btc_call['best_ask_price']
+        for btc_call_strike, btc_call_premium in zip(btc_calls.strikes.tolist(), btc_calls.premiums.tolist()):
+            self.portfolio.btc_calls_strike = btc_call_strike
+            self.portfolio.btc_calls_premium = btc_call_premium
             for btc_call_amount in BTC_CALL_AMOUNTS:
                 self.portfolio.btc_calls_amount = btc_call_amount
 
-                for btc_put in self.starting_parameters.btc_put_options:
-                    self.portfolio.btc_puts_strike = btc_put['strike']
-                    self.portfolio.btc_puts_premium = btc_put['underlying_price'] * btc_put['best_ask_price']
+                for btc_put_strike, btc_put_premium in zip(btc_puts.strikes.tolist(), btc_puts.premiums.tolist()):
+                    self.portfolio.btc_puts_strike = btc_put_strike
+                    self.portfolio.btc_puts_premium = btc_put_premium
                     for btc_put_amount in BTC_PUT_AMOUNTS:
                         self.portfolio.btc_puts_amount = btc_put_amount
 
-                        for eth_call in self.starting_parameters.eth_call_options:
-                            self.portfolio.eth_calls_strike = eth_call['strike']
-                            self.portfolio.eth_calls_premium = eth_call['underlying_price'] * eth_call['best_ask_price']
+                        for eth_call_strike, eth_call_premium in zip(eth_calls.strikes.tolist(), eth_calls.premiums.tolist()):
+                            self.portfolio.eth_calls_strike = eth_call_strike
+                            self.portfolio.eth_calls_premium = eth_call_premium
                             for eth_call_amount in ETH_CALL_AMOUNTS:
                                 self.portfolio.eth_calls_amount = eth_call_amount
 
-                                for eth_put in self.starting_parameters.eth_put_options:
-                                    self.portfolio.eth_puts_strike = eth_put['strike']
-                                    self.portfolio.eth_puts_premium = eth_put['underlying_price'] * eth_put['best_ask_price']
+                                for eth_put_strike, eth_put_premium in zip(eth_puts.strikes.tolist(), eth_puts.premiums.tolist()):
+                                    self.portfolio.eth_puts_strike = eth_put_strike
+                                    self.portfolio.eth_puts_premium = eth_put_premium
                                     for eth_put_amount in ETH_PUT_AMOUNTS:
                                         self.portfolio.eth_puts_amount = eth_put_amount
 
                                         result_of_range = self.calc_range_min()
                                         if result_of_range > best_result:
                                             best_result = result_of_range
-                                            print(f"\rnew best: BTC CALLS: {btc_call_amount} at {btc_call['strike']} + "
-                                                  f"BTC PUTS: {btc_put_amount} at {btc_put['strike']} +"
-                                                  f"ETH CALLS: {eth_call_amount} at {eth_call['strike']} +"
-                                                  f"ETH PUTS: {eth_put_amount} at {eth_put['strike']} "
+                                            print(f"\rnew best: BTC CALLS: {btc_call_amount} at {btc_call_strike} + "
+                                                  f"BTC PUTS: {btc_put_amount} at {btc_put_strike} +"
+                                                  f"ETH CALLS: {eth_call_amount} at {eth_call_strike} +"
+                                                  f"ETH PUTS: {eth_put_amount} at {eth_put_strike} "
                                                   f"PNL = {result_of_range}")
-                                            optimal = [btc_call_amount, btc_call['strike'], btc_call['underlying_price'] * btc_call['best_ask_price'],
-                                                       btc_put_amount, btc_put['strike'], btc_put['underlying_price'] * btc_put['best_ask_price'],
-                                                       eth_call_amount, eth_call['strike'], eth_call['underlying_price'] * eth_call['best_ask_price'],
-                                                       eth_put_amount, eth_put['strike'], eth_put['underlying_price'] * eth_put['best_ask_price']]
+                                            optimal = [btc_call_amount, btc_call_strike, btc_call_premium,
+                                                       btc_put_amount, btc_put_strike, btc_put_premium,
+                                                       eth_call_amount, eth_call_strike, eth_call_premium,
+                                                       eth_put_amount, eth_put_strike, eth_put_premium]
                                         cnt += 1
                                         if cnt % 1000 == 0:
-                                            print(f"\r{cnt}/{iters}", end='')
+                                            progress(cnt, iters, best_result, optimal)
 
-        self.portfolio.btc_calls_amount, \
-        self.portfolio.btc_calls_strike, \
-        self.portfolio.btc_calls_premium, \
-        self.portfolio.btc_puts_amount, \
-        self.portfolio.btc_puts_strike, \
-        self.portfolio.btc_puts_premium, \
-        self.portfolio.eth_calls_amount, \
-        self.portfolio.eth_calls_strike, \
-        self.portfolio.eth_calls_premium, \
-        self.portfolio.eth_puts_amount, \
-        self.portfolio.eth_puts_strike, \
-        self.portfolio.eth_puts_premium = optimal
+        progress(cnt, iters, best_result, optimal)
+        return optimal
+
+    def _optimize_vectorized(self, BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS, workers=1,
+                             progress=None, search=None, legs=None):
+        # every leg candidate (strike x amount) becomes one row of payoff-minus-cost over the optimization points,
+        # so a combination is scored as a broadcast sum of four rows, in the same order as the scalar loops;
+        # legs are those rows when the caller already has them
+        eth_points, btc_points, num_critical = self.optimization_points()
+        base = self._base_pnl(eth_points, btc_points)
+        if legs is None:
+            legs = (option_leg_candidates(self.starting_parameters.btc_call_options, BTC_CALL_AMOUNTS, btc_points, True),
+                    option_leg_candidates(self.starting_parameters.btc_put_options, BTC_PUT_AMOUNTS, btc_points, False),
+                    option_leg_candidates(self.starting_parameters.eth_call_options, ETH_CALL_AMOUNTS, eth_points, True),
+                    option_leg_candidates(self.starting_parameters.eth_put_options, ETH_PUT_AMOUNTS, eth_points, False))
+        btc_calls, btc_puts, eth_calls, eth_puts = legs
+        if not (len(btc_calls) and len(btc_puts) and len(eth_calls) and len(eth_puts)):
+            return []
+
+        amounts = BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS
+
+        def to_optimal(btc_index, eth_index):
+            if btc_index is None:
+                return []
+            return self._optimal_from_indices(amounts, divmod(btc_index, len(btc_puts)) + divmod(eth_index, len(eth_puts)))
+
+        def report(done, total, best_result, btc_index, eth_index):
+            if progress is not None:
+                progress(done, total, best_result, to_optimal(btc_index, eth_index))
+
+        if search is not None:
+            best_result, btc_index, eth_index = search(base, btc_calls, btc_puts, eth_calls, eth_puts, num_critical,
+                                                       progress=report)
+        elif workers > 1:
+            eth_legs = (eth_calls[:, None, :] + eth_puts[None, :, :]).reshape(-1, base.size)
+            best_result, btc_index, eth_index = parallel_best_leg_combination(base, btc_calls, btc_puts, eth_legs,
+                                                                              num_critical, workers, progress=report)
+        else:
+            eth_legs = (eth_calls[:, None, :] + eth_puts[None, :, :]).reshape(-1, base.size)
+            best_result, btc_index, eth_index = best_leg_combination(base, btc_calls, btc_puts, eth_legs, num_critical,
+                                                                     progress=report)
+        optimal = to_optimal(btc_index, eth_index)
+        if not optimal:
+            return []
+        print(f"best: BTC CALLS: {optimal[0]} at {optimal[1]} + "
+              f"BTC PUTS: {optimal[3]} at {optimal[4]} +"
+              f"ETH CALLS: {optimal[6]} at {optimal[7]} +"
+              f"ETH PUTS: {optimal[9]} at {optimal[10]} "
+              f"PNL = {best_result}")
+        return optimal
+
+    def _optimize_incremental(self, BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS, warm_start,
+                              progress=None):
+        # branch and bound over candidate rows of which only the ones of new or repriced options are recomputed,
+        # with the best of the previous optimum and its one-leg neighbors (rescored on the new quotes) as the
+        # bound that prunes from the start. Nothing changed at all returns the previous optimum as it is
+        amounts = BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS
+        eth_points, btc_points, num_critical = self.optimization_points()
+        base = self._base_pnl(eth_points, btc_points)
+        legs, rescored, unchanged = warm_start.leg_candidates(self.starting_parameters, amounts, eth_points, btc_points)
+        metrics.count("optimizer.incremental.rescored_options", rescored)
+        if unchanged and warm_start.optimal and np.array_equal(base, warm_start.base):
+            metrics.count("optimizer.incremental.unchanged")
+            progress(0, 0, warm_start.best_result, warm_start.optimal)
+            return list(warm_start.optimal)
+        lower_bound = warm_start.incumbent_bound(base, legs, amounts, num_critical)
+        optimal = self._optimize_vectorized(*amounts, progress=progress, legs=legs,
+                                            search=functools.partial(branch_and_bound_leg_combination,
+                                                                     lower_bound=lower_bound))
+        warm_start.remember(base, legs, amounts, optimal, num_critical)
+        return optimal
+
+    def _optimize_frontier(self, BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS, top_k=20,
+                           percentile=5, resolution=1.0, progress=None):
+        # scores every combination on all FRONTIER_OBJECTIVES in one pass, keeping the top_k by min_pnl and the
+        # combinations no other one beats on every objective (compared at resolution USD)
+        eth_points, btc_points, num_critical = self.optimization_points(include_liquidation=True)
+        num_grid = self.optimization_target.num_points_in_range
+        base = self._base_pnl(eth_points, btc_points)
+        chains = (self.starting_parameters.btc_call_options, self.starting_parameters.btc_put_options,
+                  self.starting_parameters.eth_call_options, self.starting_parameters.eth_put_options)
+        amounts = BTC_CALL_AMOUNTS, BTC_PUT_AMOUNTS, ETH_CALL_AMOUNTS, ETH_PUT_AMOUNTS
+        points = (btc_points, btc_points, eth_points, eth_points)
+        legs = [option_leg_candidates(chain, leg_amounts, exit_prices, is_call) for chain, leg_amounts, exit_prices, is_call
+                in zip(chains, amounts, points, (True, False, True, False))]
+        costs = [option_leg_costs(chain, leg_amounts) for chain, leg_amounts in zip(chains, amounts)]
+        if not all(len(leg) for leg in legs):
+            return OptimizationFrontier([], [])
+
+        btc_calls, btc_puts, eth_calls, eth_puts = legs
+        eth_legs = (eth_calls[:, None, :] + eth_puts[None, :, :]).reshape(-1, base.size)
+        btc_costs = (costs[0][:, None] + costs[1][None, :]).ravel() + self.portfolio.legs.cost
+        eth_costs = (costs[2][:, None] + costs[3][None, :]).ravel()
+
+        def to_entry(objectives, index):
+            btc_index, eth_index = divmod(int(index), len(eth_legs))
+            entry = dict(zip(FRONTIER_OBJECTIVES, (float(value) for value in objectives)))
+            entry['premium_cost'] = -entry['premium_cost']
+            entry['optimal'] = self._optimal_from_indices(amounts, divmod(btc_index, len(btc_puts)) +
+                                                          divmod(eth_index, len(eth_puts)))
+            return entry
+
+        def report(done, total, best_result, best_index):
+            if progress is not None:
+                progress(done, total, best_result, [] if best_index is None else to_entry(
+                    np.zeros(len(FRONTIER_OBJECTIVES)), best_index)['optimal'])
+
+        top, front_objectives, front_indices = frontier_leg_combinations(
+            base, btc_calls, btc_puts, eth_legs, btc_costs, eth_costs, num_critical, num_grid, percentile=percentile,
+            top_k=top_k, resolution=resolution, progress=report)
+        return OptimizationFrontier([to_entry(objectives, index) for objectives, index in top],
+                                    [to_entry(objectives, index) for objectives, index in
+                                     zip(front_objectives, front_indices)])
+
+    def _optimal_from_indices(self, amounts, indices):
+        # indices are (option, amount) candidate rows per leg, in btc call, btc put, eth call, eth put order
+        optimal = []
+        chains = (self.starting_parameters.btc_call_options, self.starting_parameters.btc_put_options,
+                  self.starting_parameters.eth_call_options, self.starting_parameters.eth_put_options)
+        for chain, leg_amounts, index in zip(chains, amounts, indices):
+            option_index, amount_index = divmod(int(index), len(leg_amounts))
+            option = chain[option_index]
+            optimal += [leg_amounts[amount_index], option['strike'], option['premium']]
+        return optimal
+
+    def _optimize_lp(self, max_btc_calls, max_btc_puts, max_eth_calls, max_eth_puts, progress=None, batch_size=64):
+        # for fixed strikes the PnL is linear in the four amounts, so max-min over the grid with the cant_lose
+        # points kept >= 0 is an LP; strikes dominated by a cheaper strike with a better payoff are dropped first
+        eth_points, btc_points, num_critical = self.optimization_points()
+        base = self._base_pnl(eth_points, btc_points)
+        chains = (self.starting_parameters.btc_call_options, self.starting_parameters.btc_put_options,
+                  self.starting_parameters.eth_call_options, self.starting_parameters.eth_put_options)
+        is_calls = (True, False, True, False)
+        leg_indices = [undominated_options(chain, is_call) for chain, is_call in zip(chains, is_calls)]
+        units = [option_leg_candidates(chain.take(indices), [1], points, is_call)
+                 for chain, indices, points, is_call in
+                 zip(chains, leg_indices, (btc_points, btc_points, eth_points, eth_points), is_calls)]
+        if not all(len(indices) for indices in leg_indices):
+            return []
+
+        combinations = np.stack(np.meshgrid(*[np.arange(len(indices)) for indices in leg_indices],
+                                            indexing='ij'), axis=-1).reshape(-1, 4)
+        best_result, best_combination, best_amounts = -1e9, None, None
+        for start in range(0, len(combinations), batch_size):
+            batch = combinations[start:start + batch_size]
+            results, amounts = solve_max_min_lps(base, [np.stack([units[leg][combination[leg]] for leg in range(4)])
+                                                        for combination in batch],
+                                                 (max_btc_calls, max_btc_puts, max_eth_calls, max_eth_puts), num_critical)
+            batch_best = int(np.argmax(results))
+            if results[batch_best] > best_result:
+                best_result, best_combination, best_amounts = results[batch_best], batch[batch_best], amounts[batch_best]
+            if progress is not None:
+                progress(min(start + batch_size, len(combinations)), len(combinations), best_result,
+                         self._optimal_from_lp(leg_indices, best_combination, best_amounts))
+        return self._optimal_from_lp(leg_indices, best_combination, best_amounts)
+
+    def _optimal_from_lp(self, leg_indices, combination, amounts):
+        if combination is None:
+            return []
+        optimal = []
+        chains = (self.starting_parameters.btc_call_options, self.starting_parameters.btc_put_options,
+                  self.starting_parameters.eth_call_options, self.starting_parameters.eth_put_options)
+        for chain, indices, index, amount in zip(chains, leg_indices, combination, amounts):
+            option = chain[indices[index]]
+            optimal += [float(amount), option['strike'], option['premium']]
+        return optimal
+
+    def optimization_points(self, include_liquidation=False):
+        # cant_lose_prices first, then the target grid (btc major, eth minor), then with include_liquidation the
+        # ETH spot price at which the futures get liquidated, for every btc price of the range
+        target = self.optimization_target
+        eth_points = [critical_point['eth'] for critical_point in target.cant_lose_prices] + \
+                     [eth_price for btc_price in target.btc_prices_range for eth_price in target.eth_prices_range]
+        btc_points = [critical_point['btc'] for critical_point in target.cant_lose_prices] + \
+                     [btc_price for btc_price in target.btc_prices_range for eth_price in target.eth_prices_range]
+        if include_liquidation and self.portfolio.eth_quanto_futures_contracts_shorted:
+            eth_points += list(self.calculate_bitmex_eth_liq_prices(target.btc_prices_range) /
+                               (1 + self.exit_parameters.premium_exit))
+            btc_points += target.btc_prices_range
+        return np.array(eth_points, dtype=float), np.array(btc_points, dtype=float), len(target.cant_lose_prices)
+
+    def _base_pnl(self, eth_exit_prices, btc_exit_prices):
+        eth_spot_pnl_usd = self.portfolio.eth_spot_amount * \
+                           (eth_exit_prices - self.starting_parameters.eth_spot_start_price)
+        eth_quanto_futures_price_movement = eth_exit_prices * (1 + self.exit_parameters.premium_exit) - \
+                                            self.starting_parameters.eth_quanto_futures_start_price
+        eth_quanto_futures_pnl_btc = self.portfolio.eth_quanto_futures_contracts_shorted * \
+                                     (eth_quanto_futures_price_movement * -1 * self.starting_parameters.quanto_multiplier)
+        base = eth_spot_pnl_usd + eth_quanto_futures_pnl_btc * btc_exit_prices
+        if len(self.portfolio.legs):
+            base = base + self.portfolio.legs.pnl(eth_exit_prices, btc_exit_prices)
+        return base
+
+
+def eth_spot_layer(eth_exit_prices, btc_exit_prices, amount, start_price):
+    return amount * (eth_exit_prices - start_price)
+
+
+def eth_quanto_futures_layer(eth_exit_prices, btc_exit_prices, contracts, start_price, multiplier, premium_exit):
+    eth_quanto_futures_price_movement = eth_exit_prices * (1 + premium_exit) - start_price
+    return contracts * (eth_quanto_futures_price_movement * -1 * multiplier) * btc_exit_prices
+
+
+def option_layer(eth_exit_prices, btc_exit_prices, underlying, is_call, amount, strike, premium):
+    exit_prices = eth_exit_prices if underlying == 'eth' else btc_exit_prices
+    if is_call:
+        payoff = np.where(exit_prices > strike, exit_prices - strike, 0)
+    else:
+        payoff = np.where(exit_prices < strike, strike - exit_prices, 0)
+    return amount * payoff - amount * premium
+
+
+def eth_spot_components(eth_prices, btc_prices, amount, start_price):
+    return SeparableSurface(eth_prices, btc_prices, eth_terms=eth_spot_layer(eth_prices, None, amount, start_price))
+
+
+def eth_quanto_futures_components(eth_prices, btc_prices, contracts, start_price, multiplier, premium_exit):
+    # the one ETH x BTC term: linear in BTC, with a slope that depends on ETH
+    return SeparableSurface(eth_prices, btc_prices, quanto=eth_quanto_futures_layer(eth_prices, 1, contracts, start_price,
+                                                                                    multiplier, premium_exit))
+
+
+def option_components(eth_prices, btc_prices, underlying, is_call, amount, strike, premium):
+    return SeparableSurface(eth_prices, btc_prices, **{f"{underlying}_terms": option_layer(
+        eth_prices, btc_prices, underlying, is_call, amount, strike, premium)})
+
+
+def legs_components(eth_prices, btc_prices, legs):
+    is_eth = legs.underlying == 'eth'
+    return SeparableSurface(eth_prices, btc_prices, eth_terms=legs.leg_pnl(eth_prices, 0)[:, is_eth].sum(axis=-1),
+                            btc_terms=legs.leg_pnl(0, btc_prices)[:, ~is_eth].sum(axis=-1))
+
+
+class SeparableSurface:
+    # PnL over an ETH x BTC grid as eth_terms[i] + btc_terms[j] + quanto[i] * btc_prices[j]: spot and ETH options
+    # only depend on ETH, BTC options only on BTC and the quanto future is the one product term. Only these 1-D
+    # components are kept, O(n + m) instead of O(n * m); points, rows, columns and blocks are computed from them
+    # when asked for, the extremes exactly without the grid, and dense() builds the full table only on demand
+    DENSE_EXTREMES_SIZE = 4096
+
+    def __init__(self, eth_prices, btc_prices, eth_terms=0, btc_terms=0, quanto=0):
+        self.eth_prices = np.asarray(eth_prices, dtype=float)
+        self.btc_prices = np.asarray(btc_prices, dtype=float)
+        self.eth_terms = grid_component(eth_terms, self.eth_prices.shape)
+        self.btc_terms = grid_component(btc_terms, self.btc_prices.shape)
+        self.quanto = grid_component(quanto, self.eth_prices.shape)
+
+    @property
+    def shape(self):
+        return len(self.eth_prices), len(self.btc_prices)
+
+    @property
+    def nbytes(self):
+        return self.eth_prices.nbytes + self.btc_prices.nbytes + self.eth_terms.nbytes + self.btc_terms.nbytes + \
+            self.quanto.nbytes
+
+    def at(self, eth_index, btc_index):
+        return float(self.eth_terms[eth_index] + self.btc_terms[btc_index] +
+                     self.quanto[eth_index] * self.btc_prices[btc_index])
+
+    def row(self, eth_index):
+        # PnL along BTC at one ETH price
+        return self.eth_terms[eth_index] + self.btc_terms + self.quanto[eth_index] * self.btc_prices
+
+    def column(self, btc_index):
+        # PnL along ETH at one BTC price
+        return self.eth_terms + self.btc_terms[btc_index] + self.quanto * self.btc_prices[btc_index]
+
+    def block(self, eth_slice=slice(None), btc_slice=slice(None)):
+        # the dense PnL of a sub-rectangle, ETH along the first axis like calculate_pnl_grid(eth[:, None], btc)
+        return self.eth_terms[eth_slice, None] + self.btc_terms[None, btc_slice] + \
+            self.quanto[eth_slice, None] * self.btc_prices[None, btc_slice]
+
+    def dense(self):
+        return self.block()
+
+    def sub(self, eth_slice=slice(None), btc_slice=slice(None)):
+        # a sub-rectangle that stays separable
+        return SeparableSurface(self.eth_prices[eth_slice], self.btc_prices[btc_slice], self.eth_terms[eth_slice],
+                                self.btc_terms[btc_slice], self.quanto[eth_slice])
+
+    def min(self):
+        # (min PnL, (eth index, btc index) of it); for every ETH price the best BTC price is a vertex of the lower
+        # convex hull of (btc_prices, btc_terms), found by the slope quanto: O((n + m) log m) for the exact minimum.
+        # Grids as small as the optimization target are faster to scan densely
+        if self.eth_prices.size * self.btc_prices.size <= self.DENSE_EXTREMES_SIZE:
+            pnl = self.dense()
+            eth_index, btc_index = np.unravel_index(pnl.argmin(), pnl.shape)
+            return float(pnl[eth_index, btc_index]), (int(eth_index), int(btc_index))
+        btc_indices = lower_envelope(self.btc_prices, self.btc_terms, self.quanto)
+        values = self.eth_terms + self.btc_terms[btc_indices] + self.quanto * self.btc_prices[btc_indices]
+        eth_index = int(values.argmin())
+        return float(values[eth_index]), (eth_index, int(btc_indices[eth_index]))
+
+    def max(self):
+        negated = SeparableSurface(self.eth_prices, self.btc_prices, -self.eth_terms, -self.btc_terms, -self.quanto)
+        # the dense/hull threshold goes along, it may have been set on this instance
+        negated.DENSE_EXTREMES_SIZE = self.DENSE_EXTREMES_SIZE
+        value, index = negated.min()
+        return -value, index
+
+    def mean(self):
+        return float(self.eth_terms.mean() + self.btc_terms.mean() + self.quanto.mean() * self.btc_prices.mean())
+
+    def __add__(self, other):
+        if not (np.array_equal(self.eth_prices, other.eth_prices) and np.array_equal(self.btc_prices, other.btc_prices)):
+            raise ValueError("surfaces over different grids")
+        return SeparableSurface(self.eth_prices, self.btc_prices, self.eth_terms + other.eth_terms,
+                                self.btc_terms + other.btc_terms, self.quanto + other.quanto)
+
+
+def grid_component(values, shape):
+    # constants (a layer that does not depend on that axis) are spread over it
+    values = np.asarray(values, dtype=float)
+    return values if values.shape == shape else np.broadcast_to(values, shape).copy()
+
+
+def lower_envelope(x, y, slopes):
+    # for every slope the index j minimizing y[j] + slope * x[j]: the minimum lies on the lower convex hull of the
+    # points (x, y), at the vertex where the hull's edge slopes pass -slope
+    hull = []
+    xs, ys = x.tolist(), y.tolist()
+    for j in np.lexsort((y, x)).tolist():
+        if hull and xs[hull[-1]] == xs[j]:
+            continue
+        while len(hull) >= 2 and (xs[hull[-1]] - xs[hull[-2]]) * (ys[j] - ys[hull[-2]]) - \
+                (ys[hull[-1]] - ys[hull[-2]]) * (xs[j] - xs[hull[-2]]) <= 0:
+            hull.pop()
+        hull.append(j)
+    hull = np.array(hull, dtype=int)
+    edge_slopes = np.diff(y[hull]) / np.diff(x[hull])
+    return hull[np.searchsorted(edge_slopes, -np.asarray(slopes, dtype=float), side='left')]
+
+
+class LRUCache:
+    # bounded by the total size of the cached arrays, least recently used entries go first
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.size += value.nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1].nbytes
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+
+surface_cache = LRUCache(max_bytes=256 * 2 ** 20)
+
+
+class PnlSurface:
+    # PnL over a fixed grid, kept as the sum of TradeSetup.pnl_layers so that a change in one input only
+    # recomputes the layers that depend on it. Layers and their sum are SeparableSurfaces, the dense pnl_table is
+    # only built when it is read. Layers, summed and dense surfaces and liquidation curves are shared through an
+    # LRU cache keyed by their inputs and the grid, so going back to a state seen before (by any session) costs a
+    # lookup
+    def __init__(self, eth_prices, btc_prices, cache=None):
+        self.eth_prices = np.asarray(eth_prices, dtype=float)
+        self.btc_prices = np.asarray(btc_prices, dtype=float)
+        self.grid_key = hashlib.sha1(self.eth_prices.tobytes() + b'|' + self.btc_prices.tobytes()).hexdigest()
+        self.cache = surface_cache if cache is None else cache
+        self.layers = {}
+        self.layer_keys = {}
+        self.surface = None
+        self.surface_key = None
+        self.liq_prices = None
+        self.liq_key = None
+
+    @metrics.timed("pnl.surface")
+    def refresh(self, trade_setup):
+        changed = []
+        for name, (layer_function, key) in trade_setup.pnl_layers().items():
+            if self.layer_keys.get(name) != key:
+                self.layers[name] = self.cache.get_or_compute(
+                    (self.grid_key, name, key),
+                    lambda: layer_function(self.eth_prices, self.btc_prices, *key))
+                self.layer_keys[name] = key
+                changed.append(name)
+        if changed:
+            self.surface_key = (self.grid_key, 'surface', tuple(sorted(self.layer_keys.items())))
+            self.surface = self.cache.get_or_compute(
+                self.surface_key, lambda: functools.reduce(operator.add, self.layers.values()))
+
+        liq_key = trade_setup.liq_curve_key()
+        if liq_key != self.liq_key:
+            self.liq_prices = self.cache.get_or_compute(
+                (self.grid_key, 'liquidation', liq_key),
+                lambda: trade_setup.calculate_bitmex_eth_liq_prices(self.btc_prices))
+            self.liq_key = liq_key
+            changed.append('liquidation')
+        metrics.count("pnl.surface.changed_layers", len(changed))
+        return changed
+
+    @property
+    def pnl_table(self):
+        if self.surface is None:
+            return None
+        return self.cache.get_or_compute(self.surface_key + ('dense',), self.surface.dense)
+
+
+class WarmStart:
+    # what an incremental optimization leaves for the next one: the candidate rows of every leg with the points,
+    # strikes, premiums and amounts they were computed for, and the optimum as (strike, amount index) per leg
+    def __init__(self):
+        self.eth_points = None
+        self.btc_points = None
+        self.base = None
+        self.legs = None
+        self.optimal = []
+        self.incumbent = None
+        self.best_result = None
+
+    def leg_candidates(self, starting_parameters, amounts, eth_points, btc_points):
+        # (rows of every leg, number of options whose rows had to be computed, whether the chains are exactly the
+        # last ones); rows of an option are reused when its strike and premium and the leg's amounts and points are
+        # the same as last time. Repriced options are recomputed rather than shifted, so the rows are bit for bit
+        # the ones a cold search builds
+        same_points = self.eth_points is not None and np.array_equal(eth_points, self.eth_points) and \
+            np.array_equal(btc_points, self.btc_points)
+        chains = (starting_parameters.btc_call_options, starting_parameters.btc_put_options,
+                  starting_parameters.eth_call_options, starting_parameters.eth_put_options)
+        legs, rescored, unchanged = [], 0, same_points and self.legs is not None
+        for leg, (options, leg_amounts, exit_prices, is_call) in enumerate(zip(
+                chains, amounts, (btc_points, btc_points, eth_points, eth_points), (True, False, True, False))):
+            leg_amounts = np.array(leg_amounts, dtype=float)
+            previous = self.legs[leg] if same_points and self.legs is not None else None
+            if previous is None or not np.array_equal(previous['amounts'], leg_amounts):
+                legs.append(option_leg_candidates(options, leg_amounts, exit_prices, is_call))
+                rescored += len(options)
+                unchanged = False
+                continue
+            # the same options in another order would change which of tied combinations the search returns
+            unchanged = unchanged and np.array_equal(previous['strikes'], options.strikes) and \
+                np.array_equal(previous['premiums'], options.premiums)
+            previous_rows = previous['rows'].reshape(len(previous['strikes']), len(leg_amounts), len(exit_prices))
+            previous_index = {(strike, premium): index for index, (strike, premium) in
+                              reversed(list(enumerate(zip(previous['strikes'].tolist(), previous['premiums'].tolist()))))}
+            rows = np.empty((len(options), len(leg_amounts), len(exit_prices)))
+            changed = []
+            for index, key in enumerate(zip(options.strikes.tolist(), options.premiums.tolist())):
+                if key in previous_index:
+                    rows[index] = previous_rows[previous_index[key]]
+                else:
+                    changed.append(index)
+            if changed:
+                rows[changed] = option_leg_candidates(options.take(changed), leg_amounts, exit_prices, is_call) \
+                    .reshape(len(changed), len(leg_amounts), len(exit_prices))
+            legs.append(rows.reshape(-1, len(exit_prices)))
+            rescored += len(changed)
+        if not unchanged:
+            # the optimum is only valid for the chains it was found on; until remember() has the one for these, a
+            # cancelled or failed search must not leave the next run thinking it already has it
+            self.base = None
+            self.optimal = []
+            self.best_result = None
+        self.eth_points, self.btc_points = eth_points, btc_points
+        # copies, chains are updated in place when quotes tick
+        self.legs = [{'strikes': options.strikes.copy(), 'premiums': options.premiums.copy(),
+                      'amounts': np.array(leg_amounts, dtype=float), 'rows': rows}
+                     for options, leg_amounts, rows in zip(chains, amounts, legs)]
+        return legs, rescored, unchanged
+
+    def incumbent_rows(self, legs, amounts):
+        # row index of the previous optimum in every leg, None when one of its strikes is gone
+        if self.incumbent is None:
+            return None
+        indices = []
+        for leg, (strike, amount_index) in enumerate(self.incumbent):
+            matches = np.flatnonzero(self.legs[leg]['strikes'] == strike)
+            if not len(matches) or amount_index >= len(amounts[leg]):
+                return None
+            indices.append(int(matches[0]) * len(amounts[leg]) + amount_index)
+        return indices
+
+    def incumbent_bound(self, base, legs, amounts, num_critical):
+        # best score of the previous optimum and every combination that differs from it in one leg; a score
+        # that is reachable, so every subtree whose bound is below it can go. The small margin keeps rounding
+        # of this differently ordered sum from pruning the subtree that holds the combination itself
+        indices = self.incumbent_rows(legs, amounts)
+        if indices is None:
+            return -1e9
+        chosen = [leg_rows[index] for leg_rows, index in zip(legs, indices)]
+        best = -1e9
+        for leg, leg_rows in enumerate(legs):
+            totals = base + sum(row for other, row in enumerate(chosen) if other != leg) + leg_rows
+            scores = totals[:, num_critical:].min(axis=1)
+            scores[(totals[:, :num_critical] < 0).any(axis=1)] = -1e9
+            best = max(best, float(scores.max()))
+        return best - 1e-6 * max(1.0, abs(best)) if best > -1e9 else -1e9
+
+    def remember(self, base, legs, amounts, optimal, num_critical):
+        self.base = base
+        self.optimal = list(optimal)
+        self.incumbent = None
+        self.best_result = None
+        if optimal:
+            self.incumbent = []
+            for leg in range(4):
+                amount, strike = optimal[3 * leg], optimal[3 * leg + 1]
+                self.incumbent.append((strike, list(amounts[leg]).index(amount)))
+            total = base + sum(leg_rows[index] for leg_rows, index in zip(legs, self.incumbent_rows(legs, amounts)))
+            self.best_result = float(total[num_critical:].min())
+
+
+def option_leg_candidates(options, amounts, exit_prices, is_call):
+    # rows are (option, amount) pairs in loop order, columns are the exit points
+    strikes, premiums = options.strikes, options.premiums
+    amounts = np.array(amounts, dtype=float)
+    if is_call:
+        payoff = np.where(exit_prices[None, :] > strikes[:, None], exit_prices[None, :] - strikes[:, None], 0)
+    else:
+        payoff = np.where(exit_prices[None, :] < strikes[:, None], strikes[:, None] - exit_prices[None, :], 0)
+    legs = amounts[None, :, None] * payoff[:, None, :] - (amounts[None, :] * premiums[:, None])[:, :, None]
+    return legs.reshape(len(strikes) * len(amounts), len(exit_prices))
+
+
+def option_leg_costs(options, amounts):
+    # premium paid for every row of option_leg_candidates
+    return (np.array(amounts, dtype=float)[None, :] * options.premiums[:, None]).ravel()
+
+
+def print_progress(done, total, best_result, optimal):
+    print(f"\r{done}/{total}", end='' if done < total else '\n')
+
+
+def undominated_options(options, is_call):
+    # an option is dominated when another one costs no more and pays at least as much everywhere
+    strikes, premiums = options.strikes, options.premiums
+    other, option = np.meshgrid(np.arange(len(options)), np.arange(len(options)))
+    better_strike = strikes[other] <= strikes[option] if is_call else strikes[other] >= strikes[option]
+    dominated = (other != option) & better_strike & (premiums[other] <= premiums[option]) & \
+        ((strikes[other] != strikes[option]) | (premiums[other] < premiums[option]) | (other < option))
+    return np.flatnonzero(~dominated.any(axis=1)).tolist()
+
+
+def solve_max_min_lps(base, leg_units, upper_bounds, num_critical, critical_margin=1e-3):
+    # solves max t s.t. base + amounts @ units >= t on the grid and >= 0 on the cant_lose points, for every
+    # units matrix in leg_units at once as one block-diagonal LP; an infeasible batch is retried one by one.
+    # The cant_lose rows ask for a small positive margin so solver tolerances never leave them slightly negative
+    num_legs = len(upper_bounds)
+    base = base.copy()
+    base[:num_critical] -= critical_margin
+    blocks, rhs = [], []
+    for units in leg_units:
+        block = np.zeros((base.size, num_legs + 1))
+        block[:, :num_legs] = -units.T
+        block[num_critical:, num_legs] = 1
+        blocks.append(block)
+        rhs.append(base)
+    objective = np.tile(np.r_[np.zeros(num_legs), -1.0], len(leg_units))
+    bounds = [(0, upper_bound) for upper_bound in upper_bounds] + [(None, None)]
+    solution = linprog(objective, A_ub=scipy.sparse.block_diag(blocks, format='csr'), b_ub=np.concatenate(rhs),
+                       bounds=bounds * len(leg_units), method='highs')
+    if solution.status == 0:
+        x = solution.x.reshape(len(leg_units), num_legs + 1)
+        return x[:, num_legs], x[:, :num_legs]
+    if len(leg_units) == 1:
+        return np.array([-1e9]), np.zeros((1, num_legs))
+    results = [solve_max_min_lps(base, [units], upper_bounds, num_critical) for units in leg_units]
+    return np.concatenate([result for result, _ in results]), np.concatenate([amounts for _, amounts in results])
+
+
+def best_leg_combination(base, btc_calls, btc_puts, eth_legs, num_critical, start=0, stop=None,
+                         max_block_size=2 ** 23, progress=None):
+    # scores btc_call x btc_put x eth_legs in chunks, keeping the first strict improvement like the scalar loops do
+    num_btc_legs = len(btc_calls) * len(btc_puts)
+    stop = num_btc_legs if stop is None else stop
+    rows_per_chunk = max(1, max_block_size // eth_legs.size)
+    best_result, best_btc_index, best_eth_index = -1e9, None, None
+    for chunk_start in range(start, stop, rows_per_chunk):
+        btc_index = np.arange(chunk_start, min(chunk_start + rows_per_chunk, stop))
+        partial = base + btc_calls[btc_index // len(btc_puts)] + btc_puts[btc_index % len(btc_puts)]
+        block = partial[:, None, :] + eth_legs[None, :, :]
+        scores = block[:, :, num_critical:].min(axis=2)
+        scores[(block[:, :, :num_critical] < 0).any(axis=2)] = -1e9
+        flat_index = scores.argmax()
+        if scores.flat[flat_index] > best_result:
+            best_result = float(scores.flat[flat_index])
+            best_btc_index = chunk_start + flat_index // len(eth_legs)
+            best_eth_index = flat_index % len(eth_legs)
+        if progress is not None:
+            progress((min(chunk_start + rows_per_chunk, stop) - start) * len(eth_legs), (stop - start) * len(eth_legs),
+                     best_result, best_btc_index, best_eth_index)
+    return best_result, best_btc_index, best_eth_index
+
+
+def branch_and_bound_leg_combination(base, btc_calls, btc_puts, eth_calls, eth_puts, num_critical, progress=None,
+                                     lower_bound=-1e9):
+    # walks the legs in the scalar loop order; adding the per-point maximum of every leg still to be chosen gives an
+    # upper bound on the reachable PnL, so a subtree is skipped when it cannot keep the cant_lose points >= 0 or
+    # cannot beat the incumbent. Ties are never pruned ahead of the incumbent, so the result is the scalar one.
+    # lower_bound is a score known to be reachable (e.g. a previous optimum), subtrees strictly below it are skipped
+    best_eth_puts = eth_puts.max(axis=0)
+    best_eth_legs = eth_calls.max(axis=0) + best_eth_puts
+    best_rest = btc_puts.max(axis=0) + best_eth_legs
+
+    def hopeless(partial, best_remaining, best_result):
+        # per row of partial: True when no completion stays feasible or beats the incumbent
+        reachable = partial + best_remaining
+        upper_bound = reachable[..., num_critical:].min(axis=-1)
+        return (reachable[..., :num_critical] < 0).any(axis=-1) | (upper_bound <= best_result) | \
+            (upper_bound < lower_bound)
+
+    num_eth_puts = len(eth_puts)
+    total = len(btc_calls) * len(btc_puts) * len(eth_calls) * num_eth_puts
+    best_result, best_btc_index, best_eth_index = -1e9, None, None
+    for btc_call_index in range(len(btc_calls)):
+        partial_btc_call = base + btc_calls[btc_call_index]
+        if not hopeless(partial_btc_call, best_rest, best_result):
+            partial_btc = partial_btc_call + btc_puts
+            for btc_put_index in np.flatnonzero(~hopeless(partial_btc, best_eth_legs, best_result)):
+                partial_eth_call = partial_btc[btc_put_index] + eth_calls
+                eth_call_indices = np.flatnonzero(~hopeless(partial_eth_call, best_eth_puts, best_result))
+                if not len(eth_call_indices):
+                    continue
+                block = partial_eth_call[eth_call_indices][:, None, :] + eth_puts[None, :, :]
+                scores = block[:, :, num_critical:].min(axis=2)
+                scores[(block[:, :, :num_critical] < 0).any(axis=2)] = -1e9
+                flat_index = scores.argmax()
+                if scores.flat[flat_index] > best_result:
+                    best_result = float(scores.flat[flat_index])
+                    best_btc_index = btc_call_index * len(btc_puts) + btc_put_index
+                    best_eth_index = eth_call_indices[flat_index // num_eth_puts] * num_eth_puts + flat_index % num_eth_puts
+        if progress is not None:
+            progress((btc_call_index + 1) * total // len(btc_calls), total, best_result, best_btc_index, best_eth_index)
+    return best_result, best_btc_index, best_eth_index
+
+
+FRONTIER_OBJECTIVES = ('min_pnl', 'mean_pnl', 'percentile_pnl', 'premium_cost', 'liquidation_pnl')
+
+
+class OptimizationFrontier:
+    def __init__(self, top, pareto):
+        # entries are dicts of FRONTIER_OBJECTIVES plus 'optimal' (the list apply_optimal takes); top is sorted by
+        # min_pnl, pareto by its objectives in order
+        self.top = top
+        self.pareto = pareto
+
+
+def pareto_front(objectives, order):
+    # positions of the rows no other row dominates, every objective larger is better; of equal rows the one
+    # first in order is kept. After a lexicographic sort no row can be dominated by a later one
+    keys = (order,) + tuple(-objectives[:, column] for column in reversed(range(objectives.shape[1])))
+    positions = np.lexsort(keys)
+    remaining = objectives[positions]
+    front = []
+    while len(positions):
+        front.append(positions[0])
+        keep = ~(remaining[0] >= remaining).all(axis=1)
+        remaining, positions = remaining[keep], positions[keep]
+    return np.array(front, dtype=int)
+
+
+def grid_percentile(pnl, percentile):
+    # np.percentile (linear interpolation) along the last axis using a partial sort
+    position = percentile / 100 * (pnl.shape[-1] - 1)
+    low, high = int(np.floor(position)), int(np.ceil(position))
+    partitioned = np.partition(pnl, [low, high], axis=-1)
+    return partitioned[..., low] + (position - low) * (partitioned[..., high] - partitioned[..., low])
+
+
+def frontier_leg_combinations(base, btc_calls, btc_puts, eth_legs, btc_costs, eth_costs, num_critical, num_grid,
+                              percentile=5, top_k=20, resolution=1.0, max_block_size=2 ** 22, progress=None):
+    # like best_leg_combination, but every feasible combination gets all FRONTIER_OBJECTIVES (premium_cost negated
+    # so that larger is better); returns the top_k (objectives, index) by min_pnl and the pareto front as
+    # (objectives, indices), index being btc_index * len(eth_legs) + eth_index
+    num_btc_legs = len(btc_calls) * len(btc_puts)
+    rows_per_chunk = max(1, max_block_size // eth_legs.size)
+    heap = []
+    front_objectives = np.empty((0, len(FRONTIER_OBJECTIVES)))
+    front_indices = np.empty(0, dtype=np.int64)
+    for chunk_start in range(0, num_btc_legs, rows_per_chunk):
+        btc_index = np.arange(chunk_start, min(chunk_start + rows_per_chunk, num_btc_legs))
+        partial = base + btc_calls[btc_index // len(btc_puts)] + btc_puts[btc_index % len(btc_puts)]
+        block = partial[:, None, :] + eth_legs[None, :, :]
+        feasible = (block[:, :, :num_critical] >= 0).all(axis=2)
+        grid = block[:, :, num_critical:num_critical + num_grid]
+        liquidation = block[:, :, num_critical + num_grid:]
+        objectives = np.stack([grid.min(axis=2),
+                               grid.mean(axis=2),
+                               grid_percentile(grid, percentile),
+                               -(btc_costs[btc_index][:, None] + eth_costs[None, :]),
+                               liquidation.min(axis=2) if liquidation.shape[2] else np.full(feasible.shape, np.inf)],
+                              axis=2)[feasible]
+        indices = (btc_index[:, None] * len(eth_legs) + np.arange(len(eth_legs))[None, :])[feasible]
+
+        # top_k by min_pnl, ties going to the earlier combination like the other optimizers
+        for position in np.argsort(-objectives[:, 0], kind='stable')[:top_k]:
+            item = (objectives[position, 0], -indices[position], objectives[position])
+            if len(heap) < top_k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+        candidates = np.concatenate([front_objectives, objectives])
+        candidate_indices = np.concatenate([front_indices, indices])
+        front = pareto_front(np.round(candidates / resolution), candidate_indices)
+        front_objectives, front_indices = candidates[front], candidate_indices[front]
+
+        if progress is not None:
+            best = max(heap, key=lambda item: item[:2]) if heap else None
+            progress((btc_index[-1] + 1) * len(eth_legs), num_btc_legs * len(eth_legs),
+                     -1e9 if best is None else float(best[0]), None if best is None else -int(best[1]))
+
+    top = [(objectives, -negative_index) for _, negative_index, objectives in sorted(heap, key=lambda item: item[:2],
+                                                                                     reverse=True)]
+    return top, front_objectives, front_indices
+
+
+_shard_arguments = None
+
+
+def _init_shard_worker(*arguments):
+    # the leg matrices are shipped once per worker process instead of once per shard
+    global _shard_arguments
+    _shard_arguments = arguments
+
+
+def _best_leg_combination_shard(shard):
+    return best_leg_combination(*_shard_arguments, start=shard[0], stop=shard[1])
+
+
+def parallel_best_leg_combination(base, btc_calls, btc_puts, eth_legs, num_critical, workers, shards_per_worker=4,
+                                  progress=None):
+    # contiguous shards of the btc_call x btc_put rows, merged in shard order so ties resolve like the serial run
+    num_btc_legs = len(btc_calls) * len(btc_puts)
+    num_shards = min(num_btc_legs, workers * shards_per_worker)
+    bounds = [round(i * num_btc_legs / num_shards) for i in range(num_shards + 1)]
+    shards = list(zip(bounds[:-1], bounds[1:]))
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_shard_worker,
+                                   initargs=(base, btc_calls, btc_puts, eth_legs, num_critical))
+    try:
+        futures = {executor.submit(_best_leg_combination_shard, shard): shard_index
+                   for shard_index, shard in enumerate(shards)}
+        results = [None] * len(shards)
+        done = 0
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            done += (shards[futures[future]][1] - shards[futures[future]][0]) * len(eth_legs)
+            if progress is not None:
+                progress(done, num_btc_legs * len(eth_legs),
+                         *max((result for result in results if result is not None), key=lambda result: result[0]))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    best_result, best_btc_index, best_eth_index = -1e9, None, None
+    for result, btc_index, eth_index in results:
+        if result > best_result:
+            best_result, best_btc_index, best_eth_index = result, btc_index, eth_index
+    return best_result, best_btc_index, best_eth_index
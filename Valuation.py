@@ -0,0 +1,138 @@
+import math
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from scipy.special import ndtr
+
+from ETHQuantoFutures.MonteCarlo import implied_vol
+from ETHQuantoFutures.TradingUtil import eth_spot_layer, eth_quanto_futures_layer
+
+SECONDS_PER_DAY = 24 * 3600
+DAYS_PER_YEAR = 365
+
+
+def expiry_timestamp(expiry):
+    # Deribit options expire at 08:00 UTC of the day in their code (25JUN21)
+    return datetime.strptime(expiry, '%d%b%y').replace(hour=8, tzinfo=timezone.utc).timestamp()
+
+
+def black76(forward, strike, years, vol, is_call):
+    # undiscounted Black-76 value in USD per unit; Deribit options are on the future, rates are left out.
+    # Falls back to the intrinsic value at and after expiry (and for zero vol or forward)
+    forward, strike, years, vol = np.broadcast_arrays(*(np.asarray(value, dtype=float)
+                                                        for value in (forward, strike, years, vol)))
+    intrinsic = np.where(is_call, np.maximum(forward - strike, 0), np.maximum(strike - forward, 0))
+    std_dev = vol * np.sqrt(np.maximum(years, 0))
+    live = (std_dev > 0) & (forward > 0) & (strike > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = (np.log(forward / strike) + 0.5 * std_dev ** 2) / std_dev
+        d2 = d1 - std_dev
+        value = np.where(is_call, forward * ndtr(d1) - strike * ndtr(d2), strike * ndtr(-d2) - forward * ndtr(-d1))
+    return np.where(live, value, intrinsic)
+
+
+def chain_of(starting_parameters, underlying, is_call):
+    return getattr(starting_parameters, f"{underlying}_{'call' if is_call else 'put'}_options")
+
+
+def leg_quotes(starting_parameters, legs):
+    # (vol, expiry timestamp) of every leg, from the chain row of its strike and expiry; legs the chains do not
+    # quote get the chain's at-the-money vol and the chain's last expiry
+    vols, expiries = [], []
+    for underlying, is_call, strike, expiry, _, _ in legs.rows():
+        options = chain_of(starting_parameters, underlying, is_call)
+        index = options.find(strike, expiry)
+        row_vol = options[index].get('mark_iv') if index is not None else None
+        underlying_price = starting_parameters.eth_spot_start_price if underlying == 'eth' else \
+            starting_parameters.btc_start_price
+        vols.append(row_vol / 100 if row_vol else implied_vol(options, underlying_price, 0.8))
+        row_expiry = options.expiries[index] if index is not None else expiry
+        expiries.append(expiry_timestamp(row_expiry) if row_expiry else last_expiry(starting_parameters))
+    return np.array(vols, dtype=float), np.array(expiries, dtype=float)
+
+
+def last_expiry(starting_parameters, default_days=90):
+    expiries = {expiry for underlying in ('eth', 'btc') for is_call in (True, False)
+                for expiry in chain_of(starting_parameters, underlying, is_call).expiries if expiry}
+    if not expiries:
+        return valuation_start(starting_parameters) + default_days * SECONDS_PER_DAY
+    return max(expiry_timestamp(expiry) for expiry in expiries)
+
+
+def valuation_start(starting_parameters):
+    return starting_parameters.quoted_at or time.time()
+
+
+def horizon_days(starting_parameters):
+    # whole days from the quote to the last expiry of the chains
+    return max(0, math.ceil((last_expiry(starting_parameters) - valuation_start(starting_parameters)) / SECONDS_PER_DAY))
+
+
+class MarkToMarket:
+    # PnL of closing everything after a number of days, as a (day x ETH x BTC) tensor that is only computed one
+    # day slice at a time, on first access. Options are revalued with Black-76 at their quoted IV, and the futures
+    # premium moves linearly from the starting premium to the exit premium over the horizon; on the horizon day
+    # every leg expiring then is at its payoff, so that slice matches calculate_pnl_grid
+    def __init__(self, trade_setup, eth_prices, btc_prices, days=None):
+        starting_parameters = trade_setup.starting_parameters
+        self.eth_prices = np.asarray(eth_prices, dtype=float)
+        self.btc_prices = np.asarray(btc_prices, dtype=float)
+        self.start = valuation_start(starting_parameters)
+        self.horizon = horizon_days(starting_parameters)
+        self.days = np.arange(self.horizon + 1) if days is None else np.asarray(days, dtype=float)
+        self.legs = trade_setup.portfolio.leg_table
+        self.vols, expiries = leg_quotes(starting_parameters, self.legs)
+        self.expiry_days = (expiries - self.start) / SECONDS_PER_DAY
+        self.key = self.key_of(trade_setup)
+        self.start_premium = starting_parameters.eth_quanto_futures_start_price / starting_parameters.eth_spot_start_price - 1
+        self.exit_premium = trade_setup.exit_parameters.premium_exit
+        self.fixed_layers = (trade_setup.portfolio.eth_spot_amount, starting_parameters.eth_spot_start_price), \
+            (trade_setup.portfolio.eth_quanto_futures_contracts_shorted,
+             starting_parameters.eth_quanto_futures_start_price, starting_parameters.quanto_multiplier)
+        self.slices = {}
+
+    @staticmethod
+    def key_of(trade_setup):
+        # everything a tensor depends on, a tensor with a different key is stale
+        legs = trade_setup.portfolio.leg_table
+        vols, expiries = leg_quotes(trade_setup.starting_parameters, legs)
+        return trade_setup.fingerprint, tuple(vols.tolist()), tuple(expiries.tolist()), \
+            trade_setup.starting_parameters.quoted_at
+
+    @property
+    def shape(self):
+        return len(self.days), len(self.eth_prices), len(self.btc_prices)
+
+    def premium_at(self, day):
+        if not self.horizon:
+            return self.exit_premium
+        return self.start_premium + (self.exit_premium - self.start_premium) * min(day / self.horizon, 1)
+
+    def premium_slope(self, day):
+        # change of premium_at per day
+        if not self.horizon or day >= self.horizon:
+            return 0
+        return (self.exit_premium - self.start_premium) / self.horizon
+
+    def pnl_at(self, day):
+        # one (ETH x BTC) slice for any day, not only the ones on the axis
+        eth_exit_prices = self.eth_prices[:, None]
+        btc_exit_prices = self.btc_prices[None, :]
+        spot, futures = self.fixed_layers
+        pnl = eth_spot_layer(eth_exit_prices, btc_exit_prices, *spot) + \
+            eth_quanto_futures_layer(eth_exit_prices, btc_exit_prices, *futures, self.premium_at(day))
+        if len(self.legs):
+            forwards = np.where(self.legs.underlying == 'eth', eth_exit_prices[..., None], btc_exit_prices[..., None])
+            values = black76(forwards, self.legs.strike, (self.expiry_days - day) / DAYS_PER_YEAR, self.vols,
+                             self.legs.is_call)
+            pnl = pnl + (self.legs.amount * values - self.legs.amount * self.legs.premium).sum(axis=-1)
+        return pnl
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = range(len(self.days))[index]
+            if index not in self.slices:
+                self.slices[index] = self.pnl_at(float(self.days[index]))
+            return self.slices[index]
+        return np.stack([self[int(i)] for i in np.arange(len(self.days))[index]])
@@ -1,13 +1,41 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 import dash
-import numpy as np
+import flask
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
-from ETHQuantoFutures.TradingUtil import TradeSetup
-
-n_clicks_optimize = 0
+from ETHQuantoFutures.TradingUtil import TradeSetup, StartingPrices, PnlSurface, WarmStart
+from ETHQuantoFutures.Snapshots import MarketSnapshot, PRICE_FIELDS, CHAIN_FIELDS
+from ETHQuantoFutures.Streaming import PriceStream
+from ETHQuantoFutures.Jobs import JobManager
+from ETHQuantoFutures.Sessions import SessionStore, new_session_id
+from ETHQuantoFutures.Valuation import MarkToMarket, expiry_timestamp, horizon_days
+from ETHQuantoFutures.Sensitivity import position_greeks
+from ETHQuantoFutures.Metrics import metrics, profiler
+
+# every browser session has its own TradeSetup in the session store, this one only fills the initial layout
 trade_setup = TradeSetup()
+sessions = SessionStore(directory=os.environ.get("QUANTO_SESSION_DIR"))
+# with a shared session directory the jobs publish their progress and results there, for every worker process
+optimization_jobs = JobManager(store=sessions if sessions.directory else None)
+
+# one shared price stream feeds every session that has live prices switched on
+live_prices = StartingPrices()
+live_sessions = set()
+price_stream = None
+price_stream_lock = threading.Lock()
+
+pnl_surfaces = OrderedDict()
+pnl_surfaces_lock = threading.Lock()
+MAX_PNL_SURFACES = 100
+mark_to_market_tensors = OrderedDict()
+# the last optimization of every session, so that optimizing again on fresher quotes only redoes what changed
+warm_starts = OrderedDict()
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash("Shorting Ethereum quanto futures contracts on BitMEX", external_stylesheets=[dbc.themes.BOOTSTRAP])
@@ -23,6 +51,11 @@ row_starting_prices = html.Div([
             )], width={"order": "first"}),
         dbc.Col([
             html.Button('Query exchanges', id="query-btn")
+        ]),
+        dbc.Col([
+            dcc.Checklist(id="live-toggle", options=[{'label': ' Live prices', 'value': 'live'}], value=[]),
+            dcc.Interval(id="live-interval", interval=2000, disabled=True),
+            html.P(id="live-prices", children="")
         ])
     ], align="center")
 ])
@@ -162,44 +195,123 @@ row_eth_puts = html.Div([
     ])
 ])
 
-app.layout = dbc.Container(children=[
-    row_starting_prices,
-    html.Br(),
-    row_bitcon_amount,
-    html.Br(),
-    row_eth_quanto_amount,
-    html.Br(),
-    row_eth_spot_amount,
-    html.Br(),
-    html.Button('Optimize options', id="optimize-btn"),
-    dcc.Loading(
-        id="loading-optimize",
-        fullscreen=True,
-        children=html.P(children="", id="optimize-output", style=dict(display='none'))
-    ),
-    html.Br(),
-    row_btc_calls,
-    html.Br(),
-    row_eth_calls,
-    html.Br(),
-    row_btc_puts,
-    html.Br(),
-    row_eth_puts,
-    html.Br(),
-    html.P("Premium left when closing positions, expressed in percentage"),
-    dcc.Slider(
-        id='prem-left-close-slider',
-        min=0,
-        max=100,
-        step=0.1,
-        value=0,
-        tooltip=dict(always_visible=False)
-    ),
-    dcc.Loading(
-        id="loading-figure",
-        children=dcc.Graph(id="graph")
-    )
-])
+
+def serve_layout():
+    return dbc.Container(children=[
+        dcc.Store(id="session-id", data=new_session_id()),
+        row_starting_prices,
+        html.Br(),
+        row_bitcon_amount,
+        html.Br(),
+        row_eth_quanto_amount,
+        html.Br(),
+        row_eth_spot_amount,
+        html.Br(),
+        html.Button('Optimize options', id="optimize-btn"),
+        html.Button('Cancel optimization', id="optimize-cancel-btn"),
+        html.Button('Use best so far', id="optimize-best-btn"),
+        html.P(id="optimize-progress", children=""),
+        dcc.Interval(id="optimize-interval", interval=1000, disabled=True),
+        dcc.Loading(
+            id="loading-optimize",
+            fullscreen=True,
+            children=html.P(children="", id="optimize-output", style=dict(display='none'))
+        ),
+        html.Br(),
+        row_btc_calls,
+        html.Br(),
+        row_eth_calls,
+        html.Br(),
+        row_btc_puts,
+        html.Br(),
+        row_eth_puts,
+        html.Br(),
+        html.P("Premium left when closing positions, expressed in percentage"),
+        dcc.Slider(
+            id='prem-left-close-slider',
+            min=0,
+            max=100,
+            step=0.1,
+            value=0,
+            tooltip=dict(always_visible=False)
+        ),
+        html.P("Days after the start when closing positions, the last day is the last option expiry"),
+        dcc.Slider(
+            id='close-day-slider',
+            min=0,
+            max=horizon_days(trade_setup.starting_parameters),
+            step=1,
+            value=horizon_days(trade_setup.starting_parameters),
+            tooltip=dict(always_visible=False)
+        ),
+        dcc.Dropdown(
+            id='greek-overlay',
+            options=[{'label': 'No greeks overlay', 'value': ''},
+                     {'label': 'ETH delta [USD per USD]', 'value': 'eth_delta'},
+                     {'label': 'BTC delta [USD per USD]', 'value': 'btc_delta'},
+                     {'label': 'ETH gamma', 'value': 'eth_gamma'},
+                     {'label': 'BTC gamma', 'value': 'btc_gamma'},
+                     {'label': 'ETH x BTC cross gamma', 'value': 'cross_gamma'},
+                     {'label': 'Vega [USD per vol point]', 'value': 'vega'},
+                     {'label': 'Theta [USD per day]', 'value': 'theta'}],
+            value='',
+            clearable=False
+        ),
+        dcc.Loading(
+            id="loading-figure",
+            children=dcc.Graph(id="graph")
+        )
+    ])
+
+
+app.layout = serve_layout
+
+
+def timed_callback(function):
+    # times and counts every call of a callback as callback.<name>
+    return metrics.timed(f"callback.{function.__name__}")(function)
+
+
+# METRICS: JSON by default, ?format=prometheus for scraping, /metrics/profiles for the last request profiles
+@app.server.route('/metrics')
+def serve_metrics():
+    if flask.request.args.get('format') == 'prometheus':
+        return flask.Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+    return flask.jsonify(metrics.snapshot())
+
+
+@app.server.route('/metrics/profiles')
+def serve_profiles():
+    return flask.jsonify(enabled=profiler.enabled, profiles=list(profiler.recent))
+
+
+# a request with ?profile=1, an X-Quanto-Profile header or a quanto_profile cookie runs under cProfile when
+# QUANTO_PROFILE_DIR is set; the cookie is how the callbacks of a whole browser session get profiled
+@app.server.before_request
+def start_profile():
+    request = flask.request
+    if not profiler.enabled or not (request.args.get('profile') or request.headers.get('X-Quanto-Profile') or
+                                    request.cookies.get('quanto_profile')):
+        return
+    # callbacks all share one URL, the output they update tells them apart
+    body = request.get_json(silent=True) if request.is_json else None
+    name = body.get('output', request.path) if isinstance(body, dict) else request.path
+    flask.g.profile = profiler.profile(name)
+    flask.g.profile_path = flask.g.profile.__enter__()
+
+
+@app.server.teardown_request
+def stop_profile(error):
+    profile = flask.g.pop('profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+
+
+@app.server.after_request
+def add_profile_header(response):
+    if flask.g.get('profile_path'):
+        response.headers['X-Quanto-Profile-Path'] = flask.g.profile_path
+    return response
 
 
 # QUERY BUTTON -> STARTING PRICES TEXT
@@ -220,49 +332,88 @@ app.layout = dbc.Container(children=[
         dash.dependencies.Output('amount-btc-calls-inp', 'value'),
         dash.dependencies.Output('amount-eth-calls-inp', 'value'),
         dash.dependencies.Output('amount-btc-puts-inp', 'value'),
-        dash.dependencies.Output('amount-eth-puts-inp', 'value')
+        dash.dependencies.Output('amount-eth-puts-inp', 'value'),
+        dash.dependencies.Output('close-day-slider', 'max'),
+        dash.dependencies.Output('close-day-slider', 'value')
     ],
     [dash.dependencies.Input('query-btn', 'n_clicks'),
-     dash.dependencies.Input('optimize-output', 'children')])
-def on_query(_, hidden_text):
-    global n_clicks_optimize
-    if str(n_clicks_optimize + 1) == hidden_text:
-        n_clicks_optimize += 1
-    else:
-        trade_setup.starting_parameters.query()
-        trade_setup.set_default_state()
-    prices = [op['strike'] for op in trade_setup.starting_parameters.btc_call_options]
-    prices.sort()
-    btc_calls = [{'label': pr, 'value': pr} for pr in prices]
-    prices = [op['strike'] for op in trade_setup.starting_parameters.eth_call_options]
-    prices.sort()
-    eth_calls = [{'label': pr, 'value': pr} for pr in prices]
-    prices = [op['strike'] for op in trade_setup.starting_parameters.btc_put_options]
-    prices.sort()
-    btc_puts = [{'label': pr, 'value': pr} for pr in prices]
-    prices = [op['strike'] for op in trade_setup.starting_parameters.eth_put_options]
-    prices.sort()
-    eth_puts = [{'label': pr, 'value': pr} for pr in prices]
+     dash.dependencies.Input('optimize-output', 'children')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def on_query(_, hidden_text, session_id):
+    with sessions.edit(session_id) as session:
+        trade_setup = session.trade_setup
+        if str(session.n_clicks_optimize + 1) == hidden_text:
+            session.n_clicks_optimize += 1
+        else:
+            trade_setup.starting_parameters.query()
+            trade_setup.set_default_state()
+    btc_calls = strike_options(trade_setup.starting_parameters.btc_call_options)
+    eth_calls = strike_options(trade_setup.starting_parameters.eth_call_options)
+    btc_puts = strike_options(trade_setup.starting_parameters.btc_put_options)
+    eth_puts = strike_options(trade_setup.starting_parameters.eth_put_options)
+    # the dropdowns select instruments, the same strike can be there once per expiry
+    btc_calls_name, btc_puts_name, eth_calls_name, eth_puts_name = trade_setup.leg_instrument_names()[:4]
     return trade_setup.starting_parameters.html_summary, \
         btc_calls, eth_calls, btc_puts, eth_puts, \
-        trade_setup.portfolio.btc_calls_strike, trade_setup.portfolio.eth_calls_strike, \
-        trade_setup.portfolio.btc_puts_strike, trade_setup.portfolio.eth_puts_strike, \
+        btc_calls_name, eth_calls_name, btc_puts_name, eth_puts_name, \
         trade_setup.portfolio.btc_amount_bitmex, \
         trade_setup.portfolio.eth_spot_amount, \
         trade_setup.portfolio.eth_quanto_futures_contracts_shorted, \
         trade_setup.portfolio.btc_calls_amount, trade_setup.portfolio.eth_calls_amount, \
-        trade_setup.portfolio.btc_puts_amount, trade_setup.portfolio.eth_puts_amount
+        trade_setup.portfolio.btc_puts_amount, trade_setup.portfolio.eth_puts_amount, \
+        horizon_days(trade_setup.starting_parameters), horizon_days(trade_setup.starting_parameters)
+
 
+def strike_options(options):
+    # dropdown options by strike and expiry, valued by instrument name
+    strikes, expiries = options.strikes.tolist(), options.expiries
+    rows = sorted(range(len(options)), key=lambda index: (strikes[index],
+                                                          expiry_timestamp(expiries[index]) if expiries[index] else 0))
+    return [{'label': f"{strikes[index]:g} · {expiries[index]}" if expiries[index] else strikes[index],
+             'value': options.instrument_names[index]} for index in rows]
 
-# OPTIMIZE BUTTON -> OPTIONS INPUTS
+
+# OPTIMIZE BUTTONS / PROGRESS POLLING -> OPTIONS INPUTS
 @app.callback(
-    dash.dependencies.Output('optimize-output', 'children'),    # this is a loading component
-    [dash.dependencies.Input('optimize-btn', 'n_clicks')])
-def on_optimize(n_clicks):
-    if n_clicks is not None:
-        trade_setup.set_optimal_state()
-        return f"{n_clicks}"
-    return "init"
+    [dash.dependencies.Output('optimize-output', 'children'),    # this is a loading component
+     dash.dependencies.Output('optimize-progress', 'children'),
+     dash.dependencies.Output('optimize-interval', 'disabled')],
+    [dash.dependencies.Input('optimize-btn', 'n_clicks'),
+     dash.dependencies.Input('optimize-cancel-btn', 'n_clicks'),
+     dash.dependencies.Input('optimize-best-btn', 'n_clicks'),
+     dash.dependencies.Input('optimize-interval', 'n_intervals')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def on_optimize(n_clicks, n_clicks_cancel, n_clicks_best, n_intervals, session_id):
+    # the search runs as a background job, this callback only starts, cancels and polls it; the hidden output
+    # is bumped whenever a (partial) result is applied, which makes on_query refresh the inputs
+    if n_clicks is None:
+        return "init", "", True
+    trigger = dash.callback_context.triggered[0]['prop_id']
+    with sessions.edit(session_id) as session:
+        job = optimization_jobs.get(session.optimization_job_id) if session.optimization_job_id else None
+
+        if trigger == 'optimize-btn.n_clicks' and (job is None or job.finished):
+            job = optimization_jobs.submit(session.trade_setup, method='incremental',
+                                           warm_start=warm_start(session_id))
+            session.optimization_job_id = job.id
+            return dash.no_update, f"Optimization {job.id} started", False
+        if job is None:
+            return dash.no_update, "", True
+        if trigger == 'optimize-cancel-btn.n_clicks':
+            optimization_jobs.cancel(job.id)
+        elif trigger == 'optimize-best-btn.n_clicks' and job.best_so_far:
+            session.trade_setup.portfolio.set_eth_contracts_to_short(job.portfolio['eth_quanto_futures_contracts_shorted'])
+            session.trade_setup.portfolio.set_eth_spot_amount(job.portfolio['eth_spot_amount'])
+            session.trade_setup.apply_optimal(job.best_so_far)
+            return f"{session.n_clicks_optimize + 1}", job.summary, job.finished
+        elif job.status == 'done':
+            session.optimization_job_id = None
+            session.trade_setup.set_portfolio_state(job.portfolio)
+            optimization_jobs.forget(job.id)
+            return f"{session.n_clicks_optimize + 1}", job.summary, True
+        return dash.no_update, job.summary, job.finished
 
 
 # ANY TEXT FIELD -> GRAPH
@@ -276,53 +427,174 @@ def on_optimize(n_clicks):
      dash.dependencies.Input('eth-calls-txt', 'children'),
      dash.dependencies.Input('btc-puts-txt', 'children'),
      dash.dependencies.Input('eth-puts-txt', 'children'),
-     dash.dependencies.Input('prem-left-close-slider', 'value')])
-def update_graph_on_any_param_change(txt0, txt1, txt2, txt3, txt4, txt5, txt6, txt7, prem_left):
-    trade_setup.set_exit_premium(prem_left / 100)
-    return build_plot()
+     dash.dependencies.Input('prem-left-close-slider', 'value'),
+     dash.dependencies.Input('close-day-slider', 'value'),
+     dash.dependencies.Input('greek-overlay', 'value'),
+     dash.dependencies.Input('live-interval', 'n_intervals')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def update_graph_on_any_param_change(txt0, txt1, txt2, txt3, txt4, txt5, txt6, txt7, prem_left, close_day, greek,
+                                     n_intervals, session_id):
+    with sessions.edit(session_id) as session:
+        if dash.callback_context.triggered[0]['prop_id'] == 'live-interval.n_intervals':
+            if session.live and session_id not in live_sessions:
+                join_live_stream(session_id, session.trade_setup.starting_parameters)
+            stream = price_stream
+            if stream is None or session.stream_version == stream.version:
+                return dash.no_update
+            with stream.lock:
+                session.stream_version = stream.version
+                apply_live_prices(session.trade_setup)
+            session.trade_setup.refresh_premiums()
+        session.trade_setup.set_exit_premium(prem_left / 100)
+        # one user action fans out into several text callbacks that all feed this one, only the first of them
+        # sees a new portfolio state, the rest are dropped here
+        fingerprint = figure_fingerprint(session.trade_setup, close_day, greek)
+        if fingerprint == session.figure_fingerprint:
+            return dash.no_update
+        session.figure_fingerprint = fingerprint
+        return build_plot(session.trade_setup, session_id, close_day, greek)
+
+
+def figure_fingerprint(trade_setup, close_day, greek):
+    # the PnL at expiry only depends on the TradeSetup fingerprint; marked-to-market days and greeks also on the
+    # IVs and the quote time, which MarkToMarket.key_of adds
+    if greek or (close_day is not None and close_day < horizon_days(trade_setup.starting_parameters)):
+        key = MarkToMarket.key_of(trade_setup)
+    else:
+        key = trade_setup.fingerprint
+    return hashlib.sha1(repr((key, close_day, greek)).encode()).hexdigest()
+
+
+def apply_live_prices(trade_setup):
+    # the streamed prices and the streamed quotes of the options the session holds; its chains, strikes and
+    # expiries stay the ones it queried
+    starting_parameters = trade_setup.starting_parameters
+    for field in PRICE_FIELDS:
+        setattr(starting_parameters, field, getattr(live_prices, field))
+    held = set(trade_setup.leg_instrument_names())
+    for field in CHAIN_FIELDS:
+        getattr(starting_parameters, field).update_quotes(getattr(live_prices, field), held)
+
+
+def missing_live_options(starting_parameters):
+    # the session's options the stream does not subscribe to yet, by chain
+    missing = {field: getattr(live_prices, field).missing_from(getattr(starting_parameters, field))
+               for field in CHAIN_FIELDS}
+    return {field: chain for field, chain in missing.items() if len(chain)}
+
+
+# LIVE TOGGLE -> PRICE STREAM
+@app.callback(
+    dash.dependencies.Output('live-interval', 'disabled'),
+    [dash.dependencies.Input('live-toggle', 'value')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def on_live_toggle(live, session_id):
+    with sessions.edit(session_id) as session:
+        session.live = 'live' in live
+        if session.live:
+            join_live_stream(session_id, session.trade_setup.starting_parameters)
+            return False
+        leave_live_stream(session_id)
+        return True
+
+
+def join_live_stream(session_id, starting_parameters):
+    # every worker process runs its own stream for the live sessions it serves, a session whose ticks land on
+    # another worker than its toggle joins that worker's stream on the first one
+    global price_stream
+    with price_stream_lock:
+        if price_stream is None:
+            MarketSnapshot.from_starting_prices(starting_parameters).apply(live_prices)
+            price_stream = PriceStream(live_prices)
+            price_stream.start()
+        else:
+            missing = missing_live_options(starting_parameters)
+            if missing:
+                # the stream subscribes to the options of every live session, which it only does when it starts
+                price_stream.stop()
+                for field, chain in missing.items():
+                    setattr(live_prices, field, getattr(live_prices, field) + chain)
+                version = price_stream.version
+                price_stream = PriceStream(live_prices)
+                price_stream.version = version + 1
+                price_stream.start()
+        live_sessions.add(session_id)
+
+
+def leave_live_stream(session_id):
+    global price_stream
+    with price_stream_lock:
+        live_sessions.discard(session_id)
+        if price_stream is not None and not live_sessions:
+            price_stream.stop()
+            price_stream = None
+
+
+# LIVE INTERVAL -> LIVE PRICES TEXT
+@app.callback(
+    dash.dependencies.Output('live-prices', 'children'),
+    [dash.dependencies.Input('live-interval', 'n_intervals')])
+@timed_callback
+def update_live_prices(n_intervals):
+    if price_stream is None:
+        return ""
+    return [f"Live: BTC {live_prices.btc_start_price}",
+            f" · ETH spot {live_prices.eth_spot_start_price}",
+            f" · ETH quanto {live_prices.eth_quanto_futures_start_price}"]
 
 
 # BTC AMOUNT INPUT -> BTC AMOUNT TEXT
 @app.callback(
     dash.dependencies.Output('amount-btc-txt', 'children'),
-    dash.dependencies.Input('amount-btc-inp', 'value'))
-def update_amount_btc(amount_btc):
-    trade_setup.portfolio.set_btc_amount_bitmex(amount_btc)
-    return f"[BTC] : Bitcoin held on BitMEX (fully hedged to synthetic USD) · {trade_setup.bitmex_starting_value} USD as investment"
+    dash.dependencies.Input('amount-btc-inp', 'value'),
+    dash.dependencies.State('session-id', 'data'))
+@timed_callback
+def update_amount_btc(amount_btc, session_id):
+    with sessions.edit(session_id) as session:
+        session.trade_setup.portfolio.set_btc_amount_bitmex(amount_btc)
+    return f"[BTC] : Bitcoin held on BitMEX (fully hedged to synthetic USD) · {session.trade_setup.bitmex_starting_value} USD as investment"
 
 
 # ETH AMOUNT INPUT -> ETH AMOUNT TEXT
 @app.callback(
     dash.dependencies.Output('amount-eth-spot-txt', 'children'),
-    dash.dependencies.Input('amount-eth-spot-inp', 'value'))
-def update_amount_eth_spot(amount_eth_spot):
-    trade_setup.portfolio.set_eth_spot_amount(amount_eth_spot)
-    return f"[ETH] : Ethereum held as spot · {trade_setup.eth_spot_value} USD as investment"
+    dash.dependencies.Input('amount-eth-spot-inp', 'value'),
+    dash.dependencies.State('session-id', 'data'))
+@timed_callback
+def update_amount_eth_spot(amount_eth_spot, session_id):
+    with sessions.edit(session_id) as session:
+        session.trade_setup.portfolio.set_eth_spot_amount(amount_eth_spot)
+    return f"[ETH] : Ethereum held as spot · {session.trade_setup.eth_spot_value} USD as investment"
 
 
 # ETH CONTRACTS INPUT -> ETH CONTRACTS TEXT
 @app.callback(
     dash.dependencies.Output('amount-eth-contracts-txt', 'children'),
-    dash.dependencies.Input('amount-eth-contracts-inp', 'value'))
-def update_amount_eth_contracts(amount_eth_contracts):
-    trade_setup.portfolio.set_eth_contracts_to_short(amount_eth_contracts)
+    dash.dependencies.Input('amount-eth-contracts-inp', 'value'),
+    dash.dependencies.State('session-id', 'data'))
+@timed_callback
+def update_amount_eth_contracts(amount_eth_contracts, session_id):
+    with sessions.edit(session_id) as session:
+        session.trade_setup.portfolio.set_eth_contracts_to_short(amount_eth_contracts)
     return f"[contracts] : Ethereum quanto futures contracts shorted on BitMEX" \
-           f" · {trade_setup.eth_quanto_futures_btc_value} BTC in value" \
-           f" · {trade_setup.eth_quanto_futures_value} USD in value"
+           f" · {session.trade_setup.eth_quanto_futures_btc_value} BTC in value" \
+           f" · {session.trade_setup.eth_quanto_futures_value} USD in value"
 
 
 # ETH CALLS INPUT -> ETH CALLS TEXT
 @app.callback(
     dash.dependencies.Output('eth-calls-txt', 'children'),
     [dash.dependencies.Input('amount-eth-calls-inp', 'value'),
-     dash.dependencies.Input('strike-eth-calls', 'value')])
-def update_amount_eth_calls(amount_eth_calls, strike_eth_calls):
-    trade_setup.portfolio.eth_calls_amount = amount_eth_calls
-    for call in trade_setup.starting_parameters.eth_call_options:
-        if call['strike'] == strike_eth_calls:
-            trade_setup.portfolio.eth_calls_premium = call['underlying_price'] * call['best_ask_price']
-            trade_setup.portfolio.eth_calls_strike = call['strike']
-            break
+     dash.dependencies.Input('strike-eth-calls', 'value')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def update_amount_eth_calls(amount_eth_calls, strike_eth_calls, session_id):
+    with sessions.edit(session_id) as session:
+        trade_setup = session.trade_setup
+        trade_setup.portfolio.eth_calls_amount = amount_eth_calls
+        trade_setup.select_option('eth_calls', strike_eth_calls)
     return f"[ETH] : Ethereum call options to buy on Deribit with the specified strike price. "\
            f"Cost is {trade_setup.portfolio.cost_of_eth_calls}"
 
@@ -331,14 +603,14 @@ def update_amount_eth_calls(amount_eth_calls, strike_eth_calls):
 @app.callback(
     dash.dependencies.Output('btc-calls-txt', 'children'),
     [dash.dependencies.Input('amount-btc-calls-inp', 'value'),
-     dash.dependencies.Input('strike-btc-calls', 'value')])
-def update_amount_btc_calls(amount_btc_calls, strike_btc_calls):
-    trade_setup.portfolio.btc_calls_amount = amount_btc_calls
-    for call in trade_setup.starting_parameters.btc_call_options:
-        if call['strike'] == strike_btc_calls:
-            trade_setup.portfolio.btc_calls_premium = call['underlying_price'] * call['best_ask_price']
-            trade_setup.portfolio.btc_calls_strike = call['strike']
-            break
+     dash.dependencies.Input('strike-btc-calls', 'value')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def update_amount_btc_calls(amount_btc_calls, strike_btc_calls, session_id):
+    with sessions.edit(session_id) as session:
+        trade_setup = session.trade_setup
+        trade_setup.portfolio.btc_calls_amount = amount_btc_calls
+        trade_setup.select_option('btc_calls', strike_btc_calls)
     return f"[BTC] : Bitcoin call options to buy on Deribit with the specified strike price. "\
            f"Cost is {trade_setup.portfolio.cost_of_btc_calls}"
 
@@ -347,14 +619,14 @@ def update_amount_btc_calls(amount_btc_calls, strike_btc_calls):
 @app.callback(
     dash.dependencies.Output('eth-puts-txt', 'children'),
     [dash.dependencies.Input('amount-eth-puts-inp', 'value'),
-     dash.dependencies.Input('strike-eth-puts', 'value')])
-def update_amount_eth_puts(amount_eth_puts, strike_eth_puts):
-    trade_setup.portfolio.eth_puts_amount = amount_eth_puts
-    for put in trade_setup.starting_parameters.eth_put_options:
-        if put['strike'] == strike_eth_puts:
-            trade_setup.portfolio.eth_puts_premium = put['underlying_price'] * put['best_ask_price']
-            trade_setup.portfolio.eth_puts_strike = put['strike']
-            break
+     dash.dependencies.Input('strike-eth-puts', 'value')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def update_amount_eth_puts(amount_eth_puts, strike_eth_puts, session_id):
+    with sessions.edit(session_id) as session:
+        trade_setup = session.trade_setup
+        trade_setup.portfolio.eth_puts_amount = amount_eth_puts
+        trade_setup.select_option('eth_puts', strike_eth_puts)
     return f"[ETH] : Ethereum put options to buy on Deribit with the specified strike price. "\
            f"Cost is {trade_setup.portfolio.cost_of_eth_puts}"
 
@@ -363,28 +635,74 @@ def update_amount_eth_puts(amount_eth_puts, strike_eth_puts):
 @app.callback(
     dash.dependencies.Output('btc-puts-txt', 'children'),
     [dash.dependencies.Input('amount-btc-puts-inp', 'value'),
-     dash.dependencies.Input('strike-btc-puts', 'value')])
-def update_amount_btc_puts(amount_btc_puts, strike_btc_puts):
-    trade_setup.portfolio.btc_puts_amount = amount_btc_puts
-    for put in trade_setup.starting_parameters.btc_put_options:
-        if put['strike'] == strike_btc_puts:
-            trade_setup.portfolio.btc_puts_premium = put['underlying_price'] * put['best_ask_price']
-            trade_setup.portfolio.btc_puts_strike = put['strike']
-            break
+     dash.dependencies.Input('strike-btc-puts', 'value')],
+    [dash.dependencies.State('session-id', 'data')])
+@timed_callback
+def update_amount_btc_puts(amount_btc_puts, strike_btc_puts, session_id):
+    with sessions.edit(session_id) as session:
+        trade_setup = session.trade_setup
+        trade_setup.portfolio.btc_puts_amount = amount_btc_puts
+        trade_setup.select_option('btc_puts', strike_btc_puts)
     return f"[BTC] : Bitcoin put options to buy on Deribit with the specified strike price. "\
            f"Cost is {trade_setup.portfolio.cost_of_btc_puts}"
 
 
-def build_plot(resolution=100, btc_max=200000, eth_max=10000):
+def pnl_surface(session_id, eth_prices, btc_prices, grid):
+    key = (session_id,) + grid
+    with pnl_surfaces_lock:
+        surface = pnl_surfaces.get(key)
+        if surface is None:
+            surface = pnl_surfaces[key] = PnlSurface(eth_prices, btc_prices)
+            while len(pnl_surfaces) > MAX_PNL_SURFACES:
+                pnl_surfaces.popitem(last=False)
+        pnl_surfaces.move_to_end(key)
+    return surface
+
+
+def warm_start(session_id):
+    with pnl_surfaces_lock:
+        state = warm_starts.get(session_id)
+        if state is None:
+            state = warm_starts[session_id] = WarmStart()
+            while len(warm_starts) > MAX_PNL_SURFACES:
+                warm_starts.popitem(last=False)
+        warm_starts.move_to_end(session_id)
+    return state
+
+
+def mark_to_market(session_id, trade_setup, eth_prices, btc_prices, grid):
+    # one lazily filled (day x ETH x BTC) tensor per session and grid, rebuilt when anything it depends on changed
+    key = (session_id,) + grid
+    valuation_key = MarkToMarket.key_of(trade_setup)
+    with pnl_surfaces_lock:
+        tensor = mark_to_market_tensors.get(key)
+    if tensor is None or tensor.key != valuation_key:
+        tensor = MarkToMarket(trade_setup, eth_prices, btc_prices)
+    with pnl_surfaces_lock:
+        mark_to_market_tensors[key] = tensor
+        mark_to_market_tensors.move_to_end(key)
+        while len(mark_to_market_tensors) > MAX_PNL_SURFACES:
+            mark_to_market_tensors.popitem(last=False)
+    return tensor
+
+
+@metrics.timed("build_plot")
+def build_plot(trade_setup, session_id=None, close_day=None, greek=None, resolution=100, btc_max=200000,
+               eth_max=10000):
+    # close_day None (or the last day) shows the PnL at expiry, earlier days the marked-to-market PnL;
+    # greek (one of Sensitivity.GREEKS) is drawn as contour lines over it, for the same day
     eth_prices = [i * eth_max / resolution for i in range(0, resolution + 1)]
     btc_prices = [i * btc_max / resolution for i in range(0, resolution + 1)]
-    liq_prices = [trade_setup.calculate_bitmex_eth_liq_price(btc_prices[i]) for i in range(0, resolution + 1)]
-
-    pnl_table = np.zeros((resolution + 1, resolution + 1))
-    for eth_index in range(resolution + 1):
-        for btc_index in range(resolution + 1):
-            trade_setup.set_exit_prices(eth_prices[eth_index], btc_prices[btc_index])
-            pnl_table[eth_index, btc_index] = trade_setup.calculate_pnl()
+    grid = (resolution, btc_max, eth_max)
+    surface = pnl_surface(session_id, eth_prices, btc_prices, grid)
+    surface.refresh(trade_setup)
+    liq_prices = surface.liq_prices
+    horizon = horizon_days(trade_setup.starting_parameters)
+    if close_day is None or close_day >= horizon:
+        close_day = horizon
+        pnl_table = surface.pnl_table
+    else:
+        pnl_table = mark_to_market(session_id, trade_setup, eth_prices, btc_prices, grid)[int(close_day)]
 
     fig = go.Figure(data=go.Contour(z=pnl_table, x=btc_prices, y=eth_prices,
                                     contours=dict(
@@ -393,6 +711,11 @@ def build_plot(resolution=100, btc_max=200000, eth_max=10000):
                                         size=trade_setup.bitmex_starting_value),
                                     contours_coloring='heatmap'),
                     layout=dict(height=1000))
+    if greek:
+        greeks = position_greeks(mark_to_market(session_id, trade_setup, eth_prices, btc_prices, grid), close_day)
+        fig.add_trace(go.Contour(z=greeks[greek], x=btc_prices, y=eth_prices, name=greek,
+                                 contours=dict(coloring='lines', showlabels=True),
+                                 colorscale=[[0, 'black'], [1, 'black']], showscale=False, line=dict(width=1)))
 
     fig.add_trace(go.Scatter(x=[trade_setup.starting_parameters.btc_start_price, trade_setup.starting_parameters.btc_start_price,],
                              y=[eth_prices[0], eth_prices[-1]],
@@ -0,0 +1,120 @@
+import argparse
+import gzip
+import json
+import math
+import os
+import random
+import time
+from urllib.parse import urlencode
+
+from ETHQuantoFutures.MarketData import MarketDataClient
+from ETHQuantoFutures.TradingUtil import StartingPrices
+from ETHQuantoFutures.Valuation import SECONDS_PER_DAY, black76, expiry_timestamp
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_SIZES = {'small': 3, 'medium': 8, 'large': 14}
+# fixtures also keep when they were quoted, replaying them at another time would change their time to expiry
+QUOTED_AT_KEY = "quoted_at"
+SYNTHETIC_QUOTED_AT = expiry_timestamp("25JUN21") - 45 * SECONDS_PER_DAY
+
+
+def request_key(path, params):
+    # fixtures map "path?sorted query" to the exchange's JSON answer, the way the stand-in sees the request
+    return f"{path}?{urlencode(sorted((key, str(value)) for key, value in params.items()))}"
+
+
+class RecordingMarketDataClient(MarketDataClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.responses = {}
+
+    def get_many(self, calls):
+        results = super().get_many(calls)
+        for (_, path, params), result in zip(calls, results):
+            self.responses[request_key(path, params)] = result
+        return results
+
+
+def record_fixture(path):
+    # one bulk and one per-ticker query against the real exchanges, saved in the fixture format
+    market_data = RecordingMarketDataClient()
+    starting_prices = StartingPrices()
+    starting_prices.query_exchanges(market_data, bulk=True)
+    StartingPrices().query_exchanges(market_data, bulk=False)
+    save_fixture(path, dict(market_data.responses, **{QUOTED_AT_KEY: starting_prices.quoted_at}))
+
+
+def save_fixture(path, responses):
+    with gzip.open(path, 'wt') as f:
+        json.dump(responses, f, separators=(',', ':'))
+
+
+def load_fixture(path):
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURE_DIR, f"{name}.json.gz")
+
+
+def synthetic_responses(num_strikes, seed=0, btc_price=55000.0, eth_spot_price=1700.0, eth_quanto_price=1850.5):
+    # exchange answers shaped like recorded ones: num_strikes strikes per chain that pass the StartingPrices filters,
+    # plus a second expiry and out-of-range strikes that it has to drop. Asks are Black-76 values with a smile
+    # and a random spread, for a quote taken 45 days before expiry (SYNTHETIC_QUOTED_AT)
+    rng = random.Random(seed)
+    years = 45 / 365
+    responses = {
+        QUOTED_AT_KEY: SYNTHETIC_QUOTED_AT,
+        request_key("/api/v1/quote", dict(symbol="XBTUSD", count=1, reverse="true")): [{'bidPrice': btc_price}],
+        request_key("/api/v1/quote", dict(symbol="ETHUSDM21", count=1, reverse="true")): [{'bidPrice': eth_quanto_price}],
+        request_key("/api/v3/ticker/price", dict(symbol="ETHUSDT")): {'symbol': "ETHUSDT", 'price': f"{eth_spot_price:.2f}"},
+    }
+    # strikes step away from the money, the first ones being those that can make the cant_lose points
+    chains = {
+        'BTC': (btc_price * 1.01, [(True, 71000 + 4000 * i) for i in range(num_strikes)] +
+                [(False, 54000 - 2500 * i) for i in range(num_strikes)] + [(True, 150000), (False, 10000)]),
+        'ETH': (eth_spot_price * 1.01, [(True, 2200 + 200 * i) for i in range(num_strikes)] +
+                [(False, 1650 - 75 * i) for i in range(num_strikes)] + [(True, 6000), (False, 400)]),
+    }
+    for currency, (underlying_price, strikes) in chains.items():
+        step = 1000 if currency == 'BTC' else 50
+        instruments, summaries = [], []
+        for expiry in ("25JUN21", "24SEP21"):
+            for is_call, strike in strikes:
+                strike = round(strike / step) * step
+                name = f"{currency}-{expiry}-{strike}-{'C' if is_call else 'P'}"
+                vol = 0.55 + 0.2 * abs(math.log(strike / underlying_price))
+                mark_price = float(black76(underlying_price, strike, years, vol, is_call)) / underlying_price
+                ask_price = round(max(mark_price * rng.uniform(1.02, 1.15), 0.0005), 4)
+                bid_price = round(mark_price * rng.uniform(0.85, 0.98), 4) or None
+                instruments.append({'instrument_name': name, 'strike': strike, 'kind': "option",
+                                    'option_type': "call" if is_call else "put", 'base_currency': currency})
+                summaries.append({'instrument_name': name, 'underlying_price': underlying_price,
+                                  'ask_price': ask_price, 'bid_price': bid_price, 'mark_price': round(mark_price, 4),
+                                  'mark_iv': round(vol * 100, 2)})
+                responses[request_key("/api/v2/public/ticker", dict(instrument_name=name))] = {'result': {
+                    'instrument_name': name, 'underlying_price': underlying_price, 'best_ask_price': ask_price,
+                    'best_bid_price': bid_price or 0, 'mark_price': round(mark_price, 4),
+                    'mark_iv': round(vol * 100, 2), 'greeks': {}, 'stats': {}}}
+        responses[request_key("/api/v2/public/get_instruments",
+                              dict(currency=currency, kind="option", expired="false"))] = {'result': instruments}
+        responses[request_key("/api/v2/public/get_book_summary_by_currency",
+                              dict(currency=currency, kind="option"))] = {'result': summaries}
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the benchmark fixtures")
+    parser.add_argument("--record", metavar="NAME", help="record the live exchanges into fixtures/NAME.json.gz instead")
+    args = parser.parse_args()
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    if args.record:
+        record_fixture(fixture_path(args.record))
+        return
+    for name, num_strikes in FIXTURE_SIZES.items():
+        save_fixture(fixture_path(name), synthetic_responses(num_strikes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from ETHQuantoFutures.Jobs import OptimizationCancelled
+from ETHQuantoFutures.TradingUtil import TradeSetup, StartingPrices
+from ETHQuantoFutures.Valuation import MarkToMarket, horizon_days
+from ETHQuantoFutures.benchmarks.fixtures import FIXTURE_SIZES, QUOTED_AT_KEY, fixture_path, load_fixture
+from ETHQuantoFutures.benchmarks.standin import ExchangeStandIn
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# optimizer methods and the fixtures they are run on; the exhaustive ones only where they finish in seconds
+OPTIMIZER_SIZES = {
+    'scalar': ('small',),
+    'vectorized': ('small', 'medium'),
+    'parallel': ('small',),
+    'branch_and_bound': ('small', 'medium', 'large'),
+    'lp': ('small', 'medium'),
+    'frontier': ('small',),
+}
+EXACT_METHODS = ('scalar', 'vectorized', 'parallel', 'branch_and_bound', 'frontier')
+
+
+def quiet(*args):
+    pass
+
+
+def measure(function, repeat, warmup=1):
+    # (wall seconds of every repetition, peak traced bytes of one extra repetition); tracemalloc slows the code
+    # it traces, so the timed repetitions run without it
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak
+
+
+def summarize(times, peak, work=None, unit=None):
+    times = np.array(times)
+    result = {'repeat': len(times),
+              'p50_ms': float(np.percentile(times, 50) * 1000),
+              'p90_ms': float(np.percentile(times, 90) * 1000),
+              'p99_ms': float(np.percentile(times, 99) * 1000),
+              'peak_kib': peak / 1024}
+    if work:
+        result[f"{unit}_per_s"] = work / float(np.median(times))
+    return result
+
+
+def queried_setup(responses):
+    with ExchangeStandIn(responses) as stand_in:
+        trade_setup = TradeSetup()
+        trade_setup.starting_parameters.query_exchanges(stand_in.client())
+    # replayed as of when the quotes were taken, not of now
+    trade_setup.starting_parameters.quoted_at = responses.get(QUOTED_AT_KEY, trade_setup.starting_parameters.quoted_at)
+    trade_setup.set_default_state()
+    return trade_setup
+
+
+def optimize(trade_setup, method):
+    # the optimizers report on stdout, that is I/O in the timed region and floods the results
+    trade_setup.set_default_state()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trade_setup.set_optimal_state(method=method, progress=quiet)
+
+
+def candidate_count(trade_setup):
+    # leg combinations the exhaustive search scores, as a common yardstick for every method
+    amounts = trade_setup.optimization_amounts()
+    chains = (trade_setup.starting_parameters.btc_call_options, trade_setup.starting_parameters.btc_put_options,
+              trade_setup.starting_parameters.eth_call_options, trade_setup.starting_parameters.eth_put_options)
+    return int(np.prod([len(options) * len(leg_amounts) for options, leg_amounts in zip(chains, amounts)]))
+
+
+def run_size(name, repeat, results, failures):
+    responses = load_fixture(fixture_path(name))
+
+    with ExchangeStandIn(responses) as stand_in:
+        market_data = stand_in.client()
+        for bulk in (True, False):
+            hits = stand_in.hits
+            times, peak = measure(lambda: StartingPrices().query_exchanges(market_data, bulk=bulk), repeat)
+            results[f"{name}/query_{'bulk' if bulk else 'tickers'}"] = dict(
+                summarize(times, peak), requests=(stand_in.hits - hits) // (repeat + 2))
+
+    trade_setup = queried_setup(responses)
+    grid_points = len(trade_setup.optimization_target.eth_prices_range) * \
+        len(trade_setup.optimization_target.btc_prices_range)
+    eth_prices = np.linspace(0, 10000, 101)
+    btc_prices = np.linspace(0, 200000, 101)
+
+    times, peak = measure(trade_setup.calculate_pnl, repeat * 100)
+    results[f"{name}/calculate_pnl"] = summarize(times, peak, 1, 'pnl_evals')
+    times, peak = measure(lambda: trade_setup.calculate_pnl_grid(eth_prices[:, None], btc_prices[None, :]), repeat)
+    results[f"{name}/calculate_pnl_grid"] = summarize(times, peak, eth_prices.size * btc_prices.size, 'pnl_evals')
+    times, peak = measure(trade_setup.calc_range_min, repeat)
+    results[f"{name}/calc_range_min"] = summarize(times, peak, grid_points, 'pnl_evals')
+    # a zoom at 2000 x 2000, the dense grid of which would be 30 MiB
+    zoom_eth_prices = np.linspace(1000, 3000, 2001)
+    zoom_btc_prices = np.linspace(30000, 90000, 2001)
+    times, peak = measure(lambda: trade_setup.pnl_surface(zoom_eth_prices, zoom_btc_prices).min(), repeat)
+    results[f"{name}/pnl_surface_min"] = summarize(times, peak, zoom_eth_prices.size * zoom_btc_prices.size, 'pnl_evals')
+    # a day half way to expiry, where the options are valued with Black-76
+    middle = horizon_days(trade_setup.starting_parameters) // 2
+    times, peak = measure(lambda: MarkToMarket(trade_setup, eth_prices, btc_prices)[middle], repeat)
+    results[f"{name}/mark_to_market_slice"] = summarize(times, peak, eth_prices.size * btc_prices.size, 'pnl_evals')
+
+    check_pnl(name, trade_setup, eth_prices, btc_prices, failures)
+
+    states = {}
+    candidates = candidate_count(trade_setup)
+    for method, sizes in OPTIMIZER_SIZES.items():
+        if name not in sizes:
+            continue
+        optimized = queried_setup(responses)
+        times, peak = measure(lambda: optimize(optimized, method), repeat, warmup=0)
+        results[f"{name}/optimize_{method}"] = summarize(times, peak, candidates, 'candidates')
+        # every repetition starts from the same default state, so the last one left the optimum behind
+        states[method] = optimized.to_state()['portfolio'], optimized.calc_range_min()
+    check_optimizers(name, states, failures)
+    check_incremental(name, responses, failures)
+
+
+def check_pnl(name, trade_setup, eth_prices, btc_prices, failures):
+    # the grid, the exact range minimum and the expiry slice of the mark-to-market tensor against the scalar PnL
+    rng = np.random.default_rng(0)
+    for eth_exit_price, btc_exit_price in zip(rng.choice(eth_prices, 25), rng.choice(btc_prices, 25)):
+        trade_setup.set_exit_prices(eth_exit_price, btc_exit_price)
+        scalar = trade_setup.calculate_pnl()
+        grid = float(trade_setup.calculate_pnl_grid(eth_exit_price, btc_exit_price))
+        if not np.isclose(scalar, grid, rtol=1e-9, atol=1e-6):
+            failures.append(f"{name}: calculate_pnl_grid {grid} != calculate_pnl {scalar} "
+                            f"at ETH {eth_exit_price}, BTC {btc_exit_price}")
+    if trade_setup.calc_range_min(exact=True) > trade_setup.calc_range_min() + 1e-6:
+        failures.append(f"{name}: exact range minimum above the grid minimum")
+    surface = trade_setup.pnl_surface(eth_prices, btc_prices)
+    grid = trade_setup.calculate_pnl_grid(eth_prices[:, None], btc_prices[None, :])
+    if not np.allclose(surface.dense(), grid, rtol=1e-9, atol=1e-6):
+        failures.append(f"{name}: pnl_surface differs from calculate_pnl_grid")
+    # the convex hull search, not the dense scan small grids take
+    extremes = surface.sub()
+    extremes.DENSE_EXTREMES_SIZE = 0
+    if not np.isclose(extremes.min()[0], grid.min(), atol=1e-6) or not np.isclose(extremes.max()[0], grid.max(), atol=1e-6):
+        failures.append(f"{name}: pnl_surface extremes differ from the calculate_pnl_grid ones")
+    horizon = horizon_days(trade_setup.starting_parameters)
+    if not horizon:
+        failures.append(f"{name}: quoted at or after expiry, mark-to-market has only the expiry day to check")
+    mark_to_market = MarkToMarket(trade_setup, eth_prices, btc_prices)
+    expiry_slice = mark_to_market[horizon]
+    if not np.allclose(expiry_slice, trade_setup.calculate_pnl_grid(eth_prices[:, None], btc_prices[None, :]),
+                       rtol=1e-9, atol=1e-6):
+        failures.append(f"{name}: mark-to-market at expiry differs from calculate_pnl_grid")
+
+
+def check_optimizers(name, states, failures):
+    # every exact method has to land on the scalar optimum (or, where scalar is too slow to run, on the others'),
+    # the LP relaxation may only do better than the discrete search
+    exact = {method: state for method, state in states.items() if method in EXACT_METHODS}
+    reference_method = 'scalar' if 'scalar' in exact else next(iter(exact), None)
+    if reference_method is None:
+        return
+    reference_state, reference_min = exact[reference_method]
+    for method, (state, range_min) in exact.items():
+        if state != reference_state:
+            failures.append(f"{name}: {method} optimum differs from {reference_method}: {state} != {reference_state}")
+    if 'lp' in states and states['lp'][1] < reference_min - 1e-6:
+        failures.append(f"{name}: lp range minimum {states['lp'][1]} below the {reference_method} optimum "
+                        f"{reference_min}")
+
+
+def cancel(*args):
+    raise OptimizationCancelled()
+
+
+def check_incremental(name, responses, failures):
+    # an incremental search cancelled after the ETH chains were repriced must not leave the next one returning
+    # the optimum of the old quotes
+    trade_setup = queried_setup(responses)
+    with contextlib.redirect_stdout(io.StringIO()):
+        trade_setup.set_optimal_state(method='incremental', progress=quiet)
+        for options in (trade_setup.starting_parameters.eth_call_options, trade_setup.starting_parameters.eth_put_options):
+            for index in range(len(options)):
+                options.set(index, 'best_ask_price', options[index]['best_ask_price'] * 0.2)
+        try:
+            trade_setup.set_optimal_state(method='incremental', progress=cancel)
+        except OptimizationCancelled:
+            pass
+        optimize(trade_setup, 'incremental')
+        warm = trade_setup.to_state()['portfolio']
+        optimize(trade_setup, 'branch_and_bound')
+        cold = trade_setup.to_state()['portfolio']
+    if warm != cold:
+        failures.append(f"{name}: incremental optimum after a cancelled run differs from branch_and_bound: "
+                        f"{warm} != {cold}")
+
+
+def calibrate(repeat=7):
+    # median milliseconds of a fixed numpy and interpreter workload, the yardstick that makes timings from
+    # different machines comparable
+    rng = np.random.default_rng(0)
+    values = rng.random(200000)
+
+    def workload():
+        np.sort(values)
+        sum(i * i for i in range(100000))
+    times, _ = measure(workload, repeat)
+    return float(np.median(times) * 1000)
+
+
+def compare(results, baseline, tolerance, speed=1.0):
+    # a benchmark regresses when its median time grows by more than tolerance (0.5 is 50%) or its peak memory does;
+    # speed is this machine's calibration time over the baseline's, baseline times are scaled by it
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric, scale in (('p50_ms', speed), ('peak_kib', 1.0)):
+            expected = previous[metric] * scale
+            if result[metric] > expected * (1 + tolerance) and result[metric] - expected > 1:
+                regressions.append(f"{key}: {metric} {result[metric]:.1f} vs baseline {expected:.1f}" +
+                                   (f" (scaled by {scale:.2f} for this machine)" if metric == 'p50_ms' else ""))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':40} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'peak KiB':>10}  throughput")
+    for key, result in results.items():
+        throughput = ", ".join(f"{value:,.0f} {metric[:-6].replace('_', ' ')}/s"
+                               for metric, value in result.items() if metric.endswith('_per_s'))
+        print(f"{key:40} {result['p50_ms']:10.2f} {result['p90_ms']:10.2f} {result['p99_ms']:10.2f} "
+              f"{result['peak_kib']:10.0f}  {throughput}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks on the recorded exchange fixtures")
+    parser.add_argument("--sizes", default=",".join(FIXTURE_SIZES), help="comma separated fixtures to run")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown against the baseline")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results, failures = {}, []
+    calibration_ms = calibrate()
+    for name in args.sizes.split(","):
+        run_size(name, args.repeat, results, failures)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if failures:
+        print("\nEQUIVALENCE CHECKS FAILED:\n  " + "\n  ".join(failures), file=sys.stderr)
+        sys.exit(1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'calibration_ms': calibration_ms, 'results': results}, f, indent=1)
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        speed = calibration_ms / baseline['calibration_ms'] if baseline.get('calibration_ms') else 1.0
+        regressions = compare(results, baseline['results'], args.tolerance, speed)
+        if regressions:
+            print("\nPERFORMANCE REGRESSIONS against the baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from ETHQuantoFutures.MarketData import MarketDataClient, RateLimiter
+from ETHQuantoFutures.benchmarks.fixtures import request_key
+
+
+class ExchangeStandIn:
+    # serves a fixture over local HTTP for all three exchanges at once, their paths do not overlap
+    def __init__(self, responses, host="127.0.0.1", port=0):
+        self.responses = responses
+        self.hits = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                body = stand_in.responses.get(request_key(url.path, dict(parse_qsl(url.query))))
+                stand_in.hits += 1
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler, bind_and_activate=False)
+        # the per-ticker query opens up to max_workers connections at once, the default backlog of 5 drops some
+        self.server.request_queue_size = 64
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+
+    def client(self):
+        # the stand-in has no rate limits, so neither has its client
+        market_data = MarketDataClient(self.url, self.url, self.url)
+        for exchange in (market_data.bitmex, market_data.binance, market_data.deribit):
+            exchange.rate_limiter = RateLimiter(rate=1e9, burst=1e9)
+        return market_data
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,18 @@
+import pytest
+
+from ETHQuantoFutures.Snapshots import MarketSnapshot
+from ETHQuantoFutures.benchmarks.fixtures import synthetic_responses
+from ETHQuantoFutures.benchmarks.run import queried_setup
+
+
+@pytest.fixture(scope='session')
+def trade_setup():
+    # the small benchmark fixture, queried through the exchange stand-in
+    return queried_setup(synthetic_responses(3))
+
+
+@pytest.fixture(scope='session')
+def snapshot_path(tmp_path_factory, trade_setup):
+    path = tmp_path_factory.mktemp("snapshots") / "snapshot-1620720000.000.json.gz"
+    MarketSnapshot.from_starting_prices(trade_setup.starting_parameters).save(str(path))
+    return str(path)
@@ -0,0 +1,90 @@
+import csv
+
+import numpy as np
+
+from ETHQuantoFutures.Backtest import Backtest
+from ETHQuantoFutures.benchmarks.fixtures import SYNTHETIC_QUOTED_AT, synthetic_responses
+
+STEP = 60
+# (BTC, ETH spot) after every step; the quanto future trades at spot and the options at their payoff after the start
+MOVES = [(55000.0, 1700.0), (61000.0, 1550.0), (47000.0, 2450.0), (52000.0, 1900.0)]
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+def intrinsic(instrument_name, underlying_price):
+    strike = float(instrument_name.split('-')[2])
+    return max(underlying_price - strike, 0) if instrument_name[-1] == 'C' else max(strike - underlying_price, 0)
+
+
+def book_summaries(responses):
+    return [summary for key, value in responses.items() if 'get_book_summary' in key for summary in value['result']]
+
+
+def history(tmp_path):
+    # the synthetic fixture's quotes at the start, then prices moving every step with every option marked at its
+    # payoff, so that the marked PnL has to be the PnL at expiry of calculate_pnl_grid
+    summaries = book_summaries(synthetic_responses(3))
+    bitmex, binance, deribit = [], [], []
+    bitmex.append((SYNTHETIC_QUOTED_AT, 'XBTUSD', 55000.0))
+    bitmex.append((SYNTHETIC_QUOTED_AT, 'ETHUSDM21', 1850.5))
+    binance.append((SYNTHETIC_QUOTED_AT, 1700.0))
+    for summary in summaries:
+        deribit.append((SYNTHETIC_QUOTED_AT, summary['instrument_name'], summary['underlying_price'],
+                        summary['ask_price'], summary['bid_price'], summary['mark_price'], summary['mark_iv']))
+    for step, (btc, eth) in enumerate(MOVES[1:], 1):
+        timestamp = SYNTHETIC_QUOTED_AT + step * STEP
+        bitmex += [(timestamp, 'XBTUSD', btc), (timestamp, 'ETHUSDM21', eth)]
+        binance.append((timestamp, eth))
+        for summary in summaries:
+            underlying_price = btc if summary['instrument_name'].startswith('BTC') else eth
+            deribit.append((timestamp, summary['instrument_name'], underlying_price, summary['ask_price'],
+                            summary['bid_price'], intrinsic(summary['instrument_name'], underlying_price) / underlying_price,
+                            summary['mark_iv']))
+    return (write_csv(tmp_path / "bitmex.csv", ('timestamp', 'symbol', 'bidPrice'), bitmex),
+            write_csv(tmp_path / "binance.csv", ('timestamp', 'price'), binance),
+            write_csv(tmp_path / "deribit.csv", ('timestamp', 'instrument_name', 'underlying_price', 'best_ask_price',
+                                                 'best_bid_price', 'mark_price', 'mark_iv'), deribit))
+
+
+def test_replayed_pnl_path(tmp_path):
+    output = str(tmp_path / "steps.csv")
+    # the optimized position, which holds options; chunks of two steps, so that the last quotes carry over from one
+    # chunk to the next
+    backtest = Backtest(*history(tmp_path), step=STEP, chunk_size=2, method='branch_and_bound')
+    summary = backtest.run(output)
+    steps = np.genfromtxt(output, delimiter=',', names=True)
+
+    assert summary['steps'] == len(MOVES) == len(steps)
+    assert np.allclose(steps['timestamp'], SYNTHETIC_QUOTED_AT + STEP * np.arange(len(MOVES)))
+    assert np.allclose(steps['btc_price'], [btc for btc, _ in MOVES])
+    assert np.allclose(steps['eth_spot_price'], [eth for _, eth in MOVES])
+
+    trade_setup = backtest.trade_setup
+    assert trade_setup.starting_parameters.quoted_at == SYNTHETIC_QUOTED_AT
+    # opened at the start prices: only the options are off, by what their mark is below the ask they were bought at
+    legs = trade_setup.portfolio.leg_table
+    assert steps['spot_pnl'][0] == 0 and steps['futures_pnl'][0] == 0
+    assert steps['options_pnl'][0] < 0
+    marks = {summary['instrument_name']: summary['mark_price'] * summary['underlying_price']
+             for summary in book_summaries(synthetic_responses(3))}
+    assert np.isclose(steps['options_pnl'][0], sum(amount * (marks[name] - premium) for amount, premium, name in
+                                                   zip(legs.amount, legs.premium, backtest.leg_names)))
+
+    # after the start every step is the PnL at expiry at its prices, without a futures premium
+    btc, eth = np.array(MOVES[1:]).T
+    expected = trade_setup.calculate_pnl_grid(eth, btc, premium_exit=0)
+    assert np.allclose(steps['pnl'][1:], expected, rtol=1e-9, atol=1e-6)
+    assert np.allclose(steps['pnl'], steps['spot_pnl'] + steps['futures_pnl'] + steps['options_pnl'])
+    assert np.allclose(steps['liquidation_price'], trade_setup.calculate_bitmex_eth_liq_prices(steps['btc_price']))
+
+    # the CSV has ten significant digits
+    assert np.isclose(summary['final_pnl'], steps['pnl'][-1])
+    assert np.isclose(summary['min_pnl'], steps['pnl'].min()) and np.isclose(summary['max_pnl'], steps['pnl'].max())
+    assert np.isclose(summary['max_drawdown'], (np.maximum.accumulate(steps['pnl']) - steps['pnl']).max())
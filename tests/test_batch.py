@@ -0,0 +1,75 @@
+import csv
+import io
+
+from ETHQuantoFutures.Batch import finished_ids, run_batch, scenarios
+
+
+def spec_for(snapshot_path, methods=('branch_and_bound',)):
+    return {'snapshots': [snapshot_path], 'method': list(methods), 'premium_exit': [0, 0.02],
+            'eth_prices_range': [[1600, 2000, 2400]], 'btc_prices_range': [[40000, 55000, 70000]]}
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_scenario_ids_only_depend_on_the_parameters(snapshot_path):
+    ids = [scenario['id'] for scenario in scenarios(spec_for(snapshot_path))]
+    assert len(set(ids)) == 2
+    assert ids == [scenario['id'] for scenario in scenarios(spec_for(snapshot_path))]
+    # a swept value added at the end leaves the ids of the others alone
+    more = dict(spec_for(snapshot_path), premium_exit=[0, 0.02, 0.05])
+    assert ids == [scenario['id'] for scenario in scenarios(more)][:2]
+
+
+def test_second_run_does_nothing(tmp_path, snapshot_path):
+    output = str(tmp_path / "results.csv")
+    assert run_batch(spec_for(snapshot_path), output, workers=1, log=io.StringIO()) == 0
+    rows = read_rows(output)
+    assert [row['status'] for row in rows] == ['ok', 'ok']
+    with open(output) as f:
+        written = f.read()
+
+    log = io.StringIO()
+    assert run_batch(spec_for(snapshot_path), output, workers=1, log=log) == 0
+    assert log.getvalue().startswith("0 scenarios to run, 2 already in")
+    with open(output) as f:
+        assert f.read() == written
+
+
+def test_cut_off_last_line_is_run_again(tmp_path, snapshot_path):
+    output = str(tmp_path / "results.csv")
+    run_batch(spec_for(snapshot_path), output, workers=1, log=io.StringIO())
+    rows = read_rows(output)
+    with open(output) as f:
+        lines = f.readlines()
+    # an interruption in the middle of writing the last row
+    with open(output, 'w') as f:
+        f.writelines(lines[:-1] + [lines[-1][:20]])
+
+    assert finished_ids(output) == {rows[0]['id']}
+    log = io.StringIO()
+    run_batch(spec_for(snapshot_path), output, workers=1, log=log)
+    assert log.getvalue().startswith("1 scenarios to run, 1 already in")
+    assert sorted(row['id'] for row in read_rows(output)) == sorted(row['id'] for row in rows)
+
+
+def test_retry_failed_only_runs_the_failed_ones(tmp_path, snapshot_path):
+    output = str(tmp_path / "results.csv")
+    spec = spec_for(snapshot_path, methods=('branch_and_bound', 'no_such_method'))
+    assert run_batch(spec, output, workers=1, log=io.StringIO()) == 2
+    first = read_rows(output)
+    failed = {row['id'] for row in first if row['status'] == 'failed'}
+    assert len(first) == 4 and len(failed) == 2
+
+    # failed rows count as done unless asked to retry them
+    log = io.StringIO()
+    assert run_batch(spec, output, workers=1, log=log) == 0
+    assert log.getvalue().startswith("0 scenarios to run")
+    assert len(read_rows(output)) == 4
+
+    assert run_batch(spec, output, workers=1, retry_failed=True, log=io.StringIO()) == 2
+    retried = read_rows(output)[4:]
+    assert {row['id'] for row in retried} == failed
+    assert all(row['status'] == 'failed' for row in retried)
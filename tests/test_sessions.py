@@ -0,0 +1,55 @@
+import multiprocessing
+
+import pytest
+
+from ETHQuantoFutures.Sessions import Session, SessionStore, new_session_id
+
+
+def edited_session(trade_setup):
+    session = Session(trade_setup, n_clicks_optimize=3, optimization_job_id=new_session_id(), stream_version=7,
+                      figure_fingerprint="abc", live=True)
+    session.trade_setup.set_exit_premium(0.02)
+    return session
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_round_trip(tmp_path, trade_setup, shared):
+    store = SessionStore(directory=str(tmp_path) if shared else None)
+    session_id = new_session_id()
+    session = edited_session(trade_setup)
+    store.save(session_id, session)
+
+    loaded = store.load(session_id)
+    assert loaded.to_bytes() == session.to_bytes()
+    assert (loaded.n_clicks_optimize, loaded.stream_version, loaded.figure_fingerprint, loaded.live) == (3, 7, "abc", True)
+    assert loaded.trade_setup.fingerprint == session.trade_setup.fingerprint
+    assert loaded.trade_setup.calc_range_min() == session.trade_setup.calc_range_min()
+    # an unknown session starts out fresh
+    assert store.load(new_session_id()).n_clicks_optimize == 0
+
+
+def test_invalid_session_ids_are_refused(tmp_path):
+    with pytest.raises(ValueError):
+        SessionStore(directory=str(tmp_path)).load("../outside")
+
+
+def count_clicks(directory, session_id, times):
+    # a worker process with its own store on the shared directory
+    store = SessionStore(directory=directory)
+    for _ in range(times):
+        with store.edit(session_id) as session:
+            session.n_clicks_optimize += 1
+
+
+def test_two_writers_lose_no_update(tmp_path, trade_setup):
+    directory = str(tmp_path)
+    session_id = new_session_id()
+    SessionStore(directory=directory).save(session_id, Session(trade_setup))
+    context = multiprocessing.get_context('fork')
+    writers = [context.Process(target=count_clicks, args=(directory, session_id, 25)) for _ in range(2)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join(timeout=60)
+    assert [writer.exitcode for writer in writers] == [0, 0]
+    assert SessionStore(directory=directory).load(session_id).n_clicks_optimize == 50